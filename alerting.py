@@ -0,0 +1,144 @@
+from datetime import datetime, timezone
+
+import psycopg2.extras
+
+SEVERITIES = ('low', 'medium', 'high')
+MAX_BULK_IDS = 1000
+
+# A truck has at most one unread alert per type (the partial unique index
+# idx_alerts_open). Raising a type that is already open folds into that row: its
+# occurrence count grows, last_seen_at and the message move to the newest
+# occurrence and the severity only ever escalates. Once read, the next occurrence
+# opens a fresh row.
+RAISE_ALERTS_QUERY = '''
+    INSERT INTO alerts (truck_id, alert_type, message, severity, occurrences, created_at, last_seen_at)
+    VALUES %s
+    ON CONFLICT (truck_id, alert_type) WHERE NOT is_read DO UPDATE SET
+        occurrences = alerts.occurrences + EXCLUDED.occurrences,
+        message = CASE WHEN EXCLUDED.last_seen_at >= alerts.last_seen_at THEN EXCLUDED.message ELSE alerts.message END,
+        last_seen_at = GREATEST(alerts.last_seen_at, EXCLUDED.last_seen_at),
+        severity = CASE
+            WHEN array_position(ARRAY['low', 'medium', 'high'], EXCLUDED.severity::text)
+               > COALESCE(array_position(ARRAY['low', 'medium', 'high'], alerts.severity::text), 0)
+            THEN EXCLUDED.severity ELSE alerts.severity END
+    RETURNING (xmax = 0)
+'''
+
+# Newest activity first; with one open row per truck and type this reads at most
+# (trucks x alert types) rows from idx_alerts_open.
+DASHBOARD_ALERTS_QUERY = '''
+    SELECT a.*, t.truck_number
+    FROM alerts a
+    JOIN trucks t ON a.truck_id = t.id
+    WHERE t.owner_id = %s AND NOT a.is_read
+    ORDER BY a.last_seen_at DESC
+    LIMIT 10
+'''
+
+
+def _rank(severity):
+    return SEVERITIES.index(severity) if severity in SEVERITIES else -1
+
+
+def raise_alerts(cur, alerts, seen_at=None):
+    # alerts are (truck_id, alert_type, message, severity) tuples. Repeats within the
+    # batch are collapsed first, since one statement may not update a row twice.
+    # Returns the number of new alert rows; the rest were folded into open ones.
+    if not alerts:
+        return 0
+    seen_at = seen_at or datetime.now(timezone.utc).replace(tzinfo=None)
+    merged = {}
+    for truck_id, alert_type, message, severity in alerts:
+        current = merged.get((truck_id, alert_type))
+        if current is None:
+            merged[(truck_id, alert_type)] = [message, severity, 1]
+        else:
+            current[0] = message
+            if _rank(severity) > _rank(current[1]):
+                current[1] = severity
+            current[2] += 1
+    rows = [
+        (truck_id, alert_type, message, severity, occurrences, seen_at, seen_at)
+        for (truck_id, alert_type), (message, severity, occurrences) in sorted(merged.items())
+    ]
+    inserted = psycopg2.extras.execute_values(cur, RAISE_ALERTS_QUERY, rows, fetch=True)
+    return sum(1 for (new,) in inserted if new)
+
+
+def refresh_alert_counts(cur):
+    # Rebuilds owner_alert_counts from scratch; triggers keep it current afterwards.
+    cur.execute('DELETE FROM owner_alert_counts')
+    cur.execute('''
+        INSERT INTO owner_alert_counts (owner_id, severity, unread)
+        SELECT t.owner_id, a.severity, count(*)
+        FROM alerts a
+        JOIN trucks t ON t.id = a.truck_id
+        WHERE NOT a.is_read AND t.owner_id IS NOT NULL
+        GROUP BY 1, 2
+    ''')
+
+
+def unread_counts(cur, owner_id):
+    cur.execute('SELECT severity, unread FROM owner_alert_counts WHERE owner_id = %s', (owner_id,))
+    counts = dict.fromkeys(SEVERITIES, 0)
+    counts.update((severity, unread) for severity, unread in cur.fetchall() if unread)
+    return counts
+
+
+class BulkFilterError(ValueError):
+    pass
+
+
+def bulk_filter(data):
+    # Builds the WHERE clauses of a bulk mark-read from a JSON body. Filters combine:
+    # ids, truck_id, alert_type, severity and a [since, until) range on created_at.
+    if not isinstance(data, dict):
+        raise BulkFilterError('expected a JSON object')
+    clauses, params = [], []
+    ids = data.get('ids')
+    if ids is not None:
+        if not isinstance(ids, list) or not ids or len(ids) > MAX_BULK_IDS:
+            raise BulkFilterError('ids must be a list of 1 to %d alert ids' % MAX_BULK_IDS)
+        try:
+            ids = [int(i) for i in ids]
+        except (TypeError, ValueError):
+            raise BulkFilterError('ids must be integers')
+        clauses.append('a.id = ANY(%s)')
+        params.append(ids)
+    for key in ('truck_id', 'alert_type', 'severity'):
+        value = data.get(key)
+        if value is None:
+            continue
+        if key == 'truck_id':
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise BulkFilterError('truck_id must be an integer')
+        elif not isinstance(value, str):
+            raise BulkFilterError('%s must be a string' % key)
+        clauses.append('a.%s = %%s' % key)
+        params.append(value)
+    for key, op in (('since', '>='), ('until', '<')):
+        value = data.get(key)
+        if value is None:
+            continue
+        try:
+            ts = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except (TypeError, ValueError, AttributeError):
+            raise BulkFilterError('%s must be an ISO 8601 timestamp' % key)
+        if ts.tzinfo is not None:
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        clauses.append('a.created_at %s %%s' % op)
+        params.append(ts)
+    if not clauses:
+        raise BulkFilterError('give at least one of ids, truck_id, alert_type, severity, since, until')
+    return clauses, params
+
+
+def mark_read(cur, owner_id, clauses, params):
+    cur.execute('''
+        UPDATE alerts a SET is_read = TRUE
+        FROM trucks t
+        WHERE a.truck_id = t.id AND t.owner_id = %s AND NOT a.is_read AND ''' + ' AND '.join(clauses),
+        [owner_id] + params)
+    return cur.rowcount
@@ -0,0 +1,183 @@
+import io
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import psycopg2.extras
+
+from alerting import raise_alerts
+
+EARTH_RADIUS_M = 6371008.8
+
+SPEED_LIMIT_KMH = float(os.getenv('SPEED_LIMIT_KMH', '100'))
+SPEEDING_MIN_SECONDS = float(os.getenv('SPEEDING_MIN_SECONDS', '30'))
+IDLE_SPEED_KMH = float(os.getenv('IDLE_SPEED_KMH', '3'))
+IDLE_MIN_SECONDS = float(os.getenv('IDLE_MIN_SECONDS', '900'))
+# Fixes further apart than this are a reporting gap, not continuous driving or idling.
+MAX_SEGMENT_GAP_SECONDS = float(os.getenv('MAX_SEGMENT_GAP_SECONDS', '300'))
+# Segments implying more than this are GPS glitches and are ignored.
+MAX_PLAUSIBLE_KMH = float(os.getenv('MAX_PLAUSIBLE_KMH', '250'))
+FLEET_CHUNK_SIZE = int(os.getenv('ANALYTICS_CHUNK_SIZE', '200'))
+
+# Rows of COPY ... TO STDOUT (FORMAT binary) for four NOT NULL columns
+# (int4 truck_id, float8 epoch, float8 latitude, float8 longitude): each row is
+# a field count followed by (length, value) pairs, so it maps onto a fixed dtype.
+_COPY_ROW = np.dtype([
+    ('fields', '>i2'),
+    ('truck_len', '>i4'), ('truck_id', '>i4'),
+    ('ts_len', '>i4'), ('ts', '>f8'),
+    ('lat_len', '>i4'), ('lat', '>f8'),
+    ('lon_len', '>i4'), ('lon', '>f8'),
+])
+_COPY_HEADER = 19
+_COPY_TRAILER = 2
+
+
+def load_tracks(cur, truck_ids, start, end):
+    query = cur.mogrify('''
+        COPY (
+            SELECT truck_id, extract(epoch FROM timestamp)::float8, latitude::float8, longitude::float8
+            FROM gps_locations
+            WHERE truck_id = ANY(%s) AND timestamp >= %s AND timestamp < %s
+            ORDER BY truck_id, timestamp
+        ) TO STDOUT WITH (FORMAT binary)
+    ''', (list(truck_ids), start, end)).decode()
+    buf = io.BytesIO()
+    cur.copy_expert(query, buf)
+    rows = np.frombuffer(buf.getbuffer()[_COPY_HEADER:len(buf.getbuffer()) - _COPY_TRAILER], dtype=_COPY_ROW)
+    return (
+        rows['truck_id'].astype(np.int64),
+        rows['ts'].astype(np.float64),
+        rows['lat'].astype(np.float64),
+        rows['lon'].astype(np.float64),
+    )
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def segments(truck_ids, ts, lat, lon):
+    # Segment i joins point i and i + 1; segments spanning two trucks are masked out.
+    same_truck = truck_ids[1:] == truck_ids[:-1]
+    distance = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    dt = np.diff(ts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(dt > 0, distance / dt * 3.6, 0.0)
+    valid = same_truck & (dt > 0) & (speed <= MAX_PLAUSIBLE_KMH)
+    distance = np.where(valid, distance, 0.0)
+    return distance, dt, speed, valid
+
+
+def runs(mask):
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def detect_events(truck_ids, ts, speed, dt, valid, mask, min_seconds):
+    starts, ends = runs(mask & valid & (dt <= MAX_SEGMENT_GAP_SECONDS))
+    if len(starts) == 0:
+        return []
+    elapsed = np.concatenate(([0.0], np.cumsum(dt)))
+    duration = elapsed[ends] - elapsed[starts]
+    # reduceat over interleaved (start, end) bounds: even slots reduce [start, end),
+    # odd slots the gaps between runs, which are discarded. An end equal to
+    # len(speed) cannot be an index, so the array gets one padding element.
+    bounds = np.column_stack((starts, ends)).ravel()
+    peak = np.maximum.reduceat(np.append(speed, -np.inf), bounds)[::2]
+    keep = duration >= min_seconds
+    return list(zip(
+        truck_ids[starts[keep]].tolist(),
+        ts[starts[keep]].tolist(),
+        duration[keep].tolist(),
+        peak[keep].tolist(),
+    ))
+
+
+def daily_mileage(truck_ids, ts, distance):
+    # Points arrive ordered by (truck_id, timestamp), so each (truck, UTC day) is one
+    # contiguous run of segments and a reduceat over the run starts sums it.
+    truck = truck_ids[:-1]
+    day = np.floor(ts[:-1] / 86400).astype(np.int64)
+    change = np.concatenate(([True], (truck[1:] != truck[:-1]) | (day[1:] != day[:-1])))
+    starts = np.flatnonzero(change)
+    totals = np.add.reduceat(distance, starts)
+    return list(zip(truck[starts].tolist(), day[starts].tolist(), totals.tolist()))
+
+
+def analyze(truck_ids, ts, lat, lon):
+    if len(ts) < 2:
+        return {'speeding': [], 'idle': [], 'mileage': [], 'distance_m': 0.0}
+    distance, dt, speed, valid = segments(truck_ids, ts, lat, lon)
+    return {
+        'speeding': detect_events(truck_ids, ts, speed, dt, valid, speed > SPEED_LIMIT_KMH, SPEEDING_MIN_SECONDS),
+        'idle': detect_events(truck_ids, ts, speed, dt, valid, speed < IDLE_SPEED_KMH, IDLE_MIN_SECONDS),
+        'mileage': daily_mileage(truck_ids, ts, distance),
+        'distance_m': float(distance.sum()),
+    }
+
+
+def _utc(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+
+
+def _alert_rows(result, truck_numbers):
+    rows = []
+    for truck_id, started, duration, peak in result['speeding']:
+        rows.append((truck_id, 'Speed Alert', '%s exceeded %.0f km/h for %.0fs from %s, peaking at %.0f km/h' % (
+            truck_numbers[truck_id], SPEED_LIMIT_KMH, duration, _utc(started).strftime('%Y-%m-%d %H:%M'), peak), 'medium'))
+    for truck_id, started, duration, _ in result['idle']:
+        rows.append((truck_id, 'Idle Alert', '%s idled for %.0f minutes from %s' % (
+            truck_numbers[truck_id], duration / 60, _utc(started).strftime('%Y-%m-%d %H:%M')), 'low'))
+    return rows
+
+
+def analyze_fleet(conn, start, end, chunk_size=FLEET_CHUNK_SIZE, alerts=True):
+    # Trucks are processed in id-ordered chunks, each in its own short transaction.
+    # Daily mileage is written only for whole UTC days inside [start, end), so the
+    # hourly alert sweep never records partial-day totals. alerts=False only writes
+    # mileage, for the daily pass over windows the hourly sweep has already alerted on.
+    cur = conn.cursor()
+    summary = {'trucks': 0, 'points': 0, 'alerts': 0, 'mileage_rows': 0}
+    first_day = np.ceil((start - datetime(1970, 1, 1)).total_seconds() / 86400)
+    last_day = np.floor((end - datetime(1970, 1, 1)).total_seconds() / 86400)
+    last_id = 0
+    while True:
+        cur.execute('SELECT id, truck_number FROM trucks WHERE id > %s ORDER BY id LIMIT %s', (last_id, chunk_size))
+        trucks = cur.fetchall()
+        if not trucks:
+            break
+        last_id = trucks[-1][0]
+        truck_numbers = dict(trucks)
+
+        truck_ids, ts, lat, lon = load_tracks(cur, truck_numbers, start, end)
+        result = analyze(truck_ids, ts, lat, lon)
+
+        rows = _alert_rows(result, truck_numbers) if alerts else []
+        raise_alerts(cur, rows)
+        mileage = [
+            (truck_id, _utc(day * 86400).date(), meters)
+            for truck_id, day, meters in result['mileage']
+            if first_day <= day < last_day
+        ]
+        if mileage:
+            psycopg2.extras.execute_values(cur, '''
+                INSERT INTO truck_daily_mileage (truck_id, day, distance_m) VALUES %s
+                ON CONFLICT (truck_id, day) DO UPDATE SET distance_m = EXCLUDED.distance_m
+            ''', mileage)
+        conn.commit()
+
+        summary['trucks'] += len(trucks)
+        summary['points'] += len(ts)
+        summary['alerts'] += len(rows)
+        summary['mileage_rows'] += len(mileage)
+    cur.close()
+    return summary
+
+
+def previous_hour(now=None):
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    end = now.replace(minute=0, second=0, microsecond=0)
+    return end - timedelta(hours=1), end
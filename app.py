@@ -1,25 +1,211 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-from werkzeug.security import check_password_hash, generate_password_hash
+import click
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify
+import numpy as np
 import psycopg2.extras
+import hmac
+import logging
 import os
-from datetime import datetime, timedelta
-from models import get_db_connection, init_db, create_test_data
+from datetime import datetime, timedelta, timezone
+from models import get_db, get_db_connection, close_db, get_pool, init_db, drop_db, create_test_data
+from migrations import HOT_QUERIES, check_hot_query_indexes
+import events
+import jobs
+import profiling
+from auth import owns_truck, truck_owner
+from dispatch import DispatchError, nearest_trucks, parse_query as parse_dispatch_query
+from fleet_state import fleet_state
+from gateway import authenticate_device, issue_device_tokens
+from geofence import Fence, GeofenceError, load_fences, parse_geofence, invalidate as invalidate_geofences
+from gps_storage import ensure_partitions, run_compaction, apply_retention, read_history
+from ingest import IngestError, ingest_authorized, parse_timestamp, point_reader, copy_gps_points
+from alerting import DASHBOARD_ALERTS_QUERY, BulkFilterError, bulk_filter, mark_read, unread_counts
+from analytics import analyze_fleet, previous_hour
+from archive import ARCHIVE_AFTER_DAYS, archive_history, face_detections_page, gps_page, read_points
+from fleetgen import generate_fleet
+from face_match import FaceMatchError, encode_embedding, match_detections, parse_detections, parse_embedding, invalidate as invalidate_faces
+from pagination import (
+    ALERTS_PAGE_QUERY, FACE_DETECTIONS_PAGE_QUERY, LOCATIONS_PAGE_QUERY, RECORDINGS_PAGE_QUERY,
+    CursorError, decode_cursor, keyset_page, page_size,
+)
+from truck_bundle import load_truck_bundle
+from recordings import (
+    RecordingError, create_recording, finalize, locked, parse_camera_number, remove, upload_offset, upload_url,
+    video_response, video_url, write_chunk,
+)
+from passwords import LoginThrottledError, check_password, login_failed, login_succeeded, throttle_login
+from page_cache import cached_fragment, conditional_response, fleet_validator, fragments, truck_validator
+from trajectory import check_detail, encode_polyline, project, simplify, zoom_tolerance
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SESSION_SECRET', 'dev-secret-key-change-in-production')
+app.permanent_session_lifetime = timedelta(hours=float(os.getenv('SESSION_LIFETIME_HOURS', '12')))
+app.teardown_appcontext(close_db)
+app.jinja_env.globals['cached_fragment'] = cached_fragment
 
-db_initialized = False
+@app.before_request
+def start_request_profiling():
+    profiling.start_request(profile='profile' in request.args)
 
 @app.before_request
-def initialize_database():
-    global db_initialized
-    if not db_initialized:
-        try:
-            init_db()
-            create_test_data()
-            db_initialized = True
-        except Exception as e:
-            print(f"Database initialization error: {e}")
+def start_event_listener():
+    events.get_listener()
+
+@app.before_request
+def start_job_scheduler():
+    jobs.get_scheduler()
+
+@app.after_request
+def finish_request_profiling(response):
+    finished = profiling.finish_request(request.endpoint or 'unmatched', request.method, response.status_code)
+    if finished is None:
+        return response
+    elapsed, stats, sampler = finished
+    response.headers['Server-Timing'] = 'db;dur=%.2f;desc="%d queries, %d rows", total;dur=%.2f' % (
+        stats.db_time * 1000, stats.queries, stats.rows, elapsed * 1000)
+    if sampler is not None:
+        report = profiling.profile_report('%s %s' % (request.method, request.path), elapsed, stats, sampler)
+        return Response(report, mimetype='text/plain')
+    return response
+
+INGEST_MAX_POINTS = int(os.getenv('INGEST_MAX_POINTS', '200000'))
+HISTORY_MAX_POINTS = int(os.getenv('HISTORY_MAX_POINTS', '2000'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+@app.cli.command('init-db')
+def init_db_command():
+    applied = init_db()
+    print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+
+@app.cli.command('seed-db')
+def seed_db_command():
+    init_db()
+    print("Seeded test data" if create_test_data() else "Database already has users; not seeding")
+
+@app.cli.command('reset-db')
+def reset_db_command():
+    drop_db()
+    init_db()
+    create_test_data()
+    print("Database reset and seeded")
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    conn = get_db_connection()
+    try:
+        failures = check_hot_query_indexes(conn)
+    finally:
+        conn.close()
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        raise SystemExit(1)
+    print(f"All {len(HOT_QUERIES)} hot queries use their index")
+
+@app.cli.command('gps-maintenance')
+def gps_maintenance_command():
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        created = ensure_partitions(cur)
+        conn.commit()
+        cur.close()
+        compacted = run_compaction(conn)
+        expired = apply_retention(conn)
+    finally:
+        conn.close()
+    print(f"Created {len(created)} partitions, compacted {compacted} minute buckets, expired {len(expired)} partitions")
+
+@app.cli.command('archive-history')
+@click.option('--older-than-days', default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive days at least this old')
+def archive_history_command(older_than_days):
+    conn = get_db_connection()
+    try:
+        summary = archive_history(conn, older_than_days, progress=print)
+    finally:
+        conn.close()
+    print(f"Archived {summary['segments']} day segments, {summary['rows']} rows")
+
+@app.cli.command('analyze-fleet')
+@click.option('--since', help='Window start (ISO 8601, UTC); defaults to the previous full hour')
+@click.option('--until', help='Window end (ISO 8601, UTC)')
+def analyze_fleet_command(since, until):
+    start, end = previous_hour()
+    if since:
+        start = parse_timestamp(since)
+    if until:
+        end = parse_timestamp(until)
+    conn = get_db_connection()
+    try:
+        summary = analyze_fleet(conn, start, end)
+    finally:
+        conn.close()
+    print(f"Analyzed {summary['points']} points from {summary['trucks']} trucks: "
+          f"{summary['alerts']} alerts, {summary['mileage_rows']} daily mileage rows")
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    init_db()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    jobs.serve()
+
+@app.cli.command('jobs')
+@click.option('--history', metavar='NAME', help='Show the latest runs of one job')
+def jobs_command(history):
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        if history:
+            for started_at, seconds, status, worker, result, error in jobs.job_history(cur, history):
+                print(f"{started_at:%Y-%m-%d %H:%M:%S}  {seconds:8.2f}s  {status:11}  {worker}  {error or result}")
+            return
+        for name, schedule, enabled, next_run_at, lease_owner, started_at, status, seconds, _ in jobs.job_status(cur):
+            state = f"running on {lease_owner}" if lease_owner else (
+                f"last {status} at {started_at:%Y-%m-%d %H:%M:%S} in {seconds:.2f}s" if status else 'never run')
+            print(f"{name:16} {schedule:18} {'next ' + format(next_run_at, '%Y-%m-%d %H:%M:%S') if enabled else 'disabled':25} {state}")
+    finally:
+        conn.close()
+
+@app.cli.command('run-job')
+@click.argument('name')
+def run_job_command(name):
+    try:
+        jobs.get_job(name)
+    except jobs.JobError as e:
+        raise click.BadParameter(str(e))
+    scheduler = jobs.Scheduler(os.getenv('DATABASE_URL'), workers=1)
+    try:
+        finished = scheduler.run_now(name)
+    finally:
+        scheduler.stop()
+    if finished is None:
+        raise SystemExit(f"{name} is running in another scheduler")
+    status, seconds, result, error = finished
+    print(f"{name} {status} in {seconds:.2f}s: {error or result}")
+    if status != 'succeeded':
+        raise SystemExit(1)
+
+@app.cli.command('generate-fleet')
+@click.option('--trucks', default=1000, show_default=True)
+@click.option('--trucks-per-owner', default=20, show_default=True)
+@click.option('--drivers-per-truck', default=2, show_default=True)
+@click.option('--hours', default=24, show_default=True, help='GPS history per truck')
+@click.option('--interval', default=60, show_default=True, help='Seconds between GPS points')
+@click.option('--alerts-per-truck', default=10, show_default=True)
+@click.option('--detections-per-truck', default=10, show_default=True)
+@click.option('--recordings-per-truck', default=4, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+def generate_fleet_command(**options):
+    init_db()
+    conn = get_db_connection()
+    try:
+        summary = generate_fleet(conn, progress=print, **options)
+    finally:
+        conn.close()
+    print(f"Generated {summary['owners']} owners ({summary['usernames']}, password 'password123'), "
+          f"{summary['trucks']} trucks, {summary['drivers']} drivers, {summary['gps_points']} GPS points, "
+          f"{summary['alerts']} alerts, {summary['face_detections']} face detections and "
+          f"{summary['recordings']} recordings in {summary['seconds']}s")
 
 @app.route('/')
 def index():
@@ -37,20 +223,34 @@ def login():
             flash('Username and password are required', 'error')
             return render_template('login.html')
         
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute('SELECT * FROM users WHERE username = %s', (username,))
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
+        try:
+            throttle_login(username, request.remote_addr)
+            conn = get_db()
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cur.execute('SELECT * FROM users WHERE username = %s', (username,))
+            user = cur.fetchone()
+            cur.close()
+            # Hand the connection back before hashing, so logins waiting on the KDF
+            # never hold pooled connections that page requests need.
+            close_db()
+            valid = user is not None and check_password(user['password_hash'], password)
+        except LoginThrottledError as e:
+            flash(str(e), 'error')
+            return render_template('login.html'), e.status, {'Retry-After': str(e.retry_after)}
         
-        if user and check_password_hash(user['password_hash'], password):
+        if valid:
+            login_succeeded(username, request.remote_addr)
+            # The signed session cookie is the only record of the login: later requests
+            # trust session['user_id'] without a users lookup until the lifetime ends.
+            session.clear()
+            session.permanent = True
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['full_name'] = user['full_name']
             flash('Login successful!', 'success')
             return redirect(url_for('dashboard'))
         else:
+            login_failed(request.remote_addr)
             flash('Invalid username or password', 'error')
     
     return render_template('login.html')
@@ -67,115 +267,131 @@ def dashboard():
         return redirect(url_for('login'))
     
     user_id = session['user_id']
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cur.execute('''
-        SELECT * FROM trucks 
-        WHERE owner_id = %s 
-        ORDER BY created_at DESC
-    ''', (user_id,))
-    trucks = cur.fetchall()
-    
-    cur.execute('''
-        SELECT a.*, t.truck_number 
-        FROM alerts a
-        JOIN trucks t ON a.truck_id = t.id
-        WHERE t.owner_id = %s AND a.is_read = FALSE
-        ORDER BY a.created_at DESC
-        LIMIT 10
-    ''', (user_id,))
-    alerts = cur.fetchall()
+    validator = fleet_validator(user_id)
     
-    cur.close()
-    conn.close()
+    def render():
+        conn = get_db()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        
+        trucks = fleet_state(cur, user_id)
+        
+        cur.execute(DASHBOARD_ALERTS_QUERY, (user_id,))
+        alerts = cur.fetchall()
+        alert_counts = unread_counts(cur, user_id)
+        
+        cur.close()
+        
+        return render_template('dashboard.html', trucks=trucks, alerts=alerts, alert_counts=alert_counts,
+                               page_version=validator and validator.version)
     
-    return render_template('dashboard.html', trucks=trucks, alerts=alerts)
+    return conditional_response(validator, render)
 
 @app.route('/truck/<int:truck_id>')
+@owns_truck(html=True)
 def truck_detail(truck_id):
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user_id = session['user_id']
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    validator = truck_validator(truck_id, session['user_id'])
     
-    cur.execute('SELECT * FROM trucks WHERE id = %s AND owner_id = %s', (truck_id, user_id))
-    truck = cur.fetchone()
-    
-    if not truck:
-        flash('Truck not found or access denied', 'error')
-        return redirect(url_for('dashboard'))
-    
-    cur.execute('SELECT * FROM drivers WHERE truck_id = %s', (truck_id,))
-    drivers = cur.fetchall()
-    
-    cur.execute('''
-        SELECT * FROM gps_locations 
-        WHERE truck_id = %s 
-        ORDER BY timestamp DESC 
-        LIMIT 1
-    ''', (truck_id,))
-    current_location = cur.fetchone()
-    
-    cur.execute('''
-        SELECT * FROM gps_locations 
-        WHERE truck_id = %s 
-        ORDER BY timestamp DESC 
-        LIMIT 50
-    ''', (truck_id,))
-    travel_history = cur.fetchall()
-    
-    cur.execute('''
-        SELECT fd.*, d.name as driver_name 
-        FROM face_detections fd
-        LEFT JOIN drivers d ON fd.driver_id = d.id
-        WHERE fd.truck_id = %s 
-        ORDER BY fd.detected_at DESC 
-        LIMIT 10
-    ''', (truck_id,))
-    face_detections = cur.fetchall()
+    def render():
+        cur = get_db().cursor()
+        bundle = load_truck_bundle(cur, truck_id)
+        cur.close()
+        
+        if bundle is None:
+            flash('Truck not found or access denied', 'error')
+            return redirect(url_for('dashboard'))
+        
+        return render_template('truck_detail.html', 
+                             truck=bundle.truck, 
+                             drivers=bundle.drivers,
+                             current_location=bundle.location,
+                             page_version=validator and validator.version)
     
-    cur.execute('''
-        SELECT * FROM video_recordings 
-        WHERE truck_id = %s 
-        ORDER BY recorded_at DESC
-    ''', (truck_id,))
-    recordings = cur.fetchall()
+    return conditional_response(validator, render)
+
+def keyset_response(query, ts_column, truck_id, archived=None):
+    try:
+        cursor = request.args.get('cursor')
+        decode_cursor(cursor)
+    except CursorError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = page_size(request.args.get('limit', type=int))
+    
+    cur = get_db().cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    items, next_cursor = keyset_page(cur, query, ts_column, truck_id, cursor, limit, archived)
+    cur.close()
     
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/truck/<int:truck_id>/recordings')
+@owns_truck()
+def truck_recordings(truck_id):
+    return keyset_response(RECORDINGS_PAGE_QUERY, 'recorded_at', truck_id)
+
+@app.route('/truck/<int:truck_id>/alerts')
+@owns_truck()
+def truck_alerts(truck_id):
+    return keyset_response(ALERTS_PAGE_QUERY, 'created_at', truck_id)
+
+@app.route('/truck/<int:truck_id>/face_detections')
+@owns_truck()
+def truck_face_detections(truck_id):
+    return keyset_response(FACE_DETECTIONS_PAGE_QUERY, 'detected_at', truck_id, face_detections_page)
+
+@app.route('/truck/<int:truck_id>/locations')
+@owns_truck()
+def truck_locations(truck_id):
+    return keyset_response(LOCATIONS_PAGE_QUERY, 'timestamp', truck_id, gps_page)
+
+@app.route('/truck/<int:truck_id>/history')
+@owns_truck()
+def truck_history(truck_id):
+    try:
+        end = parse_timestamp(request.args.get('end')) or datetime.now(timezone.utc).replace(tzinfo=None)
+        start = parse_timestamp(request.args.get('start')) or end - timedelta(hours=24)
+        zoom = request.args.get('zoom', type=float)
+        tolerance = request.args.get('tolerance', type=float)
+        check_detail(zoom, tolerance)
+        max_points = min(request.args.get('max_points', HISTORY_MAX_POINTS, type=int), HISTORY_MAX_POINTS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if start >= end:
+        return jsonify({'error': 'start must be before end'}), 400
+    
+    conn = get_db()
+    cur = conn.cursor()
+    resolution, points = read_history(cur, truck_id, start, end, read_points)
     cur.close()
-    conn.close()
     
-    return render_template('truck_detail.html', 
-                         truck=truck, 
-                         drivers=drivers,
-                         current_location=current_location,
-                         travel_history=travel_history,
-                         face_detections=face_detections,
-                         recordings=recordings)
+    lat, lon = points[:, 0], points[:, 1]
+    if tolerance is None:
+        tolerance = zoom_tolerance(zoom, float(lat.mean())) if zoom is not None and len(points) else 0.0
+    keep = simplify(project(lat, lon), tolerance, max_points)
+    
+    result = {
+        'truck_id': truck_id,
+        'resolution': resolution,
+        'source_points': len(points),
+        'points': len(keep),
+        'tolerance_m': round(tolerance, 2),
+    }
+    if request.args.get('format') == 'polyline':
+        result['polyline'] = encode_polyline(lat[keep], lon[keep])
+        result['timestamps'] = points[keep, 2].astype(np.int64).tolist()
+    else:
+        result['path'] = points[keep].tolist()
+    return jsonify(result)
 
 @app.route('/truck/<int:truck_id>/driver/add', methods=['POST'])
+@owns_truck()
 def add_driver(truck_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
-    
     name = request.form.get('name')
     phone = request.form.get('phone')
     license_number = request.form.get('license_number')
     photo_url = request.form.get('photo_url', '/static/images/default_driver.jpg')
     
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
-    cur.execute('SELECT owner_id FROM trucks WHERE id = %s', (truck_id,))
-    truck = cur.fetchone()
-    
-    if not truck or truck[0] != session['user_id']:
-        cur.close()
-        conn.close()
-        return jsonify({'error': 'Access denied'}), 403
-    
     cur.execute('''
         INSERT INTO drivers (truck_id, name, phone, license_number, photo_url)
         VALUES (%s, %s, %s, %s, %s)
@@ -183,31 +399,20 @@ def add_driver(truck_id):
     
     conn.commit()
     cur.close()
-    conn.close()
     
     flash('Driver added successfully', 'success')
     return redirect(url_for('truck_detail', truck_id=truck_id))
 
 @app.route('/truck/<int:truck_id>/driver/<int:driver_id>/edit', methods=['POST'])
+@owns_truck()
 def edit_driver(truck_id, driver_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
-    
     name = request.form.get('name')
     phone = request.form.get('phone')
     license_number = request.form.get('license_number')
     
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
-    cur.execute('SELECT owner_id FROM trucks WHERE id = %s', (truck_id,))
-    truck = cur.fetchone()
-    
-    if not truck or truck[0] != session['user_id']:
-        cur.close()
-        conn.close()
-        return jsonify({'error': 'Access denied'}), 403
-    
     cur.execute('''
         UPDATE drivers 
         SET name = %s, phone = %s, license_number = %s
@@ -216,164 +421,515 @@ def edit_driver(truck_id, driver_id):
     
     conn.commit()
     cur.close()
-    conn.close()
     
     flash('Driver updated successfully', 'success')
     return redirect(url_for('truck_detail', truck_id=truck_id))
 
 @app.route('/truck/<int:truck_id>/driver/<int:driver_id>/delete', methods=['POST'])
+@owns_truck()
 def delete_driver(truck_id, driver_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
-    
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
-    cur.execute('SELECT owner_id FROM trucks WHERE id = %s', (truck_id,))
-    truck = cur.fetchone()
-    
-    if not truck or truck[0] != session['user_id']:
-        cur.close()
-        conn.close()
-        return jsonify({'error': 'Access denied'}), 403
-    
     cur.execute('DELETE FROM drivers WHERE id = %s AND truck_id = %s', (driver_id, truck_id))
     
     conn.commit()
     cur.close()
-    conn.close()
     
     flash('Driver deleted successfully', 'success')
     return redirect(url_for('truck_detail', truck_id=truck_id))
 
-@app.route('/truck/<int:truck_id>/recording/start', methods=['POST'])
-def start_recording(truck_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
+@app.route('/truck/<int:truck_id>/driver/<int:driver_id>/embedding', methods=['PUT', 'DELETE'])
+@owns_truck()
+def driver_embedding(truck_id, driver_id):
+    embedding = None
+    if request.method == 'PUT':
+        try:
+            embedding = encode_embedding(parse_embedding((request.get_json(silent=True) or {}).get('embedding')))
+        except FaceMatchError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    conn = get_db()
+    cur = conn.cursor()
     
-    camera_number = request.form.get('camera_number', 1)
+    cur.execute('UPDATE drivers SET embedding = %s WHERE id = %s AND truck_id = %s',
+                (psycopg2.Binary(embedding) if embedding else None, driver_id, truck_id))
+    updated = cur.rowcount
     
-    conn = get_db_connection()
+    conn.commit()
+    cur.close()
+    
+    if not updated:
+        return jsonify({'error': 'Driver not found'}), 404
+    invalidate_faces()
+    
+    return jsonify({'driver_id': driver_id, 'enrolled': embedding is not None})
+
+@app.route('/truck/<int:truck_id>/device_token', methods=['POST'])
+@owns_truck()
+def issue_device_token(truck_id):
+    conn = get_db()
     cur = conn.cursor()
     
-    cur.execute('SELECT owner_id FROM trucks WHERE id = %s', (truck_id,))
-    truck = cur.fetchone()
+    token = issue_device_tokens(cur, [truck_id])[truck_id]
     
-    if not truck or truck[0] != session['user_id']:
-        cur.close()
-        conn.close()
-        return jsonify({'error': 'Access denied'}), 403
+    conn.commit()
+    cur.close()
     
-    file_url = f'/static/videos/truck{truck_id}_cam{camera_number}_rec_{datetime.now().strftime("%Y%m%d_%H%M%S")}.mp4'
+    # The token is only ever shown here; the database keeps its hash.
+    return jsonify({'truck_id': truck_id, 'token': token})
+
+@app.route('/truck/<int:truck_id>/recording/start', methods=['POST'])
+@owns_truck()
+def start_recording(truck_id):
+    try:
+        camera_number = parse_camera_number(request.form.get('camera_number', 1))
+    except RecordingError as e:
+        return jsonify({'error': str(e)}), e.status
     
-    cur.execute('''
-        INSERT INTO video_recordings (truck_id, camera_number, file_url, status)
-        VALUES (%s, %s, %s, %s)
-    ''', (truck_id, camera_number, file_url, 'recording'))
+    conn = get_db()
+    cur = conn.cursor()
+    
+    recording_id = create_recording(cur, truck_id, camera_number)
     
     conn.commit()
     cur.close()
-    conn.close()
     
-    return jsonify({'message': 'Recording started', 'file_url': file_url})
+    return jsonify({'message': 'Recording started', 'recording_id': recording_id,
+                    'file_url': video_url(truck_id, recording_id), 'upload_url': upload_url(truck_id, recording_id)})
 
 @app.route('/truck/<int:truck_id>/recording/<int:recording_id>/stop', methods=['POST'])
+@owns_truck()
 def stop_recording(truck_id, recording_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
-    
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
-    cur.execute('SELECT owner_id FROM trucks WHERE id = %s', (truck_id,))
-    truck = cur.fetchone()
-    
-    if not truck or truck[0] != session['user_id']:
+    # Refuse further chunks first, then wait for the upload in flight to finish
+    # before measuring what was received.
+    cur.execute('''
+        UPDATE video_recordings SET status = 'saved'
+        WHERE id = %s AND truck_id = %s AND status = 'recording'
+        RETURNING file_path
+    ''', (recording_id, truck_id))
+    row = cur.fetchone()
+    conn.commit()
+    if row is None:
         cur.close()
-        conn.close()
-        return jsonify({'error': 'Access denied'}), 403
-    
+        return jsonify({'error': 'Recording not found or already stopped'}), 404
+    
+    file_size, duration = 0, None
+    if row[0] is not None:
+        close_db()
+        with locked(row[0], wait=True) as f:
+            file_size, duration = finalize(f)
+        conn = get_db()
+        cur = conn.cursor()
+    # Without a duration in the file, the recording lasted from start to stop.
     cur.execute('''
-        UPDATE video_recordings 
-        SET status = %s, file_size = %s, duration = %s
-        WHERE id = %s AND truck_id = %s
-    ''', ('saved', 524288000, 3600, recording_id, truck_id))
+        UPDATE video_recordings
+        SET file_size = %s, duration = COALESCE(%s, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - recorded_at))::integer
+        WHERE id = %s
+        RETURNING duration
+    ''', (file_size, round(duration) if duration is not None else None, recording_id))
+    duration = cur.fetchone()[0]
     
     conn.commit()
     cur.close()
-    conn.close()
     
-    return jsonify({'message': 'Recording stopped and saved'})
+    return jsonify({'message': 'Recording stopped and saved', 'file_size': file_size, 'duration': duration})
 
 @app.route('/truck/<int:truck_id>/recording/<int:recording_id>/delete', methods=['POST'])
+@owns_truck()
 def delete_recording(truck_id, recording_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
-    
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
-    cur.execute('SELECT owner_id FROM trucks WHERE id = %s', (truck_id,))
-    truck = cur.fetchone()
-    
-    if not truck or truck[0] != session['user_id']:
-        cur.close()
-        conn.close()
-        return jsonify({'error': 'Access denied'}), 403
-    
-    cur.execute('DELETE FROM video_recordings WHERE id = %s AND truck_id = %s', (recording_id, truck_id))
+    cur.execute('DELETE FROM video_recordings WHERE id = %s AND truck_id = %s RETURNING file_path',
+                (recording_id, truck_id))
+    row = cur.fetchone()
     
     conn.commit()
     cur.close()
-    conn.close()
+    if row is not None and row[0] is not None:
+        remove(row[0])
     
     flash('Recording deleted successfully', 'success')
     return redirect(url_for('truck_detail', truck_id=truck_id))
 
+@app.route('/truck/<int:truck_id>/recording/<int:recording_id>/video')
+@owns_truck()
+def recording_video(truck_id, recording_id):
+    cur = get_db().cursor()
+    cur.execute('SELECT file_path FROM video_recordings WHERE id = %s AND truck_id = %s', (recording_id, truck_id))
+    row = cur.fetchone()
+    cur.close()
+    close_db()
+    
+    response = video_response(row[0]) if row is not None and row[0] is not None else None
+    if response is None:
+        return jsonify({'error': 'Recording has no video'}), 404
+    return response
+
 @app.route('/truck/<int:truck_id>/camera/<int:camera_number>/feed')
+@owns_truck()
 def camera_feed(truck_id, camera_number):
-    if 'user_id' not in session:
+    cur = get_db().cursor()
+    cur.execute('''
+        SELECT id FROM video_recordings
+        WHERE truck_id = %s AND camera_number = %s AND status = 'recording' AND file_path IS NOT NULL
+        ORDER BY recorded_at DESC, id DESC
+        LIMIT 1
+    ''', (truck_id, camera_number))
+    row = cur.fetchone()
+    cur.close()
+    
+    # The live view plays the recording being uploaded, up to the bytes received.
+    if row is None:
+        return jsonify({'truck_id': truck_id, 'camera_number': camera_number, 'status': 'offline',
+                        'stream_url': None, 'message': 'No recording in progress on this camera'})
+    return jsonify({
+        'truck_id': truck_id,
+        'camera_number': camera_number,
+        'status': 'live',
+        'recording_id': row[0],
+        'stream_url': video_url(truck_id, row[0]),
+    })
+
+def device_authorized(truck_id):
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return False
+    cur = get_db().cursor()
+    authorized = authenticate_device(cur, truck_id, token.strip()) is not None
+    cur.close()
+    return authorized
+
+@app.route('/api/truck/<int:truck_id>/recordings', methods=['POST'])
+def device_start_recording(truck_id):
+    if not device_authorized(truck_id):
         return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        camera_number = parse_camera_number((request.get_json(silent=True) or {}).get('camera_number', 1))
+    except RecordingError as e:
+        return jsonify({'error': str(e)}), e.status
     
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
-    cur.execute('SELECT owner_id FROM trucks WHERE id = %s', (truck_id,))
-    truck = cur.fetchone()
+    recording_id = create_recording(cur, truck_id, camera_number)
     
+    conn.commit()
     cur.close()
-    conn.close()
     
-    if not truck or truck[0] != session['user_id']:
-        return jsonify({'error': 'Access denied'}), 403
+    return jsonify({'recording_id': recording_id, 'upload_url': upload_url(truck_id, recording_id)}), 201
+
+@app.route('/api/truck/<int:truck_id>/recordings/active')
+def device_active_recordings(truck_id):
+    if not device_authorized(truck_id):
+        return jsonify({'error': 'Unauthorized'}), 401
     
-    return jsonify({
-        'truck_id': truck_id,
+    cur = get_db().cursor()
+    cur.execute('''
+        SELECT id, camera_number, file_path FROM video_recordings
+        WHERE truck_id = %s AND status = 'recording' AND file_path IS NOT NULL
+        ORDER BY id
+    ''', (truck_id,))
+    rows = cur.fetchall()
+    cur.close()
+    
+    # Recordings started from the dashboard are picked up here by the truck.
+    return jsonify({'recordings': [{
+        'recording_id': recording_id,
         'camera_number': camera_number,
-        'status': 'live',
-        'stream_url': f'/static/videos/live_feed_cam{camera_number}.mp4',
-        'message': 'Simulated live camera feed'
+        'upload_url': upload_url(truck_id, recording_id),
+        'offset': upload_offset(file_path),
+    } for recording_id, camera_number, file_path in rows]})
+
+@app.route('/api/truck/<int:truck_id>/recording/<int:recording_id>/upload', methods=['HEAD', 'PATCH'])
+def upload_recording(truck_id, recording_id):
+    if not device_authorized(truck_id):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    query = 'SELECT status, file_path FROM video_recordings WHERE id = %s AND truck_id = %s'
+    cur = get_db().cursor()
+    cur.execute(query, (recording_id, truck_id))
+    row = cur.fetchone()
+    if row is None or row[1] is None:
+        cur.close()
+        return jsonify({'error': 'Recording not found'}), 404
+    status, file_path = row
+    if request.method == 'HEAD':
+        cur.close()
+        return '', 200, {'Upload-Offset': str(upload_offset(file_path)), 'Upload-Complete': str(status != 'recording').lower()}
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        cur.close()
+        return jsonify({'error': 'Upload-Offset header is required'}), 400
+    try:
+        with locked(file_path, wait=False) as f:
+            # Checked again under the lock: stop flips the status before it waits for it.
+            cur.execute(query, (recording_id, truck_id))
+            row = cur.fetchone()
+            cur.close()
+            close_db()
+            if row is None or row[0] != 'recording':
+                raise RecordingError('Recording is no longer accepting uploads', 409, upload_offset(file_path))
+            offset = write_chunk(f, offset, request.stream)
+    except RecordingError as e:
+        headers = {'Upload-Offset': str(e.offset)} if e.offset is not None else {}
+        return jsonify({'error': str(e), 'offset': e.offset}), e.status, headers
+    
+    return '', 204, {'Upload-Offset': str(offset)}
+
+def event_stream_response(channel):
+    subscription = events.broker.subscribe([channel])
+    return Response(events.stream(subscription), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
     })
 
+@app.route('/events')
+def owner_events():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return event_stream_response('owner:%d' % session['user_id'])
+
+@app.route('/truck/<int:truck_id>/events')
+@owns_truck()
+def truck_events(truck_id):
+    return event_stream_response('truck:%d' % truck_id)
+
+@app.route('/stats/db_pool')
+def db_pool_stats():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return jsonify(get_pool().stats())
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + METRICS_TOKEN):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    
+    pool = get_pool().stats()
+    gauges = []
+    for key in ('size', 'in_use', 'idle', 'waiting'):
+        gauges.append('# TYPE db_pool_%s gauge' % key)
+        gauges.append('db_pool_%s %s' % (key, pool[key]))
+    for key in ('checkouts', 'timeouts', 'health_check_failures'):
+        gauges.append('# TYPE db_pool_%s_total counter' % key)
+        gauges.append('db_pool_%s_total %s' % (key, pool[key]))
+    gauges.append('# TYPE sse_subscribers gauge')
+    gauges.append('sse_subscribers %d' % events.broker.subscriber_count())
+    gauges.append('# TYPE fragment_cache_bytes gauge')
+    gauges.append('fragment_cache_bytes %d' % fragments.size)
+    for key in ('hits', 'misses'):
+        gauges.append('# TYPE fragment_cache_%s_total counter' % key)
+        gauges.append('fragment_cache_%s_total %d' % (key, getattr(fragments, key)))
+    
+    return Response(profiling.render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/alert/<int:alert_id>/mark_read', methods=['POST'])
 def mark_alert_read(alert_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
     cur.execute('''
-        UPDATE alerts 
+        UPDATE alerts a
         SET is_read = TRUE 
-        WHERE id = %s
-    ''', (alert_id,))
+        FROM trucks t
+        WHERE a.id = %s AND a.truck_id = t.id AND t.owner_id = %s
+    ''', (alert_id, session['user_id']))
+    updated = cur.rowcount
     
     conn.commit()
     cur.close()
-    conn.close()
+    
+    if not updated:
+        return jsonify({'error': 'Alert not found'}), 404
     
     return jsonify({'message': 'Alert marked as read'})
 
+@app.route('/alerts/mark_read', methods=['POST'])
+def mark_alerts_read():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        clauses, params = bulk_filter(request.get_json(silent=True))
+    except BulkFilterError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    updated = mark_read(cur, session['user_id'], clauses, params)
+    alert_counts = unread_counts(cur, session['user_id'])
+    
+    conn.commit()
+    cur.close()
+    
+    return jsonify({'updated': updated, 'unread': alert_counts})
+
+@app.route('/geofences', methods=['GET'])
+def list_geofences():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    cur = get_db().cursor()
+    fences = load_fences(cur, session['user_id'])
+    cur.close()
+    
+    return jsonify({'geofences': [fence.to_dict() for fence in fences]})
+
+@app.route('/geofences', methods=['POST'])
+def create_geofence():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        fence = parse_geofence(request.get_json(silent=True))
+    except GeofenceError as e:
+        return jsonify({'error': str(e)}), 400
+    if fence['truck_id'] is not None and truck_owner(fence['truck_id']) != session['user_id']:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        INSERT INTO geofences (owner_id, truck_id, name, shape, coordinates, radius_m, alert_on)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+    ''', (session['user_id'], fence['truck_id'], fence['name'], fence['shape'],
+          psycopg2.extras.Json(fence['coordinates']), fence['radius_m'], fence['alert_on']))
+    geofence_id = cur.fetchone()[0]
+    
+    conn.commit()
+    cur.close()
+    invalidate_geofences()
+    
+    created = Fence(geofence_id, session['user_id'], fence['truck_id'], fence['name'], fence['shape'],
+                    fence['coordinates'], fence['radius_m'], fence['alert_on'])
+    return jsonify(created.to_dict()), 201
+
+@app.route('/geofences/<int:geofence_id>', methods=['DELETE'])
+def delete_geofence(geofence_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    cur.execute('DELETE FROM geofences WHERE id = %s AND owner_id = %s', (geofence_id, session['user_id']))
+    deleted = cur.rowcount
+    
+    conn.commit()
+    cur.close()
+    
+    if not deleted:
+        return jsonify({'error': 'Geofence not found'}), 404
+    invalidate_geofences()
+    
+    return jsonify({'message': 'Geofence deleted'})
+
+@app.route('/dispatch/nearest')
+def dispatch_nearest():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        query = parse_dispatch_query(request.args)
+    except DispatchError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    cur = get_db().cursor()
+    found = nearest_trucks(cur, session['user_id'], query['lat'], query['lon'], query['k'], query['radius_m'])
+    details = {}
+    if found:
+        cur.execute('SELECT id, truck_number, license_plate, status FROM trucks WHERE id = ANY(%s)',
+                    ([truck_id for truck_id, *_ in found],))
+        details = {row[0]: row[1:] for row in cur.fetchall()}
+    cur.close()
+    
+    trucks = []
+    for truck_id, distance, lat, lon, speed, reported_at in found:
+        if truck_id not in details:
+            continue
+        truck_number, license_plate, status = details[truck_id]
+        trucks.append({
+            'truck_id': truck_id,
+            'truck_number': truck_number,
+            'license_plate': license_plate,
+            'status': status,
+            'latitude': lat,
+            'longitude': lon,
+            'speed': speed,
+            'reported_at': reported_at,
+            'distance_m': round(distance, 1),
+        })
+    return jsonify({'trucks': trucks})
+
+@app.route('/api/face/detections', methods=['POST'])
+def ingest_face_detections():
+    if not ingest_authorized(request.headers.get('Authorization')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        detections = parse_detections(request.get_json(silent=True))
+    except FaceMatchError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    try:
+        result = match_detections(cur, detections)
+    except FaceMatchError as e:
+        conn.rollback()
+        cur.close()
+        return jsonify({'error': str(e)}), 400
+    
+    conn.commit()
+    cur.close()
+    
+    return jsonify(result)
+
+@app.route('/api/gps/batch', methods=['POST'])
+def ingest_gps_batch():
+    if not ingest_authorized(request.headers.get('Authorization')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        reader = point_reader(request.mimetype, request.stream, request.headers.get('Content-Encoding'))
+    except IngestError as e:
+        return jsonify({'error': str(e)}), 415
+    
+    conn = get_db()
+    cur = conn.cursor()
+    
+    try:
+        result = copy_gps_points(cur, reader, max_points=INGEST_MAX_POINTS)
+    except IngestError as e:
+        conn.rollback()
+        cur.close()
+        return jsonify({'error': str(e)}), 413
+    except (UnicodeDecodeError, OSError, EOFError) as e:
+        conn.rollback()
+        cur.close()
+        return jsonify({'error': 'Malformed request body: %s' % e}), 400
+    
+    conn.commit()
+    cur.close()
+    
+    return jsonify(result)
+
 if __name__ == '__main__':
+    init_db()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,476 @@
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+import events
+from gps_storage import DEFAULT_PARTITION, list_partitions, partition_name
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_OPEN_SEGMENTS = int(os.getenv('ARCHIVE_OPEN_SEGMENTS', '256'))
+MANIFEST_TTL = float(os.getenv('ARCHIVE_MANIFEST_TTL', '300'))
+
+# A segment holds one table's rows for one day, sorted by (truck_id, ts, id) and
+# stored column by column so every column is a zero-copy view of the mapped file:
+#
+#   MAGIC | column | column | ... | JSON footer | footer offset (<u8) | MAGIC
+#
+# Columns start on 64-byte boundaries. The footer lists each column's dtype, offset
+# and length; truck_ids/truck_offsets index the rows of each truck. Timestamps are
+# microseconds since the Unix epoch, strings are UTF-8 bytes addressed by offsets.
+MAGIC = b'FLEETARC'
+ALIGN = 64
+EPOCH = datetime(1970, 1, 1)
+# Binary COPY timestamps count from 2000-01-01.
+PG_EPOCH_US = 946684800 * 10 ** 6
+
+_COPY_GPS_ROW = np.dtype([
+    ('fields', '>i2'),
+    ('id_len', '>i4'), ('id', '>i8'),
+    ('truck_id_len', '>i4'), ('truck_id', '>i4'),
+    ('ts_len', '>i4'), ('ts', '>i8'),
+    ('lat_len', '>i4'), ('lat', '>f8'),
+    ('lon_len', '>i4'), ('lon', '>f8'),
+    ('speed_len', '>i4'), ('speed', '>f4'),
+])
+# Every field is fixed-width and non-null, so the COPY stream parses as one record array.
+_GPS_COLUMNS = "id, COALESCE(truck_id, -1), timestamp, latitude::float8, longitude::float8, COALESCE(speed, 'NaN')"
+
+_FACE_COLUMNS = 'id, truck_id, driver_id, image_url, confidence::float8, match_result, detected_at'
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def _micros(ts):
+    return (ts - EPOCH) // timedelta(microseconds=1)
+
+
+def _timestamp(micros):
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
+def _encode_strings(values):
+    encoded = [(value or '').encode() for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    null = np.fromiter((value is None for value in values), dtype=np.bool_, count=len(values))
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8), null
+
+
+def write_segment(path, columns, meta):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    layout = {}
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        for name, values in columns.items():
+            values = np.ascontiguousarray(values)
+            f.write(b'\0' * (-f.tell() % ALIGN))
+            layout[name] = [values.dtype.str, f.tell(), len(values)]
+            f.write(values.data)
+        footer_offset = f.tell()
+        f.write(json.dumps(dict(meta, columns=layout)).encode())
+        f.write(struct.pack('<Q', footer_offset) + MAGIC)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+    os.replace(tmp, path)
+    return size
+
+
+class Segment:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC or self._mmap[-len(MAGIC):] != MAGIC:
+            raise ArchiveError('%s is not an archive segment' % path)
+        footer_offset, = struct.unpack('<Q', self._mmap[-16:-8])
+        self.meta = json.loads(self._mmap[footer_offset:-16])
+        self.rows = self.meta['rows']
+        self._columns = {
+            name: np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+            for name, (dtype, offset, count) in self.meta['columns'].items()
+        }
+        self.truck_ids = self._columns['truck_ids']
+        self.truck_offsets = self._columns['truck_offsets']
+
+    def column(self, name):
+        return self._columns[name]
+
+    def truck_range(self, truck_id):
+        i = int(np.searchsorted(self.truck_ids, truck_id))
+        if i == len(self.truck_ids) or self.truck_ids[i] != truck_id:
+            return 0, 0
+        return int(self.truck_offsets[i]), int(self.truck_offsets[i + 1])
+
+    def string(self, name, row):
+        if self._columns[name + '.null'][row]:
+            return None
+        offsets = self._columns[name + '.offsets']
+        return self._columns[name + '.data'][offsets[row]:offsets[row + 1]].tobytes().decode()
+
+    def columns(self):
+        # Every row decoded back into arrays, for merging late rows into an archived day.
+        columns = {'truck_id': np.repeat(self.truck_ids, np.diff(self.truck_offsets))}
+        for name, values in self._columns.items():
+            base, _, part = name.partition('.')
+            if base in ('truck_ids', 'truck_offsets'):
+                continue
+            if part == 'offsets':
+                columns[base] = np.array([self.string(base, row) for row in range(self.rows)], dtype=object)
+            elif not part:
+                columns[name] = np.array(values)
+        return columns
+
+
+def _build_columns(columns):
+    order = np.lexsort((columns['id'], columns['ts'], columns['truck_id']))
+    columns = {name: values[order] for name, values in columns.items()}
+    truck_ids, starts = np.unique(columns.pop('truck_id'), return_index=True)
+    built = {
+        'truck_ids': truck_ids.astype(np.int32),
+        'truck_offsets': np.append(starts, len(order)).astype(np.int64),
+    }
+    for name, values in columns.items():
+        if values.dtype == object:
+            built[name + '.offsets'], built[name + '.data'], built[name + '.null'] = _encode_strings(values)
+        else:
+            built[name] = values
+    return built
+
+
+def _copy_gps(cur, query, params):
+    buf = io.BytesIO()
+    cur.copy_expert('COPY (' + cur.mogrify(query, params).decode() + ') TO STDOUT WITH (FORMAT binary)', buf)
+    data = buf.getbuffer()
+    # 11-byte signature, flags, header extension length and extension; 2-byte trailer.
+    extension, = struct.unpack('>i', data[15:19])
+    rows = np.frombuffer(data[19 + extension:len(data) - 2], dtype=_COPY_GPS_ROW)
+    return {
+        'truck_id': rows['truck_id'].astype(np.int32),
+        'id': rows['id'].astype(np.int64),
+        'ts': rows['ts'].astype(np.int64) + PG_EPOCH_US,
+        'latitude': rows['lat'].astype(np.float64),
+        'longitude': rows['lon'].astype(np.float64),
+        'speed': rows['speed'].astype(np.float32),
+    }
+
+
+def _extract_gps(cur, day):
+    # The day's partition is read under an EXCLUSIVE lock (readers continue, writers
+    # wait) and dropped just before commit; stragglers in the default partition are
+    # deleted and returned in one statement.
+    name = partition_name(day)
+    start, end = day, day + timedelta(days=1)
+    parts = []
+    cur.execute('SELECT to_regclass(%s) IS NOT NULL', (name,))
+    partition = name if cur.fetchone()[0] else None
+    if partition:
+        cur.execute('LOCK TABLE %s IN EXCLUSIVE MODE' % partition)
+        parts.append(_copy_gps(cur, 'SELECT ' + _GPS_COLUMNS + ' FROM ' + partition, ()))
+    parts.append(_copy_gps(cur, 'DELETE FROM ' + DEFAULT_PARTITION + ' WHERE timestamp >= %s AND timestamp < %s '
+                           'RETURNING ' + _GPS_COLUMNS, (start, end)))
+    columns = {column: np.concatenate([part[column] for part in parts]) for column in parts[0]}
+    return columns, partition
+
+
+def _extract_face_detections(cur, day):
+    cur.execute('DELETE FROM face_detections WHERE detected_at >= %s AND detected_at < %s RETURNING ' + _FACE_COLUMNS,
+                (day, day + timedelta(days=1)))
+    rows = cur.fetchall()
+    ids, truck_ids, driver_ids, image_urls, confidences, results, detected = zip(*rows) if rows else ((),) * 7
+    columns = {
+        'truck_id': np.array([-1 if t is None else t for t in truck_ids], dtype=np.int32),
+        'id': np.array(ids, dtype=np.int64),
+        'ts': np.array(detected, dtype='datetime64[us]').astype(np.int64),
+        'driver_id': np.array([-1 if d is None else d for d in driver_ids], dtype=np.int32),
+        'confidence': np.array([np.nan if c is None else c for c in confidences], dtype=np.float64),
+        'image_url': np.array(image_urls, dtype=object),
+        'match_result': np.array(results, dtype=object),
+    }
+    return columns, None
+
+
+_EXTRACTORS = {'gps_locations': _extract_gps, 'face_detections': _extract_face_detections}
+
+
+def archive_day(conn, table, day):
+    # Moves one table-day out of Postgres into a new segment file. The manifest row and
+    # the deletes commit together, so a day is readable from exactly one place; a crash
+    # before commit leaves only an unreferenced file behind. Rows that arrive for an
+    # already archived day are merged into a replacement segment.
+    cur = conn.cursor()
+    path = None
+    try:
+        cur.execute('SELECT path FROM archive_segments WHERE table_name = %s AND day = %s FOR UPDATE', (table, day))
+        row = cur.fetchone()
+        previous = row[0] if row else None
+        columns, partition = _EXTRACTORS[table](cur, day)
+        if previous is not None:
+            old = open_segment(previous).columns()
+            columns = {name: np.concatenate((old[name], values)) for name, values in columns.items()}
+        rows = len(columns['id'])
+        if rows:
+            built = _build_columns(columns)
+            path = '%s/%s-%s.seg' % (table, day.strftime('%Y%m%d'), uuid.uuid4().hex[:12])
+            size = write_segment(os.path.join(ARCHIVE_DIR, path), built,
+                                 {'version': 1, 'table': table, 'day': day.isoformat(), 'rows': rows})
+            cur.execute('''
+                INSERT INTO archive_segments (table_name, day, path, row_count, trucks, bytes, truck_ids)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (table_name, day) DO UPDATE SET
+                    path = EXCLUDED.path,
+                    row_count = EXCLUDED.row_count,
+                    trucks = EXCLUDED.trucks,
+                    bytes = EXCLUDED.bytes,
+                    truck_ids = EXCLUDED.truck_ids,
+                    archived_at = CURRENT_TIMESTAMP
+            ''', (table, day, path, rows, len(built['truck_ids']), size, built['truck_ids'].tolist()))
+        if partition:
+            cur.execute('DROP TABLE ' + partition)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if path is not None:
+            _remove(path)
+        raise
+    finally:
+        cur.close()
+    if previous is not None and path is not None:
+        _remove(previous)
+    return rows
+
+
+def _remove(path):
+    try:
+        os.remove(os.path.join(ARCHIVE_DIR, path))
+    except FileNotFoundError:
+        pass
+
+
+def pending_days(cur, cutoff, gps_cutoff):
+    gps_days = set(list_partitions(cur))
+    cur.execute('SELECT DISTINCT timestamp::date FROM ' + DEFAULT_PARTITION + ' WHERE timestamp < %s', (gps_cutoff,))
+    gps_days.update(day for (day,) in cur.fetchall())
+    cur.execute('SELECT DISTINCT detected_at::date FROM face_detections WHERE detected_at < %s', (cutoff,))
+    face_days = {day for (day,) in cur.fetchall()}
+    return ([('gps_locations', day) for day in sorted(gps_days) if day < gps_cutoff] +
+            [('face_detections', day) for day in sorted(face_days)])
+
+
+def index_segments(conn):
+    # Fills in the truck list of segments archived before the manifest kept one.
+    cur = conn.cursor()
+    cur.execute('SELECT table_name, day, path FROM archive_segments WHERE truck_ids IS NULL')
+    for table, day, path in cur.fetchall():
+        cur.execute('UPDATE archive_segments SET truck_ids = %s WHERE table_name = %s AND day = %s AND path = %s',
+                    (open_segment(path).truck_ids.tolist(), table, day, path))
+    conn.commit()
+    cur.close()
+
+
+def archive_history(conn, older_than_days=ARCHIVE_AFTER_DAYS, progress=None):
+    index_segments(conn)
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=older_than_days)
+    cur = conn.cursor()
+    # Raw points the rollups have not absorbed yet stay in the table, as for retention.
+    cur.execute('SELECT compacted_until FROM gps_rollup_progress')
+    row = cur.fetchone()
+    gps_cutoff = min(cutoff, row[0].date() if row and row[0] else date.min)
+    days = pending_days(cur, cutoff, gps_cutoff)
+    conn.commit()
+    cur.close()
+
+    summary = {'segments': 0, 'rows': 0}
+    for table, day in days:
+        rows = archive_day(conn, table, day)
+        summary['segments'] += rows > 0
+        summary['rows'] += rows
+        if progress:
+            progress('%-16s %s %9d rows' % (table, day, rows))
+    return summary
+
+
+_lock = threading.Lock()
+_manifest = None
+_loaded_at = 0.0
+
+_segments_lock = threading.Lock()
+_segments = OrderedDict()
+
+
+def invalidate():
+    global _manifest
+    with _lock:
+        _manifest = None
+
+
+# archive_segments notifies on every change; processes without a listener rely on
+# ARCHIVE_MANIFEST_TTL instead.
+events.on_notify('archive_changed', lambda payload: invalidate())
+
+
+def load_manifest(cur):
+    # Per table: days, segment paths and the sorted truck ids with rows in each segment
+    # (None when not recorded, which means the segment must be opened to tell).
+    cur.execute('SELECT table_name, day, path, truck_ids FROM archive_segments ORDER BY table_name, day')
+    manifest = {}
+    for table, day, path, truck_ids in cur.fetchall():
+        days, paths, trucks = manifest.setdefault(table, ([], [], []))
+        days.append(day)
+        paths.append(path)
+        trucks.append(None if truck_ids is None else np.array(truck_ids, dtype=np.int32))
+    return manifest
+
+
+def get_manifest(conn):
+    global _manifest, _loaded_at
+    with _lock:
+        if _manifest is None or time.monotonic() - _loaded_at > MANIFEST_TTL:
+            cur = conn.cursor()
+            try:
+                _manifest = load_manifest(cur)
+            finally:
+                cur.close()
+            _loaded_at = time.monotonic()
+        return _manifest
+
+
+def open_segment(path):
+    with _segments_lock:
+        segment = _segments.get(path)
+        if segment is not None:
+            _segments.move_to_end(path)
+            return segment
+    segment = Segment(os.path.join(ARCHIVE_DIR, path))
+    with _segments_lock:
+        _segments[path] = segment
+        # Evicted mappings are unmapped once the last view into them is gone.
+        while len(_segments) > ARCHIVE_OPEN_SEGMENTS:
+            _segments.popitem(last=False)
+    return segment
+
+
+def _has_truck(truck_ids, truck_id):
+    if truck_ids is None:
+        return True
+    i = int(np.searchsorted(truck_ids, truck_id))
+    return i < len(truck_ids) and truck_ids[i] == truck_id
+
+
+def _segment_paths(cur, table, first_day, last_day, truck_id):
+    # Oldest first, leaving out the days the manifest says have no rows for the truck.
+    days, paths, trucks = get_manifest(cur.connection).get(table, ((), (), ()))
+    lo, hi = bisect_left(days, first_day), bisect_right(days, last_day)
+    return [path for path, truck_ids in zip(paths[lo:hi], trucks[lo:hi]) if _has_truck(truck_ids, truck_id)]
+
+
+def _day_segments(cur, table, first_day, last_day, truck_id):
+    for attempt in range(2):
+        try:
+            return [open_segment(path) for path in _segment_paths(cur, table, first_day, last_day, truck_id)]
+        except FileNotFoundError:
+            # Replaced by a newer segment since the manifest was loaded.
+            if attempt:
+                raise
+            invalidate()
+
+
+def read_points(cur, truck_id, start, end):
+    # Archived GPS points in [start, end) as (latitude, longitude, epoch seconds) rows,
+    # the same shape read_history produces from the table.
+    parts = []
+    lo_us, hi_us = _micros(start), _micros(end)
+    last_day = (end - timedelta(microseconds=1)).date()
+    for segment in _day_segments(cur, 'gps_locations', start.date(), last_day, truck_id):
+        lo, hi = segment.truck_range(truck_id)
+        ts = segment.column('ts')[lo:hi]
+        a, b = lo + int(np.searchsorted(ts, lo_us)), lo + int(np.searchsorted(ts, hi_us))
+        if a < b:
+            parts.append(np.column_stack((segment.column('latitude')[a:b], segment.column('longitude')[a:b],
+                                          segment.column('ts')[a:b] / 1e6)))
+    return np.concatenate(parts) if parts else np.empty((0, 3))
+
+
+def _page_rows(cur, table, truck_id, before_ts, before_id, limit, since=None):
+    # Newest-first (segment, row) pairs strictly before the (before_ts, before_id) cursor,
+    # from days no older than since. Segments are opened one at a time, newest first,
+    # until the page is full.
+    before_us = _micros(before_ts)
+    first_day = since.date() if since is not None else date.min
+    for attempt in range(2):
+        found = []
+        try:
+            for path in reversed(_segment_paths(cur, table, first_day, before_ts.date(), truck_id)):
+                segment = open_segment(path)
+                lo, hi = segment.truck_range(truck_id)
+                ts = segment.column('ts')[lo:hi]
+                ids = segment.column('id')[lo:hi]
+                first, last = int(np.searchsorted(ts, before_us)), int(np.searchsorted(ts, before_us, 'right'))
+                stop = lo + first + int(np.searchsorted(ids[first:last], before_id))
+                start = max(lo, stop - (limit - len(found)))
+                found.extend((segment, row) for row in range(stop - 1, start - 1, -1))
+                if len(found) >= limit:
+                    break
+            return found
+        except FileNotFoundError:
+            if attempt:
+                raise
+            invalidate()
+
+
+def gps_page(cur, truck_id, before_ts, before_id, limit, since=None):
+    # Rows shaped like LOCATIONS_PAGE_QUERY's. speed goes through str() so a REAL
+    # comes back with the same shortest digits Postgres prints.
+    rows = []
+    for segment, row in _page_rows(cur, 'gps_locations', truck_id, before_ts, before_id, limit, since):
+        speed = segment.column('speed')[row]
+        rows.append({
+            'id': int(segment.column('id')[row]),
+            'latitude': float(segment.column('latitude')[row]),
+            'longitude': float(segment.column('longitude')[row]),
+            'speed': None if np.isnan(speed) else float(str(speed)),
+            'timestamp': _timestamp(segment.column('ts')[row]),
+        })
+    return rows
+
+
+def face_detections_page(cur, truck_id, before_ts, before_id, limit, since=None):
+    # Rows shaped like FACE_DETECTIONS_PAGE_QUERY's; driver names are looked up live.
+    rows = []
+    for segment, row in _page_rows(cur, 'face_detections', truck_id, before_ts, before_id, limit, since):
+        driver_id = int(segment.column('driver_id')[row])
+        confidence = float(segment.column('confidence')[row])
+        rows.append({
+            'id': int(segment.column('id')[row]),
+            'driver_id': None if driver_id < 0 else driver_id,
+            'image_url': segment.string('image_url', row),
+            'confidence': None if np.isnan(confidence) else confidence,
+            'match_result': segment.string('match_result', row),
+            'detected_at': _timestamp(segment.column('ts')[row]),
+        })
+    driver_ids = list({row['driver_id'] for row in rows if row['driver_id'] is not None})
+    names = {}
+    if driver_ids:
+        lookup = cur.connection.cursor()
+        lookup.execute('SELECT id, name FROM drivers WHERE id = ANY(%s)', (driver_ids,))
+        names = dict(lookup.fetchall())
+        lookup.close()
+    for row in rows:
+        # A driver deleted since is NULL in the table (ON DELETE SET NULL); mirror that.
+        if row['driver_id'] not in names:
+            row['driver_id'] = None
+        row['driver_name'] = names.get(row['driver_id'])
+    return rows
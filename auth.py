@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import flash, jsonify, redirect, session, url_for
+
+import events
+from models import get_db
+
+_MISSING = object()
+
+
+class TruckOwnerCache:
+    def __init__(self, maxsize=10000, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, truck_id):
+        with self._lock:
+            entry = self._entries.get(truck_id)
+            if entry is None:
+                return _MISSING
+            owner_id, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[truck_id]
+                return _MISSING
+            self._entries.move_to_end(truck_id)
+            return owner_id
+
+    def put(self, truck_id, owner_id):
+        with self._lock:
+            self._entries[truck_id] = (owner_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(truck_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, truck_id=None):
+        with self._lock:
+            if truck_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(truck_id, None)
+
+
+truck_owners = TruckOwnerCache(
+    maxsize=int(os.getenv('TRUCK_OWNER_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('TRUCK_OWNER_CACHE_TTL', '60')),
+)
+
+
+def invalidate_truck(truck_id=None):
+    truck_owners.invalidate(truck_id)
+
+
+# Reassignments and deletions committed by any process arrive through the LISTEN
+# thread; the TTL only bounds staleness if a notification is ever missed.
+events.on_notify('truck_owner_changed', lambda payload: invalidate_truck(payload.get('truck_id')))
+
+
+def truck_owner(truck_id):
+    owner_id = truck_owners.get(truck_id)
+    if owner_id is not _MISSING:
+        return owner_id
+
+    cur = get_db().cursor()
+    cur.execute('SELECT owner_id FROM trucks WHERE id = %s', (truck_id,))
+    row = cur.fetchone()
+    cur.close()
+
+    owner_id = row[0] if row else None
+    truck_owners.put(truck_id, owner_id)
+    return owner_id
+
+
+def owns_truck(html=False):
+    def decorator(view):
+        @wraps(view)
+        def wrapped(truck_id, *args, **kwargs):
+            if 'user_id' not in session:
+                if html:
+                    return redirect(url_for('login'))
+                return jsonify({'error': 'Unauthorized'}), 401
+
+            owner_id = truck_owner(truck_id)
+            if owner_id is None or owner_id != session['user_id']:
+                if html:
+                    flash('Truck not found or access denied', 'error')
+                    return redirect(url_for('dashboard'))
+                return jsonify({'error': 'Access denied'}), 403
+
+            return view(truck_id, *args, **kwargs)
+        return wrapped
+    return decorator
@@ -0,0 +1,78 @@
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from analytics import EARTH_RADIUS_M, IDLE_SPEED_KMH, MAX_PLAUSIBLE_KMH, SPEED_LIMIT_KMH, analyze
+
+
+def synthetic_fleet(trucks, points_per_truck, seed=11):
+    # Five-second fixes; each truck alternates between driving, speeding and parking.
+    rng = np.random.default_rng(seed)
+    n = trucks * points_per_truck
+    truck_ids = np.repeat(np.arange(1, trucks + 1), points_per_truck)
+    ts = 1_790_000_000 + np.tile(np.arange(points_per_truck) * 5.0, trucks)
+    phase = (np.arange(n) // 200) % 3
+    speed_ms = np.choose(phase, [rng.normal(22, 3, n), rng.normal(32, 2, n), np.zeros(n)])
+    heading = np.cumsum(rng.normal(0, 0.05, n))
+    step = speed_ms * 5 / 111_195
+    lat = 40.0 + np.cumsum(np.sin(heading) * step) + rng.normal(0, 1e-6, n)
+    lon = -100.0 + np.cumsum(np.cos(heading) * step) + rng.normal(0, 1e-6, n)
+    return truck_ids, ts, lat, lon
+
+
+def python_loop(truck_ids, ts, lat, lon):
+    distance = speeding = idle = 0
+    for i in range(1, len(ts)):
+        if truck_ids[i] != truck_ids[i - 1]:
+            continue
+        p1, p2 = math.radians(lat[i - 1]), math.radians(lat[i])
+        a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon[i] - lon[i - 1]) / 2) ** 2
+        d = 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+        dt = ts[i] - ts[i - 1]
+        speed = d / dt * 3.6 if dt > 0 else 0.0
+        if dt <= 0 or speed > MAX_PLAUSIBLE_KMH:
+            continue
+        distance += d
+        speeding += speed > SPEED_LIMIT_KMH
+        idle += speed < IDLE_SPEED_KMH
+    return distance
+
+
+def timed(label, fn, points):
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    print('%-36s %8.3fs  %12.0f points/s' % (label, elapsed, points / elapsed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark vectorized trip analytics against a per-row Python loop.')
+    parser.add_argument('--trucks', type=int, default=1000)
+    parser.add_argument('--points-per-truck', type=int, default=10_000)
+    parser.add_argument('--baseline-points', type=int, default=500_000)
+    args = parser.parse_args()
+
+    truck_ids, ts, lat, lon = synthetic_fleet(args.trucks, args.points_per_truck)
+    n = len(ts)
+    print('%d trucks x %d points = %d points' % (args.trucks, args.points_per_truck, n))
+
+    result = timed('NumPy analyze (fleet)', lambda: analyze(truck_ids, ts, lat, lon), n)
+    print('  %d speeding events, %d idle events, %d truck-days, %.0f km' % (
+        len(result['speeding']), len(result['idle']), len(result['mileage']), result['distance_m'] / 1000))
+
+    m = min(args.baseline_points, n)
+    subset = truck_ids[:m].tolist(), ts[:m].tolist(), lat[:m].tolist(), lon[:m].tolist()
+    expected = timed('Python loop (%d points)' % m, lambda: python_loop(*subset), m)
+    actual = timed('NumPy analyze (%d points)' % m, lambda: analyze(truck_ids[:m], ts[:m], lat[:m], lon[:m]), m)
+    print('  distance matches: %s' % math.isclose(expected, actual['distance_m'], rel_tol=1e-9))
+
+
+if __name__ == '__main__':
+    main()
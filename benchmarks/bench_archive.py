@@ -0,0 +1,104 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import psycopg2
+
+import archive
+from fleetgen import copy_tracks, simulate_tracks
+from gps_storage import create_partition, partition_name
+
+RAW_QUERY = '''
+    SELECT latitude::float8, longitude::float8, extract(epoch FROM timestamp)::float8 FROM gps_locations
+    WHERE truck_id = %s AND timestamp >= %s AND timestamp < %s
+    ORDER BY timestamp
+'''
+
+# Loads one synthetic day of GPS points into its own partition, reads every truck's
+# day through SQL, archives the day and reads it again from the segment file.
+
+
+def sql_day(cur, truck_id, start, end):
+    cur.execute(RAW_QUERY, (truck_id, start, end))
+    return np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 3)
+
+
+def timed(label, read, truck_ids, rounds):
+    points = 0
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        points = sum(len(read(truck_id)) for truck_id in truck_ids)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print('%-8s %9d points in %7.3fs  %8.3f us/point  %12.0f points/s' % (
+        label, points, best, best / points * 1e6, points / best))
+    return best / points
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare SQL reads of a GPS day with reads from its archive segment.')
+    parser.add_argument('--trucks', type=int, default=200)
+    parser.add_argument('--interval', type=int, default=60, help='Seconds between GPS points')
+    parser.add_argument('--day', default='2001-01-01', help='Synthetic day to load; must not have a partition yet')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    day = date.fromisoformat(args.day)
+    start, end = datetime.combine(day, datetime.min.time()), datetime.combine(day + timedelta(days=1), datetime.min.time())
+    archive.ARCHIVE_DIR = tempfile.mkdtemp(prefix='fleet-archive-')
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    cur.execute('SELECT to_regclass(%s) IS NOT NULL', (partition_name(day),))
+    if cur.fetchone()[0]:
+        sys.exit('%s already has a partition; pick another --day' % day)
+    cur.execute('SELECT id FROM trucks ORDER BY id LIMIT %s', (args.trucks,))
+    truck_ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int32)
+    if not len(truck_ids):
+        sys.exit('no trucks in database; seed it first')
+
+    create_partition(cur, day)
+    points = 86400 // args.interval
+    copy_tracks(cur, *simulate_tracks(truck_ids, points, args.interval, end - timedelta(seconds=args.interval),
+                                      np.random.default_rng(0)))
+    conn.commit()
+    cur.execute('ANALYZE ' + partition_name(day))
+    cur.execute('SELECT pg_total_relation_size(%s), (SELECT count(*) FROM ' + partition_name(day) + ')',
+                (partition_name(day),))
+    table_bytes, rows = cur.fetchone()
+    conn.commit()
+
+    try:
+        sql = timed('sql', lambda truck_id: sql_day(cur, int(truck_id), start, end), truck_ids, args.rounds)
+        conn.commit()
+        started = time.perf_counter()
+        archive.archive_day(conn, 'gps_locations', day)
+        print('archived %d rows in %.2fs' % (rows, time.perf_counter() - started))
+        cur.execute('SELECT bytes FROM archive_segments WHERE table_name = %s AND day = %s', ('gps_locations', day))
+        segment_bytes = cur.fetchone()[0]
+        conn.commit()
+        archive.invalidate()
+        mapped = timed('archive', lambda truck_id: archive.read_points(cur, int(truck_id), start, end),
+                       truck_ids, args.rounds)
+        print('speedup  %.1fx per point' % (sql / mapped))
+        print('storage  %.1f bytes/point in Postgres (table and indexes), %.1f in the segment' % (
+            table_bytes / rows, segment_bytes / rows))
+    finally:
+        conn.rollback()
+        cur.execute('DELETE FROM archive_segments WHERE table_name = %s AND day = %s', ('gps_locations', day))
+        cur.execute('DROP TABLE IF EXISTS ' + partition_name(day))
+        conn.commit()
+        conn.close()
+        shutil.rmtree(archive.ARCHIVE_DIR)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import events
+import page_cache
+from app import app
+
+ROUTES = ['/dashboard', '/truck/1']
+
+
+def measure(client, route, requests, headers=None):
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = client.get(route, headers=headers)
+        timings.append(time.perf_counter() - started)
+    return response, statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare full renders, fragment-cached renders and 304 revalidation.')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--username', default='john_doe')
+    parser.add_argument('--password', default='password123')
+    args = parser.parse_args()
+
+    client = app.test_client()
+    client.post('/login', data={'username': args.username, 'password': args.password})
+    listener = events.get_listener()
+    while not listener.connected:
+        time.sleep(0.05)
+
+    print('%-16s %14s %14s %14s' % ('route', 'no cache ms', 'fragments ms', '304 ms'))
+    for route in ROUTES:
+        page_cache.CONDITIONAL_GET = False
+        _, plain = measure(client, route, args.requests)
+        page_cache.CONDITIONAL_GET = True
+        response, cached = measure(client, route, args.requests)
+        etag = response.headers['ETag']
+        response, revalidated = measure(client, route, args.requests, {'If-None-Match': etag})
+        assert response.status_code == 304, response.status_code
+        print('%-16s %14.3f %14.3f %14.3f' % (route, plain, cached, revalidated))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from analytics import haversine
+from dispatch import OwnerGrid
+
+# Places one owner's trucks around metro areas of the continental US (plus a share
+# spread uniformly) and answers pickup queries three ways: a per-truck Python
+# haversine loop over every last-known position, a vectorized NumPy scan of all of
+# them, and the dispatch grid. Every grid answer is checked against the NumPy scan.
+
+BOX = (25.0, -124.0, 49.0, -67.0)
+
+
+def fleet(count, metros, rng):
+    centers = np.column_stack((rng.uniform(BOX[0] + 2, BOX[2] - 2, metros), rng.uniform(BOX[1] + 2, BOX[3] - 2, metros)))
+    weights = rng.pareto(1.2, metros) + 1
+    weights /= weights.sum()
+    spread = count // 5
+    home = rng.choice(metros, count - spread, p=weights)
+    lat = np.concatenate((centers[home, 0] + rng.normal(0, 0.25, len(home)), rng.uniform(BOX[0], BOX[2], spread)))
+    lon = np.concatenate((centers[home, 1] + rng.normal(0, 0.3, len(home)), rng.uniform(BOX[1], BOX[3], spread)))
+    return lat, lon
+
+
+def python_scan(lat, lon, qlat, qlon, k, radius_m):
+    found = []
+    for truck_id, (a, b) in enumerate(zip(lat, lon)):
+        p1, p2 = math.radians(qlat), math.radians(a)
+        h = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(b - qlon) / 2) ** 2
+        distance = 2 * 6371008.8 * math.asin(math.sqrt(h))
+        if radius_m is None or distance <= radius_m:
+            found.append((distance, truck_id))
+    found.sort()
+    return [(truck_id, distance) for distance, truck_id in found[:k]]
+
+
+def numpy_scan(lat, lon, qlat, qlon, k, radius_m):
+    distance = haversine(qlat, qlon, lat, lon)
+    ids = np.arange(len(lat)) if radius_m is None else np.flatnonzero(distance <= radius_m)
+    if len(ids) > k:
+        ids = ids[np.argpartition(distance[ids], k - 1)[:k]]
+    ids = ids[np.lexsort((ids, distance[ids]))]
+    return list(zip(ids.tolist(), distance[ids].tolist()))
+
+
+def timed(label, answer, queries, baseline=None):
+    latencies = []
+    results = []
+    for qlat, qlon, k, radius_m in queries:
+        started = time.perf_counter()
+        results.append(answer(qlat, qlon, k, radius_m))
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    mean = sum(latencies) / len(latencies)
+    print('  %-8s mean %8.3f ms  p50 %8.3f ms  p99 %8.3f ms%s' % (
+        label, mean * 1000, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000,
+        '' if baseline is None else '  %6.0fx faster than numpy' % (baseline / mean)))
+    return mean, results
+
+
+def same(expected, actual):
+    return [truck_id for truck_id, _ in expected] == [truck_id for truck_id, _ in actual] and \
+        np.allclose([d for _, d in expected], [d for _, d in actual])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare nearest-truck queries on the dispatch grid with full scans.')
+    parser.add_argument('--trucks', type=int, default=100000)
+    parser.add_argument('--metros', type=int, default=60)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--radius-km', type=float, default=25.0)
+    parser.add_argument('--python-queries', type=int, default=20, help='Queries also answered by the Python loop')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    lat, lon = fleet(args.trucks, args.metros, rng)
+    started = time.perf_counter()
+    grid = OwnerGrid()
+    for truck_id, (a, b) in enumerate(zip(lat.tolist(), lon.tolist())):
+        grid.put(truck_id, a, b, None, None)
+    print('%d trucks in %d occupied cells, built in %.2fs' % (args.trucks, len(grid.cells), time.perf_counter() - started))
+
+    # Pickups near trucks, so queries land where the fleet is dense as well as sparse.
+    picks = rng.integers(0, args.trucks, args.queries)
+    qlat = np.clip(lat[picks] + rng.normal(0, 0.05, args.queries), -89, 89).tolist()
+    qlon = (lon[picks] + rng.normal(0, 0.05, args.queries)).tolist()
+    radius_m = args.radius_km * 1000
+    for label, k, radius in (('%d nearest' % args.k, args.k, None),
+                             ('within %g km' % args.radius_km, 500, radius_m),
+                             ('%d nearest within %g km' % (args.k, args.radius_km), args.k, radius_m)):
+        queries = [(a, b, k, radius) for a, b in zip(qlat, qlon)]
+        print(label)
+        if args.python_queries:
+            timed('python', lambda a, b, k, r: python_scan(lat, lon, a, b, k, r), queries[:args.python_queries])
+        baseline, expected = timed('numpy', lambda a, b, k, r: numpy_scan(lat, lon, a, b, k, r), queries)
+        _, actual = timed('grid', grid.nearest, queries, baseline)
+        mismatches = sum(not same(e, a) for e, a in zip(expected, actual))
+        print('  %d of %d answers differ from the full scan' % (mismatches, len(queries)))
+
+    # Position updates: every truck moves a little, as one notification each.
+    moved_lat = lat + rng.normal(0, 0.01, args.trucks)
+    moved_lon = lon + rng.normal(0, 0.01, args.trucks)
+    started = time.perf_counter()
+    for truck_id, (a, b) in enumerate(zip(moved_lat.tolist(), moved_lon.tolist())):
+        grid.put(truck_id, a, b, None, None)
+    elapsed = time.perf_counter() - started
+    print('updates  %.0f positions/s (%.2f us each)' % (args.trucks / elapsed, elapsed / args.trucks * 1e6))
+    expected = numpy_scan(moved_lat, moved_lon, qlat[0], qlon[0], args.k, None)
+    print('after updates the grid %s the full scan' % ('matches' if same(expected, grid.nearest(qlat[0], qlon[0], args.k)) else 'DIFFERS FROM'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from face_match import EMBEDDING_DIM, MATCH_THRESHOLD, FaceIndex, classify, normalize
+
+
+def synthetic_detections(embeddings, truck_ids, count, impostor_rate, rng):
+    # Mostly noisy captures of a truck's own drivers, plus a share of faces that are
+    # either drivers of other trucks or nobody enrolled at all.
+    picks = rng.integers(0, len(embeddings), count)
+    queries = embeddings[picks] + rng.normal(scale=0.04, size=(count, EMBEDDING_DIM)).astype(np.float32)
+    trucks = truck_ids[picks].copy()
+    impostors = np.flatnonzero(rng.random(count) < impostor_rate)
+    half = len(impostors) // 2
+    trucks[impostors[:half]] = rng.choice(truck_ids, half)
+    queries[impostors[half:]] = rng.normal(size=(len(impostors) - half, EMBEDDING_DIM))
+    return trucks, normalize(queries)
+
+
+def naive_classify(embeddings, driver_ids, truck_ids, trucks, queries, threshold):
+    # One detection at a time: a Python loop over the truck's drivers, then a full
+    # fleet scan for anything unmatched.
+    results = []
+    for truck_id, query in zip(trucks.tolist(), queries):
+        own = np.flatnonzero(truck_ids == truck_id)
+        scores = embeddings[own] @ query
+        if len(own) and scores.max() >= threshold:
+            results.append(int(driver_ids[own[scores.argmax()]]))
+            continue
+        scores = embeddings @ query
+        results.append(int(driver_ids[scores.argmax()]) if scores.max() >= threshold else None)
+    return results
+
+
+def timed(label, fn, count):
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    print('%-32s %8.3fs  %12.0f detections/s' % (label, elapsed, count / elapsed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batched face matching against a per-detection scan.')
+    parser.add_argument('--drivers', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--drivers-per-truck', type=int, default=4)
+    parser.add_argument('--detections', type=int, default=5000)
+    parser.add_argument('--impostor-rate', type=float, default=0.05)
+    parser.add_argument('--naive-detections', type=int, default=500)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(5)
+    for count in args.drivers:
+        embeddings = normalize(rng.normal(size=(count, EMBEDDING_DIM)))
+        driver_ids = np.arange(1, count + 1)
+        truck_ids = driver_ids // args.drivers_per_truck + 1
+        started = time.perf_counter()
+        index = FaceIndex(driver_ids, truck_ids, embeddings)
+        print('%d drivers, %d-dim embeddings, %d detections per batch (index built in %.3fs, %.0f MB)' % (
+            count, EMBEDDING_DIM, args.detections, time.perf_counter() - started, index.matrix.nbytes / 2 ** 20))
+
+        trucks, queries = synthetic_detections(embeddings, truck_ids, args.detections, args.impostor_rate, rng)
+        results = timed('batched index', lambda: classify(index, trucks.tolist(), queries), args.detections)
+        n = min(args.naive_detections, args.detections)
+        expected = timed('per-detection scan (%d)' % n, lambda: naive_classify(
+            embeddings, driver_ids, truck_ids, trucks[:n], queries[:n], MATCH_THRESHOLD), n)
+        print('  identical matches: %s' % ([r[1] for r in results[:n]] == expected))
+        print('  outcomes: %s' % {kind: sum(r[0] == kind for r in results) for kind in sorted({r[0] for r in results})})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from geofence import Fence, FenceIndex
+
+
+def synthetic_fences(count, owners, rng):
+    # Depots (circles) and zones (small polygons) scattered over a 10 x 10 degree region,
+    # plus a handful of long corridors that land in the index's large-fence list.
+    fences = []
+    for i in range(count):
+        lat, lon = rng.uniform(35, 45), rng.uniform(-105, -95)
+        owner = i % owners
+        if i % 200 == 0:
+            coords = [[lat, lon], [lat + 0.02, lon], [lat + 3.02, lon + 6], [lat + 3, lon + 6]]
+            fences.append(Fence(i, owner, None, 'corridor %d' % i, 'polygon', coords))
+        elif i % 2:
+            fences.append(Fence(i, owner, None, 'depot %d' % i, 'circle', [[lat, lon]], rng.uniform(200, 2000)))
+        else:
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 8))
+            radius = rng.uniform(0.005, 0.03)
+            coords = np.column_stack((lat + radius * np.sin(angles), lon + radius * np.cos(angles)))
+            fences.append(Fence(i, owner, None, 'zone %d' % i, 'polygon', coords))
+    return fences
+
+
+def naive_match(fences, truck_ids, lat, lon, owners):
+    point_owners = np.array([owners[t] for t in truck_ids])
+    inside = {}
+    for fence in fences:
+        hits = np.flatnonzero((point_owners == fence.owner_id) & fence.contains(lat, lon))
+        if len(hits):
+            inside[fence.id] = set(hits.tolist())
+    return inside
+
+
+def timed(label, fn, points):
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    print('%-32s %8.3fs  %12.0f points/s' % (label, elapsed, points / elapsed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the geofence grid index against an all-fences scan.')
+    parser.add_argument('--fences', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--points', type=int, default=5000)
+    parser.add_argument('--trucks', type=int, default=2000)
+    parser.add_argument('--owners', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(3)
+    truck_ids = rng.integers(1, args.trucks + 1, args.points).tolist()
+    owners = {t: t % args.owners for t in range(1, args.trucks + 1)}
+    lat = rng.uniform(35, 45, args.points)
+    lon = rng.uniform(-105, -95, args.points)
+
+    for count in args.fences:
+        print('%d fences, %d points per batch' % (count, args.points))
+        fences = synthetic_fences(count, args.owners, rng)
+        started = time.perf_counter()
+        index = FenceIndex(fences)
+        print('  built index in %.3fs: %d cells, %d large fences' % (
+            time.perf_counter() - started, len(index.cells), len(index.large)))
+        actual = timed('grid index match', lambda: index.match(truck_ids, lat, lon, owners), args.points)
+        expected = timed('naive all-fences scan', lambda: naive_match(fences, truck_ids, lat, lon, owners), args.points)
+        print('  identical output: %s' % (actual == expected))
+
+
+if __name__ == '__main__':
+    main()
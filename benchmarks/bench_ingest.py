@@ -0,0 +1,76 @@
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+
+from ingest import iter_jsonl, copy_gps_points
+
+
+def make_points(truck_ids, count):
+    start = datetime(2024, 1, 1)
+    return [
+        (random.choice(truck_ids), random.uniform(25, 48), random.uniform(-124, -67), start + timedelta(seconds=i))
+        for i in range(count)
+    ]
+
+
+def row_at_a_time(cur, points):
+    for truck_id, lat, lon, ts in points:
+        cur.execute(
+            'INSERT INTO gps_locations (truck_id, latitude, longitude, timestamp) VALUES (%s, %s, %s, %s)',
+            (truck_id, lat, lon, ts)
+        )
+
+
+def copy_from_jsonl(cur, points):
+    body = '\n'.join(
+        json.dumps({'truck_id': t, 'latitude': lat, 'longitude': lon, 'timestamp': ts.isoformat()})
+        for t, lat, lon, ts in points
+    )
+    copy_gps_points(cur, iter_jsonl(io.StringIO(body)))
+
+
+def timed(conn, fn, points):
+    cur = conn.cursor()
+    started = time.perf_counter()
+    fn(cur, points)
+    elapsed = time.perf_counter() - started
+    conn.rollback()
+    cur.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-row INSERT with batched COPY ingestion.')
+    parser.add_argument('--points', type=int, default=50000)
+    parser.add_argument('--baseline-points', type=int, default=5000)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    cur.execute('SELECT id FROM trucks')
+    truck_ids = [row[0] for row in cur.fetchall()]
+    cur.close()
+    if not truck_ids:
+        sys.exit('no trucks in database; seed it first')
+
+    baseline = make_points(truck_ids, args.baseline_points)
+    batch = make_points(truck_ids, args.points)
+
+    elapsed = timed(conn, row_at_a_time, baseline)
+    print('row-at-a-time INSERT: %8d points in %7.3fs  %10.0f points/s' % (len(baseline), elapsed, len(baseline) / elapsed))
+    elapsed = timed(conn, copy_from_jsonl, batch)
+    print('JSON lines + COPY:    %8d points in %7.3fs  %10.0f points/s' % (len(batch), elapsed, len(batch) / elapsed))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Dashboard traffic from signed-in owners, first alone and then during a login storm
+# (every generated owner signing in, over and over), once with passwords hashed in
+# the request threads and once in the worker pool. Reports dashboard latency and
+# what happened to the logins.
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class Dashboards(threading.Thread):
+    def __init__(self, app, username, password, deadline):
+        super().__init__(daemon=True)
+        self.client = app.test_client()
+        self.client.post('/login', data={'username': username, 'password': password})
+        self.deadline = deadline
+        self.timings = []
+
+    def run(self):
+        while time.perf_counter() < self.deadline:
+            started = time.perf_counter()
+            response = self.client.get('/dashboard')
+            if response.status_code == 200:
+                self.timings.append(time.perf_counter() - started)
+
+
+class Logins(threading.Thread):
+    def __init__(self, app, usernames, password, deadline):
+        super().__init__(daemon=True)
+        self.app = app
+        self.usernames = usernames
+        self.password = password
+        self.deadline = deadline
+        self.timings = []
+        self.statuses = defaultdict(int)
+
+    def run(self):
+        i = 0
+        while time.perf_counter() < self.deadline:
+            client = self.app.test_client()
+            started = time.perf_counter()
+            response = client.post('/login', data={'username': self.usernames[i % len(self.usernames)],
+                                                   'password': self.password})
+            self.statuses[response.status_code] += 1
+            if response.status_code == 302:
+                self.timings.append(time.perf_counter() - started)
+            else:
+                # Refused logins back off like a browser honouring Retry-After.
+                time.sleep(min(float(response.headers.get('Retry-After', 1)), 1.0))
+            i += 1
+
+
+def run_phase(app, owners, password, dashboards, logins, duration):
+    deadline = time.perf_counter() + duration
+    readers = [Dashboards(app, owners[i % len(owners)], password, deadline) for i in range(dashboards)]
+    storm = [Logins(app, owners[i::logins], password, deadline) for i in range(logins)]
+    for thread in readers + storm:
+        thread.start()
+    for thread in readers + storm:
+        thread.join()
+    timings = sorted(t for reader in readers for t in reader.timings)
+    line = 'dashboard %6.1f req/s  p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms' % (
+        len(timings) / duration, percentile(timings, 0.5) * 1000, percentile(timings, 0.95) * 1000,
+        percentile(timings, 0.99) * 1000)
+    if storm:
+        login_timings = sorted(t for thread in storm for t in thread.timings)
+        statuses = defaultdict(int)
+        for thread in storm:
+            for status, count in thread.statuses.items():
+                statuses[status] += count
+        line += '\n    logins %6.1f/s  p50 %7.1f ms  p99 %7.1f ms  refused %d (429) %d (503)' % (
+            len(login_timings) / duration, percentile(login_timings, 0.5) * 1000,
+            percentile(login_timings, 0.99) * 1000, statuses[429], statuses[503])
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure dashboard latency during a login storm.')
+    parser.add_argument('--dashboards', type=int, default=4, help='Threads requesting the dashboard')
+    parser.add_argument('--logins', type=int, default=16, help='Threads logging in')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per phase')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2], help='PASSWORD_WORKERS values to compare')
+    parser.add_argument('--password', default='password123')
+    args = parser.parse_args()
+
+    import psycopg2
+
+    import passwords
+    from app import app
+    from models import init_db
+
+    init_db()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    cur.execute("SELECT username FROM users WHERE username LIKE 'fleet%%' ORDER BY id")
+    owners = [row[0] for row in cur.fetchall()]
+    conn.close()
+    if not owners:
+        raise SystemExit('No generated owners found; run flask generate-fleet first')
+    # The storm logs every owner in repeatedly from one address; only the queue limit
+    # should refuse them.
+    passwords.login_attempts.limit = passwords.address_attempts.limit = 1 << 30
+
+    for workers in args.workers:
+        passwords.PASSWORD_WORKERS = workers
+        label = 'in request threads' if workers <= 0 else 'in %d worker processes' % workers
+        print('hashing %s' % label)
+        print('  quiet   ' + run_phase(app, owners, args.password, args.dashboards, 0, args.duration))
+        print('  storm   ' + run_phase(app, owners, args.password, args.dashboards, args.logins, args.duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+from app import app, finish_request_profiling, start_request_profiling
+from db_pool import ConnectionPool
+from profiling import ProfiledConnection
+
+ROUTES = ['/truck/1', '/truck/1/alerts', '/truck/1/locations?limit=100', '/dashboard']
+
+
+def configure(profiled):
+    # Swap the pool and the request hooks so both variants run in one process.
+    if models._pool is not None:
+        models._pool.closeall()
+    models._pool = ConnectionPool(os.environ['DATABASE_URL'], minconn=1, maxconn=2,
+                                  connection_factory=ProfiledConnection if profiled else None)
+    models._pool_pid = os.getpid()
+    before = app.before_request_funcs.setdefault(None, [])
+    after = app.after_request_funcs.setdefault(None, [])
+    for funcs, hook in ((before, start_request_profiling), (after, finish_request_profiling)):
+        if hook in funcs:
+            funcs.remove(hook)
+        if profiled:
+            funcs.insert(0, hook)
+
+
+def run_round(client, route, requests):
+    started = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(route)
+        assert response.status_code == 200, (route, response.status_code)
+    return (time.perf_counter() - started) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the per-request cost of query profiling and metrics.')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=7)
+    parser.add_argument('--username', default='john_doe')
+    parser.add_argument('--password', default='password123')
+    args = parser.parse_args()
+
+    client = app.test_client()
+    client.post('/login', data={'username': args.username, 'password': args.password})
+
+    print('%-32s %12s %12s %9s' % ('route', 'plain ms', 'profiled ms', 'overhead'))
+    for route in ROUTES:
+        timings = {False: [], True: []}
+        for _ in range(args.rounds):
+            # Alternate variants so drift (caches, autovacuum) hits both equally.
+            for profiled in (False, True):
+                configure(profiled)
+                run_round(client, route, 10)
+                timings[profiled].append(run_round(client, route, args.requests))
+        plain = statistics.median(timings[False]) * 1000
+        profiled = statistics.median(timings[True]) * 1000
+        print('%-32s %12.3f %12.3f %8.1f%%' % (route, plain, profiled, (profiled / plain - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
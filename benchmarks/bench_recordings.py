@@ -0,0 +1,284 @@
+import argparse
+import hashlib
+import http.client
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+
+from gateway import issue_device_tokens
+
+# Starts the app in its own process (the Flask server, or gunicorn with --gunicorn),
+# has trucks upload recordings in resumable chunks, cutting every upload once in the
+# middle of a chunk, then downloads them whole and as random 1 MiB ranges while the
+# server's resident memory is sampled. Every recording is checked byte for byte.
+
+
+class Slice:
+    # A file-like window on the source file, so http.client streams chunk bodies
+    # without the client holding them in memory either.
+    def __init__(self, f, start, length):
+        self.f = f
+        self.pos = start
+        self.left = length
+
+    def read(self, size=-1):
+        if self.left <= 0:
+            return b''
+        size = self.left if size < 0 else min(size, self.left)
+        data = os.pread(self.f.fileno(), size, self.pos)
+        self.pos += len(data)
+        self.left -= len(data)
+        return data
+
+
+def server_memory(pid):
+    # Resident and peak resident kB of the server and its worker processes.
+    pids = [pid]
+    try:
+        pids += [int(p) for p in open('/proc/%d/task/%d/children' % (pid, pid)).read().split()]
+    except OSError:
+        pass
+    rss = peak = 0
+    for p in pids:
+        try:
+            status = open('/proc/%d/status' % p).read()
+        except OSError:
+            continue
+        # Exited (zombie) processes have no memory lines.
+        for match in re.finditer(r'Vm(RSS|HWM):\s+(\d+)', status):
+            if match.group(1) == 'RSS':
+                rss += int(match.group(2))
+            else:
+                peak += int(match.group(2))
+    return rss, peak
+
+
+class Sampler(threading.Thread):
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.05):
+            self.peak_rss = max(self.peak_rss, server_memory(self.pid)[0])
+
+
+def connect(port):
+    return http.client.HTTPConnection('127.0.0.1', port, timeout=60, blocksize=256 * 1024)
+
+
+def resume_offset(port, url, auth):
+    time.sleep(0.1)
+    conn = connect(port)
+    conn.request('HEAD', url, headers=auth)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return int(response.getheader('Upload-Offset'))
+
+
+def upload(port, truck_id, token, source, size, chunk, cut_at, result):
+    auth = {'Authorization': 'Bearer ' + token}
+    conn = connect(port)
+    conn.request('POST', '/api/truck/%d/recordings' % truck_id, body='{"camera_number": 1}',
+                 headers=dict(auth, **{'Content-Type': 'application/json'}))
+    response = conn.getresponse()
+    url = re.search(r'"upload_url":\s*"([^"]+)"', response.read().decode()).group(1)
+    result['recording_id'] = int(url.rstrip('/upload').rsplit('/', 1)[1])
+    offset, cut = 0, False
+    while offset < size:
+        length = min(chunk, size - offset)
+        if not cut and offset <= cut_at < offset + length:
+            # Send half of this chunk and drop the connection, like a truck losing signal.
+            cut = True
+            raw = connect(port)
+            raw.putrequest('PATCH', url)
+            for name, value in dict(auth, **{'Upload-Offset': str(offset), 'Content-Length': str(length)}).items():
+                raw.putheader(name, value)
+            raw.endheaders()
+            raw.send(Slice(source, offset, length // 2).read())
+            raw.sock.close()
+            offset = resume_offset(port, url, auth)
+            result['resumed_at'] = offset
+            continue
+        try:
+            conn.request('PATCH', url, body=Slice(source, offset, length),
+                         headers=dict(auth, **{'Upload-Offset': str(offset), 'Content-Length': str(length)}))
+            response = conn.getresponse()
+            response.read()
+        except (BrokenPipeError, ConnectionResetError):
+            # The server answered before reading the body (409 while the cut request
+            # still holds the recording) and closed the connection.
+            conn.close()
+            conn = connect(port)
+            offset = resume_offset(port, url, auth)
+            continue
+        if response.status == 409:
+            time.sleep(0.1)
+            offset = int(response.getheader('Upload-Offset'))
+            continue
+        if response.status != 204:
+            raise SystemExit('upload failed with %d' % response.status)
+        offset = int(response.getheader('Upload-Offset'))
+    conn.close()
+
+
+def download(port, cookie, url, size, digest, deadline, ranges, stats):
+    conn = connect(port)
+    rng = random.Random(url)
+    hasher = hashlib.sha256()
+    conn.request('GET', url, headers={'Cookie': cookie})
+    response = conn.getresponse()
+    while True:
+        data = response.read(256 * 1024)
+        if not data:
+            break
+        hasher.update(data)
+        stats['bytes'] += len(data)
+    if hasher.hexdigest() != digest:
+        stats['corrupt'] += 1
+    while time.perf_counter() < deadline:
+        start = rng.randrange(0, size - (1 << 20))
+        started = time.perf_counter()
+        conn.request('GET', url, headers={'Cookie': cookie, 'Range': 'bytes=%d-%d' % (start, start + (1 << 20) - 1)})
+        response = conn.getresponse()
+        data = response.read()
+        ranges.append(time.perf_counter() - started)
+        stats['bytes'] += len(data)
+        if response.status != 206 or len(data) != 1 << 20:
+            stats['corrupt'] += 1
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent recording uploads and range downloads against server memory.')
+    parser.add_argument('--uploads', type=int, default=8, help='Trucks uploading at once')
+    parser.add_argument('--size-mb', type=int, default=128, help='Size of each recording')
+    parser.add_argument('--chunk-mb', type=int, default=16, help='Bytes per PATCH request')
+    parser.add_argument('--downloads', type=int, default=16, help='Concurrent viewers')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of range requests')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--gunicorn', action='store_true', help='Serve with gunicorn (sendfile) instead of the Flask server')
+    args = parser.parse_args()
+
+    size, chunk = args.size_mb << 20, args.chunk_mb << 20
+    recordings_dir = tempfile.mkdtemp(prefix='fleet-recordings-')
+    env = dict(os.environ, RECORDINGS_DIR=recordings_dir)
+    if args.gunicorn:
+        command = [sys.executable, '-m', 'gunicorn', '-k', 'gthread', '--threads', '32', '-b', '127.0.0.1:%d' % args.port,
+                   '--log-level', 'warning', 'app:app']
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(args.port), '--with-threads',
+                   '--no-reload', '--no-debugger']
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT u.username, array_agg(t.id ORDER BY t.id) FROM users u JOIN trucks t ON t.owner_id = u.id
+        GROUP BY u.id HAVING count(*) >= %s ORDER BY u.id LIMIT 1
+    ''', (args.uploads,))
+    username, truck_ids = cur.fetchone()
+    truck_ids = truck_ids[:args.uploads]
+    tokens = issue_device_tokens(cur, truck_ids)
+    conn.commit()
+
+    source = tempfile.TemporaryFile()
+    block = os.urandom(1 << 20)
+    for i in range(args.size_mb):
+        source.write(hashlib.sha256(b'%d' % i).digest() + block[32:])
+    source.flush()
+    source.seek(0)
+    digest = hashlib.sha256(source.read()).hexdigest()
+
+    try:
+        for _ in range(100):
+            try:
+                probe = connect(args.port)
+                probe.request('GET', '/login')
+                probe.getresponse().read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        idle_rss = server_memory(server.pid)[0]
+        sampler = Sampler(server.pid)
+        sampler.start()
+
+        results = [{} for _ in truck_ids]
+        threads = [threading.Thread(target=upload, args=(args.port, truck_id, tokens[truck_id], source, size, chunk,
+                                                         random.randrange(size), result))
+                   for truck_id, result in zip(truck_ids, results)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        upload_peak = sampler.peak_rss
+        total = size * len(truck_ids)
+        print('uploads   %d x %d MiB in %.1fs: %.0f MiB/s, every upload cut once and resumed' % (
+            len(truck_ids), args.size_mb, elapsed, total / elapsed / (1 << 20), ))
+
+        login = connect(args.port)
+        login.request('POST', '/login', body='username=%s&password=password123' % username,
+                      headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        response = login.getresponse()
+        response.read()
+        cookie = response.getheader('Set-Cookie').split(';')[0]
+        for truck_id, result in zip(truck_ids, results):
+            login.request('POST', '/truck/%d/recording/%d/stop' % (truck_id, result['recording_id']),
+                          headers={'Cookie': cookie})
+            response = login.getresponse()
+            stopped = response.read().decode()
+            if '"file_size":%d' % size not in stopped.replace(' ', ''):
+                raise SystemExit('stop reported %s' % stopped)
+
+        sampler.peak_rss = 0
+        ranges, stats = [], {'bytes': 0, 'corrupt': 0}
+        deadline = time.perf_counter() + args.duration
+        threads = [threading.Thread(target=download, args=(
+            args.port, cookie, '/truck/%d/recording/%d/video' % (truck_ids[i % len(truck_ids)],
+                                                                 results[i % len(truck_ids)]['recording_id']),
+            size, digest, deadline, ranges, stats)) for i in range(args.downloads)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        ranges.sort()
+        print('downloads %d viewers, %d full files and %d range requests in %.1fs: %.0f MiB/s, range p50 %.1f ms p99 %.1f ms' % (
+            args.downloads, args.downloads, len(ranges), elapsed, stats['bytes'] / elapsed / (1 << 20),
+            ranges[len(ranges) // 2] * 1000, ranges[int(len(ranges) * 0.99)] * 1000))
+        print('server    RSS idle %.0f MiB, peak %.0f MiB while uploading %d MiB, %.0f MiB while serving %d MiB' % (
+            idle_rss / 1024, upload_peak / 1024, total >> 20, sampler.peak_rss / 1024, stats['bytes'] >> 20))
+        print('checks    %d corrupt responses; uploads resumed at %s' % (
+            stats['corrupt'], ', '.join('%d MiB' % (result['resumed_at'] >> 20) for result in results)))
+        sampler.stopped.set()
+
+        # gunicorn has long since closed the idle keep-alive connection.
+        login = connect(args.port)
+        for truck_id, result in zip(truck_ids, results):
+            login.request('POST', '/truck/%d/recording/%d/delete' % (truck_id, result['recording_id']),
+                          headers={'Cookie': cookie})
+            login.getresponse().read()
+    finally:
+        server.terminate()
+        server.wait()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
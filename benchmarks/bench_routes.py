@@ -0,0 +1,189 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Drives the Flask routes in-process (test clients, no sockets) from a pool of worker
+# threads, each logged in as one generated fleet owner, and reports throughput and
+# latency percentiles per route. Without DATABASE_URL an embedded Postgres is started
+# through the optional pgserver package and filled by the fleet generator.
+
+
+def start_embedded_postgres(path):
+    try:
+        import pgserver
+    except ImportError:
+        raise SystemExit('Set DATABASE_URL, or pip install pgserver to run against an embedded Postgres')
+    server = pgserver.get_server(path)
+    return server, server.get_uri()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def load_owners(conn, limit):
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT u.username, array_agg(DISTINCT t.id),
+               array_agg(ARRAY[d.truck_id, d.id]) FILTER (WHERE d.id IS NOT NULL)
+        FROM users u
+        JOIN trucks t ON t.owner_id = u.id
+        LEFT JOIN drivers d ON d.truck_id = t.id
+        WHERE u.username LIKE 'fleet%%'
+        GROUP BY u.id
+        ORDER BY u.id DESC
+        LIMIT %s
+    ''', (limit,))
+    owners = cur.fetchall()
+    cur.close()
+    return owners
+
+
+class Worker(threading.Thread):
+    def __init__(self, app, owner, password, mix, deadline, conditional, seed):
+        super().__init__(daemon=True)
+        self.client = app.test_client()
+        self.username, self.trucks, drivers = owner
+        self.drivers = drivers or []
+        self.password = password
+        self.mix = mix
+        self.deadline = deadline
+        self.conditional = conditional
+        self.random = random.Random(seed)
+        self.etags = {}
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def request(self, name, method, url, **kwargs):
+        headers = {}
+        if self.conditional and method == 'GET' and url in self.etags:
+            headers['If-None-Match'] = self.etags[url]
+        started = time.perf_counter()
+        response = self.client.open(url, method=method, headers=headers, **kwargs)
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            self.errors[name] += 1
+        else:
+            self.timings[name].append(elapsed)
+        if response.headers.get('ETag'):
+            self.etags[url] = response.headers['ETag']
+        return response
+
+    def step(self, name):
+        truck_id = self.random.choice(self.trucks)
+        if name == 'dashboard':
+            self.request(name, 'GET', '/dashboard')
+        elif name == 'truck_detail':
+            self.request(name, 'GET', '/truck/%d' % truck_id)
+        elif name == 'truck_alerts':
+            self.request(name, 'GET', '/truck/%d/alerts' % truck_id)
+        elif name == 'truck_locations':
+            self.request(name, 'GET', '/truck/%d/locations?limit=100' % truck_id)
+        elif name == 'mark_alert_read':
+            page = self.client.get('/truck/%d/alerts?limit=5' % truck_id).get_json() or {}
+            unread = [item['id'] for item in page.get('items', ()) if not item['is_read']]
+            if unread:
+                self.request(name, 'POST', '/alert/%d/mark_read' % unread[0])
+        elif name == 'edit_driver' and self.drivers:
+            driver_truck, driver_id = self.random.choice(self.drivers)
+            self.request(name, 'POST', '/truck/%d/driver/%d/edit' % (driver_truck, driver_id), data={
+                'name': 'Driver %d' % driver_id, 'phone': '+1-555-%04d' % self.random.randrange(10000),
+                'license_number': 'DL-%07d' % driver_id})
+        elif name == 'start_recording':
+            self.request(name, 'POST', '/truck/%d/recording/start' % truck_id, data={'camera_number': 1})
+
+    def run(self):
+        self.client.post('/login', data={'username': self.username, 'password': self.password})
+        names, weights = zip(*self.mix.items())
+        while time.perf_counter() < self.deadline:
+            self.step(self.random.choices(names, weights)[0])
+
+
+MIX = {
+    'dashboard': 30,
+    'truck_detail': 30,
+    'truck_alerts': 15,
+    'truck_locations': 15,
+    'mark_alert_read': 4,
+    'edit_driver': 3,
+    'start_recording': 3,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the Flask routes against a generated fleet.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per concurrency level')
+    parser.add_argument('--conditional', action='store_true', help='Revalidate pages with If-None-Match like a browser')
+    parser.add_argument('--password', default='password123')
+    parser.add_argument('--generate', type=int, default=0, help='Generate a fleet of this many trucks first')
+    parser.add_argument('--hours', type=int, default=6, help='GPS history of generated trucks')
+    args = parser.parse_args()
+
+    server = None
+    if not os.getenv('DATABASE_URL'):
+        server, uri = start_embedded_postgres(tempfile.mkdtemp(prefix='fleet-bench-'))
+        os.environ['DATABASE_URL'] = uri
+        args.generate = args.generate or 1000
+
+    import psycopg2
+
+    import events
+    from app import app
+    from fleetgen import generate_fleet
+    from models import init_db
+
+    init_db()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    if args.generate:
+        summary = generate_fleet(conn, trucks=args.generate, hours=args.hours)
+        print('generated %d trucks, %d GPS points in %.1fs' % (summary['trucks'], summary['gps_points'], summary['seconds']))
+    owners = load_owners(conn, max(args.concurrency))
+    conn.close()
+    if not owners:
+        raise SystemExit('No generated owners found; run with --generate N or flask generate-fleet')
+
+    for concurrency in args.concurrency:
+        deadline = time.perf_counter() + args.duration
+        workers = [Worker(app, owners[i % len(owners)], args.password, MIX, deadline, args.conditional, i)
+                   for i in range(concurrency)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        timings, errors = defaultdict(list), defaultdict(int)
+        for worker in workers:
+            for name, values in worker.timings.items():
+                timings[name].extend(values)
+            for name, count in worker.errors.items():
+                errors[name] += count
+        total = sum(len(values) for values in timings.values())
+        print('\nconcurrency %d: %d requests in %.1fs, %.0f req/s' % (concurrency, total, elapsed, total / elapsed))
+        print('%-18s %8s %9s %9s %9s %9s %7s' % ('route', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+        for name in MIX:
+            values = sorted(timings[name])
+            print('%-18s %8d %9.1f %9.2f %9.2f %9.2f %7d' % (
+                name, len(values), len(values) / elapsed, percentile(values, 0.5) * 1000,
+                percentile(values, 0.95) * 1000, percentile(values, 0.99) * 1000, errors[name]))
+
+    if server is not None:
+        listener = events.get_listener()
+        listener.stop()
+        listener.join()
+        server.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from events import Broker, format_sse
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+
+def run(count, owners, rounds):
+    broker = Broker()
+    latencies = []
+    lock = threading.Lock()
+    ready = threading.Barrier(count + 1)
+    stop = threading.Event()
+
+    rss_before = rss_mb()
+    tracemalloc.start()
+    subscriptions = [broker.subscribe(['owner:%d' % (i % owners)]) for i in range(count)]
+    broker_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    def consume(subscription):
+        ready.wait()
+        while not stop.is_set():
+            for message in subscription.get(5.0):
+                sent = float(message.split(b'"sent": ', 1)[1].split(b'}', 1)[0])
+                with lock:
+                    latencies.append(time.perf_counter() - sent)
+
+    threads = [threading.Thread(target=consume, args=(s,), daemon=True) for s in subscriptions]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    rss_idle = rss_mb()
+
+    # Idle subscribers wake only on their own channel, so a burst costs O(matching subscribers).
+    for _ in range(rounds):
+        for owner in range(owners):
+            broker.publish('owner:%d' % owner, format_sse('position', {'truck_id': owner, 'sent': time.perf_counter()}))
+        time.sleep(0.05)
+    time.sleep(0.5)
+    stop.set()
+    for subscription in subscriptions:
+        subscription.event.set()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        'subscribers': count,
+        'delivered': len(latencies),
+        'broker_kb_per_subscriber': broker_bytes / 1024 / count,
+        'rss_growth_mb': rss_idle - rss_before,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure SSE broker memory and fan-out latency per subscriber count.')
+    parser.add_argument('--subscribers', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--owners', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    # Thread-per-subscriber stands in for gevent greenlets; a small stack keeps RSS honest.
+    threading.stack_size(256 * 1024)
+    print('%11s %10s %16s %14s %9s %9s' % ('subscribers', 'delivered', 'broker KB/sub', 'RSS MB (idle)', 'p50 ms', 'p99 ms'))
+    for count in args.subscribers:
+        r = run(count, args.owners, args.rounds)
+        print('%11d %10d %16.2f %14.1f %9.2f %9.2f' % (
+            r['subscribers'], r['delivered'], r['broker_kb_per_subscriber'], r['rss_growth_mb'], r['p50_ms'], r['p99_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from trajectory import encode_polyline, project, simplify, zoom_tolerance
+
+
+def synthetic_trip(count, seed=7):
+    # A truck heading roughly east at highway speed with GPS jitter, one fix per second.
+    rng = np.random.default_rng(seed)
+    heading = np.cumsum(rng.normal(0, 0.02, count))
+    step = 25.0 / 111_000
+    lat = 40.0 + np.cumsum(np.sin(heading) * step) + rng.normal(0, 2e-5, count)
+    lon = -100.0 + np.cumsum(np.cos(heading) * step) + rng.normal(0, 2e-5, count)
+    return lat, lon
+
+
+def pure_python_dp(xy, tolerance):
+    points = xy.tolist()
+    keep = [0, len(points) - 1]
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        (ax, ay), (bx, by) = points[start], points[end]
+        dx, dy = bx - ax, by - ay
+        denom = dx * dx + dy * dy
+        best, index = -1.0, None
+        for i in range(start + 1, end):
+            px, py = points[i]
+            t = 0.0 if denom == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / denom))
+            d = math.hypot(px - ax - t * dx, py - ay - t * dy)
+            if d > best:
+                best, index = d, i
+        if index is not None and best > tolerance:
+            keep.append(index)
+            stack.append((start, index))
+            stack.append((index, end))
+    return sorted(keep)
+
+
+def timed(label, fn, points):
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    print('%-42s %8.3fs  %12.0f points/s' % (label, elapsed, points / elapsed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark trajectory simplification and polyline encoding.')
+    parser.add_argument('--points', type=int, default=1_000_000)
+    parser.add_argument('--zoom', type=float, default=10)
+    parser.add_argument('--budget', type=int, default=2000)
+    parser.add_argument('--baseline-points', type=int, default=100_000)
+    args = parser.parse_args()
+
+    lat, lon = synthetic_trip(args.points)
+    tolerance = zoom_tolerance(args.zoom, float(lat.mean()))
+    print('%d points, zoom %.0f -> tolerance %.1f m' % (args.points, args.zoom, tolerance))
+
+    xy = timed('project', lambda: project(lat, lon), args.points)
+    keep = timed('Douglas-Peucker, zoom tolerance', lambda: simplify(xy, tolerance), args.points)
+    print('  kept %d points' % len(keep))
+    keep = timed('Douglas-Peucker, %d point budget' % args.budget, lambda: simplify(xy, 0.0, args.budget), args.points)
+    encoded = timed('encode polyline (kept points)', lambda: encode_polyline(lat[keep], lon[keep]), len(keep))
+    timed('encode polyline (all points)', lambda: encode_polyline(lat, lon), args.points)
+    print('  %d bytes polyline vs %d bytes JSON pairs' % (len(encoded), len(str(np.column_stack((lat[keep], lon[keep])).tolist()))))
+
+    n = min(args.baseline_points, args.points)
+    small = xy[:n]
+    expected = timed('pure-Python Douglas-Peucker (%d points)' % n, lambda: pure_python_dp(small, tolerance), n)
+    actual = timed('NumPy Douglas-Peucker (%d points)' % n, lambda: simplify(small, tolerance), n)
+    print('  identical output: %s' % (list(actual) == expected))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import psycopg2.extras
+
+from archive import face_detections_page, gps_page
+from pagination import FACE_DETECTIONS_PAGE_QUERY, LOCATIONS_PAGE_QUERY, RECORDINGS_PAGE_QUERY, keyset_page
+from truck_bundle import load_truck_bundle
+
+ROUND_TRIP = 0.0
+
+
+def _delayed(cursor_class):
+    # Every execute is one client/server round trip; sleeping before it stands in for
+    # the network latency to a remote database.
+    class Delayed(cursor_class):
+        def execute(self, query, vars=None):
+            time.sleep(ROUND_TRIP)
+            return super().execute(query, vars)
+    return Delayed
+
+
+DelayedCursor = _delayed(psycopg2.extensions.cursor)
+DelayedDictCursor = _delayed(psycopg2.extras.DictCursor)
+DelayedRealDictCursor = _delayed(psycopg2.extras.RealDictCursor)
+
+
+def six_query_detail(conn, truck_id, owner_id):
+    # The truck page as it used to load: six sequential queries on one DictCursor.
+    cur = conn.cursor(cursor_factory=DelayedDictCursor)
+    cur.execute('SELECT * FROM trucks WHERE id = %s AND owner_id = %s', (truck_id, owner_id))
+    truck = cur.fetchone()
+    cur.execute('SELECT * FROM drivers WHERE truck_id = %s', (truck_id,))
+    drivers = cur.fetchall()
+    cur.execute('SELECT * FROM gps_locations WHERE truck_id = %s ORDER BY timestamp DESC LIMIT 1', (truck_id,))
+    location = cur.fetchone()
+    cur.execute('SELECT * FROM gps_locations WHERE truck_id = %s ORDER BY timestamp DESC LIMIT 50', (truck_id,))
+    history = cur.fetchall()
+    cur.execute('''
+        SELECT fd.*, d.name as driver_name FROM face_detections fd
+        LEFT JOIN drivers d ON fd.driver_id = d.id
+        WHERE fd.truck_id = %s ORDER BY fd.detected_at DESC LIMIT 10
+    ''', (truck_id,))
+    detections = cur.fetchall()
+    cur.execute('SELECT * FROM video_recordings WHERE truck_id = %s ORDER BY recorded_at DESC', (truck_id,))
+    recordings = cur.fetchall()
+    cur.close()
+    return truck, drivers, location, history, detections, recordings
+
+
+def bundle_detail(conn, truck_id, owner_id):
+    # What the page itself renders from: the truck, its state and its drivers.
+    cur = conn.cursor(cursor_factory=DelayedCursor)
+    bundle = load_truck_bundle(cur, truck_id)
+    cur.close()
+    return bundle
+
+
+def bundle_with_panels(conn, truck_id, owner_id):
+    # The page plus the panel requests the browser makes once it has loaded, as the
+    # routes run them, for the data the six-query path also loaded (locations, face
+    # detections, recordings; the alerts panel is left out as the old page had none).
+    # The browser issues them in parallel; here they run back to back, so this is the
+    # total database time of the page, not its time to first render.
+    bundle = bundle_detail(conn, truck_id, owner_id)
+    cur = conn.cursor(cursor_factory=DelayedRealDictCursor)
+    panels = [
+        keyset_page(cur, LOCATIONS_PAGE_QUERY, 'timestamp', truck_id, archived=gps_page),
+        keyset_page(cur, FACE_DETECTIONS_PAGE_QUERY, 'detected_at', truck_id, archived=face_detections_page),
+        keyset_page(cur, RECORDINGS_PAGE_QUERY, 'recorded_at', truck_id),
+    ]
+    cur.close()
+    return bundle, panels
+
+
+def measure(fn, conn, truck_id, owner_id, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn(conn, truck_id, owner_id)
+        conn.rollback()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return statistics.median(timings) * 1000, timings[int(len(timings) * 0.99) - 1] * 1000
+
+
+def main():
+    global ROUND_TRIP
+    parser = argparse.ArgumentParser(description='Compare truck page data loading with injected database latency.')
+    parser.add_argument('--truck-id', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, nargs='+', default=[0, 1, 5, 20])
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    cur.execute('SELECT owner_id FROM trucks WHERE id = %s', (args.truck_id,))
+    owner_id = cur.fetchone()[0]
+    cur.close()
+
+    print('%10s %22s %22s %22s' % ('RTT ms', 'six queries p50/p99', 'bundle p50/p99', 'bundle+panels p50/p99'))
+    for latency in args.latency_ms:
+        ROUND_TRIP = latency / 1000
+        six = measure(six_query_detail, conn, args.truck_id, owner_id, args.iterations)
+        one = measure(bundle_detail, conn, args.truck_id, owner_id, args.iterations)
+        full = measure(bundle_with_panels, conn, args.truck_id, owner_id, args.iterations)
+        print('%10.1f %10.2f / %-9.2f %10.2f / %-9.2f %10.2f / %-9.2f' % (
+            latency, six[0], six[1], one[0], one[1], full[0], full[1]))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+
+from gateway import ACK, ERROR, SEQ_RECORD, WELCOME, Gateway, encode_event, encode_gps, encode_hello, issue_device_tokens, read_frame
+
+# Simulates trucks on flaky cellular links against the telemetry gateway. Every
+# device keeps its records until they are acked and resends them after reconnecting;
+# links are cut at random. With --crash-after the in-process gateway is killed
+# without storing its buffer and replaced by a new one. At the end the database must
+# hold every record exactly once.
+
+
+class Device:
+    def __init__(self, truck_id, token, args, tag, rng):
+        self.truck_id = truck_id
+        self.token = token
+        self.args = args
+        self.tag = tag
+        self.rng = rng
+        self.seq = 0
+        self.outbox = OrderedDict()
+        self.sent_at = {}
+        self.latencies = []
+        self.points = 0
+        self.events = 0
+        self.reconnects = 0
+        self.resent = 0
+        self.lat = rng.uniform(30, 47)
+        self.lon = rng.uniform(-120, -75)
+
+    def produce(self):
+        self.seq += 1
+        now_ms = int(time.time() * 1000)
+        if self.rng.random() < self.args.event_rate:
+            frame = encode_event(self.seq, now_ms, 'Simulated Event %s' % self.tag, 'harsh braking', 'low')
+            self.events += 1
+        else:
+            self.lat += self.rng.uniform(-0.001, 0.001)
+            self.lon += self.rng.uniform(-0.001, 0.001)
+            frame = encode_gps(self.seq, now_ms, self.lat, self.lon, self.rng.uniform(40, 110))
+            self.points += 1
+        self.outbox[self.seq] = frame
+        self.sent_at[self.seq] = time.perf_counter()
+        return frame
+
+    def acked(self, seq):
+        now = time.perf_counter()
+        while self.outbox and next(iter(self.outbox)) <= seq:
+            done, _ = self.outbox.popitem(last=False)
+            self.latencies.append(now - self.sent_at.pop(done))
+
+    async def read_acks(self, reader):
+        while True:
+            kind, body = await read_frame(reader)
+            if kind == ACK:
+                self.acked(SEQ_RECORD.unpack(body)[0])
+
+    async def session(self, address, deadline):
+        reader, writer = await asyncio.open_connection(*address)
+        try:
+            writer.write(encode_hello(self.truck_id, self.token))
+            kind, body = await read_frame(reader)
+            if kind == ERROR:
+                raise SystemExit('truck %d: %s' % (self.truck_id, body.decode()))
+            if kind != WELCOME:
+                raise ConnectionError('expected WELCOME')
+            self.acked(SEQ_RECORD.unpack(body)[0])
+            for frame in self.outbox.values():
+                writer.write(frame)
+                self.resent += 1
+            acks = asyncio.create_task(self.read_acks(reader))
+            try:
+                while time.perf_counter() < deadline:
+                    await asyncio.sleep(self.args.interval * self.rng.uniform(0.5, 1.5))
+                    if acks.done():
+                        acks.result()
+                    if self.rng.random() < self.args.drop_rate:
+                        writer.transport.abort()
+                        return
+                    writer.write(self.produce())
+                    await writer.drain()
+                # Stay connected until everything sent has been acked.
+                while self.outbox and not acks.done():
+                    await asyncio.sleep(0.05)
+                if acks.done():
+                    acks.result()
+            finally:
+                acks.cancel()
+        finally:
+            writer.close()
+
+    async def run(self, address, deadline, drain_deadline):
+        await asyncio.sleep(self.rng.uniform(0, self.args.interval))
+        while time.perf_counter() < deadline or (self.outbox and time.perf_counter() < drain_deadline):
+            try:
+                await self.session(address(), deadline)
+            except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                pass
+            if time.perf_counter() < deadline or self.outbox:
+                self.reconnects += 1
+                await asyncio.sleep(self.rng.uniform(0.2, 1.0))
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def simulate(args, devices):
+    gateway = None
+    port = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(':')
+        address = (host or '127.0.0.1', int(port))
+    else:
+        gateway = Gateway()
+        port = (await gateway.start('127.0.0.1', 0))[1]
+        address = ('127.0.0.1', port)
+    current = {'address': address}
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+    tasks = [asyncio.create_task(device.run(lambda: current['address'], deadline, deadline + args.drain_timeout))
+             for device in devices]
+    if gateway is not None and args.crash_after:
+        await asyncio.sleep(args.crash_after)
+        buffered = len(gateway._records)
+        await gateway.abort()
+        print('gateway crashed with %d records buffered; restarting' % buffered)
+        gateway = Gateway()
+        await gateway.start('127.0.0.1', port)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    if gateway is not None:
+        await gateway.stop()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate trucks streaming telemetry to the gateway.')
+    parser.add_argument('--trucks', type=int, default=2000)
+    parser.add_argument('--duration', type=float, default=20.0, help='Seconds of streaming')
+    parser.add_argument('--interval', type=float, default=1.0, help='Mean seconds between records per truck')
+    parser.add_argument('--event-rate', type=float, default=0.02, help='Share of records that are sensor events')
+    parser.add_argument('--drop-rate', type=float, default=0.01, help='Chance per record that the link is cut')
+    parser.add_argument('--crash-after', type=float, default=0.0, help='Kill the in-process gateway after this many seconds')
+    parser.add_argument('--drain-timeout', type=float, default=30.0)
+    parser.add_argument('--connect', help='host:port of a running gateway instead of an in-process one')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    cur.execute('SELECT id FROM trucks ORDER BY id LIMIT %s', (args.trucks,))
+    truck_ids = [row[0] for row in cur.fetchall()]
+    tokens = issue_device_tokens(cur, truck_ids)
+    cur.execute('SELECT COALESCE(max(id), 0) FROM gps_locations')
+    last_point_id = cur.fetchone()[0]
+    conn.commit()
+
+    rng = random.Random(args.seed)
+    # Unique per run, so events of earlier runs never fold into this run's alerts.
+    tag = os.urandom(4).hex()
+    devices = [Device(truck_id, tokens[truck_id], args, tag, random.Random(rng.random())) for truck_id in truck_ids]
+    elapsed = asyncio.run(simulate(args, devices))
+
+    points = sum(device.points for device in devices)
+    events = sum(device.events for device in devices)
+    latencies = sorted(latency for device in devices for latency in device.latencies)
+    unacked = sum(len(device.outbox) for device in devices)
+    print('%d trucks, %d records in %.1fs: %.0f records/s' % (len(devices), points + events, elapsed, (points + events) / elapsed))
+    print('reconnects %d, records resent %d, unacked at end %d' % (
+        sum(device.reconnects for device in devices), sum(device.resent for device in devices), unacked))
+    print('ack latency p50 %.0f ms, p95 %.0f ms, p99 %.0f ms' % (
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000, percentile(latencies, 0.99) * 1000))
+
+    cur.execute('SELECT count(*) FROM gps_locations WHERE truck_id = ANY(%s) AND id > %s', (truck_ids, last_point_id))
+    stored_points = cur.fetchone()[0]
+    cur.execute('SELECT COALESCE(sum(occurrences), 0) FROM alerts WHERE truck_id = ANY(%s) AND alert_type = %s',
+                (truck_ids, 'Simulated Event %s' % tag))
+    stored_events = cur.fetchone()[0]
+    conn.close()
+    print('stored %d of %d points and %d of %d events: %s' % (
+        stored_points, points, stored_events, events,
+        'exactly once' if (stored_points, stored_events) == (points, events) else 'MISMATCH'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+import itertools
+import math
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+import events
+from analytics import EARTH_RADIUS_M, haversine
+
+GRID_DEGREES = float(os.getenv('DISPATCH_GRID_DEGREES', '0.1'))
+MAX_RESULTS = int(os.getenv('DISPATCH_MAX_RESULTS', '500'))
+MAX_RADIUS_KM = 20000.0
+# Roughly how many trucks a vectorized distance scan measures in the time it takes
+# to look up one grid cell.
+SCAN_CELL_COST = 32
+
+POSITIONS_QUERY = '''
+    SELECT s.truck_id, t.owner_id, s.latitude::float8, s.longitude::float8, s.speed::float8, s.reported_at
+    FROM trucks t
+    JOIN truck_state s ON s.truck_id = t.id
+    WHERE s.latitude IS NOT NULL AND s.longitude IS NOT NULL
+'''
+OWNER_POSITIONS_QUERY = POSITIONS_QUERY + ' AND t.owner_id = %s'
+
+
+class DispatchError(ValueError):
+    pass
+
+
+class OwnerGrid:
+    # Last-known positions of one owner's trucks. Coordinates live in flat arrays
+    # indexed by slot, and a uniform lat/lon grid lists the slots in each cell, so a
+    # query measures the trucks of the cells around it instead of the whole fleet.
+    # Longitudes are not wrapped: cells across the antimeridian are not neighbours.
+    def __init__(self, cell_degrees=GRID_DEGREES, capacity=64):
+        self.cell_degrees = cell_degrees
+        self.lat = np.zeros(capacity)
+        self.lon = np.zeros(capacity)
+        self.ids = np.full(capacity, -1, dtype=np.int64)
+        self.slots = {}
+        self.free = list(range(capacity - 1, -1, -1))
+        self.cells = {}
+        self.cell_of = {}
+        self.info = {}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lon / self.cell_degrees))
+
+    def _grow(self):
+        size = len(self.ids)
+        self.lat = np.concatenate((self.lat, np.zeros(size)))
+        self.lon = np.concatenate((self.lon, np.zeros(size)))
+        self.ids = np.concatenate((self.ids, np.full(size, -1, dtype=np.int64)))
+        self.free.extend(range(2 * size - 1, size - 1, -1))
+
+    def reported_at(self, truck_id):
+        info = self.info.get(truck_id)
+        return info[1] if info is not None else None
+
+    def put(self, truck_id, lat, lon, speed, reported_at):
+        slot = self.slots.get(truck_id)
+        if slot is None:
+            if not self.free:
+                self._grow()
+            slot = self.free.pop()
+            self.slots[truck_id] = slot
+            self.ids[slot] = truck_id
+        else:
+            self._unlink(slot)
+        self.lat[slot] = lat
+        self.lon[slot] = lon
+        self.info[truck_id] = (speed, reported_at)
+        cell = self._cell(lat, lon)
+        self.cell_of[slot] = cell
+        self.cells.setdefault(cell, set()).add(slot)
+
+    def pop(self, truck_id):
+        slot = self.slots.pop(truck_id, None)
+        if slot is None:
+            return None
+        self._unlink(slot)
+        self.ids[slot] = -1
+        self.free.append(slot)
+        speed, reported_at = self.info.pop(truck_id)
+        return float(self.lat[slot]), float(self.lon[slot]), speed, reported_at
+
+    def _unlink(self, slot):
+        cell = self.cell_of.pop(slot)
+        members = self.cells[cell]
+        members.discard(slot)
+        if not members:
+            del self.cells[cell]
+
+    def _bound(self, lat, lon, row, col, ring):
+        # Great-circle distance below which nothing outside the (2 * ring + 1)^2 block of
+        # cells around (row, col) can lie: either far away in latitude, or outside in
+        # longitude within a band no wider than the block's latitudes.
+        south, north = (row - ring) * self.cell_degrees, (row + ring + 1) * self.cell_degrees
+        west, east = (col - ring) * self.cell_degrees, (col + ring + 1) * self.cell_degrees
+        lat_gap = min(lat - south, north - lat)
+        lon_gap = min(lon - west, east - lon, 180.0)
+        widest = min(max(abs(south), abs(north)), 90.0)
+        lon_bound = 2 * math.asin(min(1.0, math.cos(math.radians(widest)) * math.sin(math.radians(lon_gap) / 2)))
+        return EARTH_RADIUS_M * min(math.radians(lat_gap), lon_bound)
+
+    def _ring(self, row, col, ring):
+        if ring == 0:
+            return [(row, col)]
+        keys = [(row - ring, c) for c in range(col - ring, col + ring + 1)]
+        keys += [(row + ring, c) for c in range(col - ring, col + ring + 1)]
+        keys += [(r, col - ring) for r in range(row - ring + 1, row + ring)]
+        keys += [(r, col + ring) for r in range(row - ring + 1, row + ring)]
+        return keys
+
+    def nearest(self, lat, lon, k, radius_m=None):
+        # Returns [(truck_id, distance_m)] of the k nearest trucks, closest first,
+        # optionally only those within radius_m. Rings of cells are added around the
+        # query cell until the k-th distance found is within the bound of the rings
+        # searched. Once the block would take longer to walk than measuring every truck
+        # (a query far from the fleet, or an owner with few trucks) all are measured.
+        if not self.slots or k <= 0:
+            return []
+        row, col = self._cell(lat, lon)
+        walk_limit = min(len(self.cells), len(self.slots) // SCAN_CELL_COST)
+        found_slots, found_dist = [], []
+        found = 0
+        ring = 0
+        while True:
+            if (2 * ring + 1) ** 2 >= walk_limit:
+                slots = np.flatnonzero(self.ids >= 0)
+                found_slots, found_dist = [slots], [haversine(lat, lon, self.lat[slots], self.lon[slots])]
+                break
+            cells = [self.cells[key] for key in self._ring(row, col, ring) if key in self.cells]
+            if cells:
+                slots = np.fromiter(itertools.chain.from_iterable(cells), dtype=np.int64)
+                found_slots.append(slots)
+                found_dist.append(haversine(lat, lon, self.lat[slots], self.lon[slots]))
+                found += len(slots)
+            bound = self._bound(lat, lon, row, col, ring)
+            if radius_m is not None and bound >= radius_m:
+                break
+            if found >= k:
+                dist = np.concatenate(found_dist)
+                if np.partition(dist, k - 1)[k - 1] <= bound:
+                    break
+            ring += 1
+
+        slots = np.concatenate(found_slots)
+        dist = np.concatenate(found_dist)
+        if radius_m is not None:
+            inside = dist <= radius_m
+            slots, dist = slots[inside], dist[inside]
+        if len(dist) > k:
+            top = np.argpartition(dist, k - 1)[:k]
+            slots, dist = slots[top], dist[top]
+        order = np.lexsort((self.ids[slots], dist))
+        return list(zip(self.ids[slots[order]].tolist(), dist[order].tolist()))
+
+    def position(self, truck_id):
+        slot = self.slots[truck_id]
+        speed, reported_at = self.info[truck_id]
+        return float(self.lat[slot]), float(self.lon[slot]), speed, reported_at
+
+
+class DispatchIndex:
+    # Every owner's grid in this process, kept current by the position notifications
+    # on fleet_events and by fleet_version, which carries ownership changes and
+    # deletions. Like the page cache's version mirror it is only trusted while the
+    # LISTEN connection is up and after a reload since it last (re)connected.
+    def __init__(self, cell_degrees=GRID_DEGREES):
+        self.cell_degrees = cell_degrees
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._owners = {}
+        self._truck_owner = {}
+        self._generation = None
+        self._pending = None
+
+    def apply_position(self, payload):
+        if payload.get('kind') != 'position' or payload.get('latitude') is None or payload.get('longitude') is None:
+            return
+        reported_at = payload.get('reported_at')
+        if reported_at is not None:
+            reported_at = datetime.fromisoformat(reported_at)
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((self._put, payload, reported_at))
+            self._put(payload, reported_at)
+
+    def apply_version(self, payload):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((self._move, payload, None))
+            self._move(payload, None)
+
+    def _put(self, payload, reported_at):
+        truck_id = payload['truck_id']
+        owner_id = self._truck_owner.get(truck_id)
+        if owner_id is not None:
+            # truck_state only moves forward, so an older position is a notification
+            # from a transaction that committed before the one already applied.
+            current = self._owners[owner_id].reported_at(truck_id)
+            if current is not None and reported_at is not None and reported_at < current:
+                return
+        self.put(truck_id, payload.get('owner_id'), float(payload['latitude']), float(payload['longitude']),
+                 payload.get('speed'), reported_at)
+
+    def _move(self, payload, _):
+        truck_id = payload['truck_id']
+        owner_id = self._truck_owner.get(truck_id)
+        if owner_id is None:
+            return
+        if payload.get('deleted') or payload.get('owner_id') is None:
+            self._remove(truck_id)
+        elif payload['owner_id'] != owner_id:
+            self.put(truck_id, payload['owner_id'], *self._owners[owner_id].position(truck_id))
+
+    def put(self, truck_id, owner_id, lat, lon, speed, reported_at):
+        if self._truck_owner.get(truck_id) != owner_id:
+            self._remove(truck_id)
+        if owner_id is None:
+            return
+        grid = self._owners.get(owner_id)
+        if grid is None:
+            grid = self._owners[owner_id] = OwnerGrid(self.cell_degrees)
+        grid.put(truck_id, lat, lon, speed, reported_at)
+        self._truck_owner[truck_id] = owner_id
+
+    def _remove(self, truck_id):
+        owner_id = self._truck_owner.pop(truck_id, None)
+        if owner_id is None:
+            return
+        grid = self._owners[owner_id]
+        grid.pop(truck_id)
+        if not grid:
+            del self._owners[owner_id]
+
+    def load(self, cur, generation):
+        # Notifications that arrive while the snapshot is read are replayed on top of
+        # it; a replayed position older than the snapshot's is ignored.
+        with self._load_lock:
+            if self._generation == generation:
+                return
+            with self._lock:
+                self._pending = []
+            try:
+                cur.execute(POSITIONS_QUERY)
+                rows = cur.fetchall()
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                pending, self._pending = self._pending, None
+                self._owners, self._truck_owner = {}, {}
+                for row in rows:
+                    self.put(*row)
+                for apply, payload, reported_at in pending:
+                    apply(payload, reported_at)
+                self._generation = generation
+
+    def is_current(self, generation):
+        return self._generation == generation
+
+    def nearest(self, owner_id, lat, lon, k, radius_m=None):
+        with self._lock:
+            grid = self._owners.get(owner_id)
+            if grid is None:
+                return []
+            return [(truck_id, distance) + grid.position(truck_id)
+                    for truck_id, distance in grid.nearest(lat, lon, k, radius_m)]
+
+
+index = DispatchIndex()
+events.on_notify(events.FLEET_EVENTS_CHANNEL, index.apply_position)
+events.on_notify('fleet_version', index.apply_version)
+
+
+def parse_query(args):
+    try:
+        lat = float(args['lat'])
+        lon = float(args['lon'])
+    except KeyError:
+        raise DispatchError('lat and lon are required')
+    except ValueError:
+        raise DispatchError('lat and lon must be numbers')
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise DispatchError('lat must be within [-90, 90] and lon within [-180, 180]')
+    try:
+        radius_km = float(args['radius_km']) if args.get('radius_km') else None
+        k = int(args.get('k', MAX_RESULTS if radius_km is not None else 10))
+    except ValueError:
+        raise DispatchError('k and radius_km must be numbers')
+    if radius_km is not None and not 0 < radius_km <= MAX_RADIUS_KM:
+        raise DispatchError('radius_km must be within (0, %d]' % MAX_RADIUS_KM)
+    if not 1 <= k <= MAX_RESULTS:
+        raise DispatchError('k must be between 1 and %d' % MAX_RESULTS)
+    return {'lat': lat, 'lon': lon, 'k': k, 'radius_m': radius_km * 1000 if radius_km is not None else None}
+
+
+def nearest_trucks(cur, owner_id, lat, lon, k, radius_m=None):
+    # Returns [(truck_id, distance_m, lat, lon, speed, reported_at)], closest first.
+    # Without a live LISTEN connection the owner's positions are read from truck_state.
+    listener = events.get_listener()
+    if listener.connected:
+        generation = listener.generation
+        if not index.is_current(generation):
+            index.load(cur, generation)
+        return index.nearest(owner_id, lat, lon, k, radius_m)
+    cur.execute(OWNER_POSITIONS_QUERY, (owner_id,))
+    grid = OwnerGrid()
+    for truck_id, _, *position in cur.fetchall():
+        grid.put(truck_id, *position)
+    return [(truck_id, distance) + grid.position(truck_id) for truck_id, distance in grid.nearest(lat, lon, k, radius_m)]
@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import defaultdict, deque
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+FLEET_EVENTS_CHANNEL = 'fleet_events'
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv('SSE_QUEUE_SIZE', '100'))
+
+
+def format_sse(event, data):
+    return ('event: %s\ndata: %s\n\n' % (event, json.dumps(data, default=str))).encode()
+
+
+class Subscription:
+    __slots__ = ('channels', 'queue', 'event')
+
+    def __init__(self, channels, maxlen):
+        self.channels = tuple(channels)
+        # A slow consumer loses its oldest events instead of growing without bound.
+        self.queue = deque(maxlen=maxlen)
+        self.event = threading.Event()
+
+    def push(self, message):
+        self.queue.append(message)
+        self.event.set()
+
+    def get(self, timeout):
+        if not self.queue:
+            self.event.wait(timeout)
+        self.event.clear()
+        messages = []
+        while self.queue:
+            messages.append(self.queue.popleft())
+        return messages
+
+
+class Broker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = defaultdict(set)
+
+    def subscribe(self, channels, maxlen=SUBSCRIBER_QUEUE_SIZE):
+        subscription = Subscription(channels, maxlen)
+        with self._lock:
+            for channel in subscription.channels:
+                self._channels[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._channels[channel]
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        for subscription in subscribers:
+            subscription.push(message)
+        return len(subscribers)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({s for subscribers in self._channels.values() for s in subscribers})
+
+
+class PgListener(threading.Thread):
+    def __init__(self, dsn, reconnect_delay=2.0):
+        super().__init__(name='pg-listener', daemon=True)
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self._handlers = defaultdict(list)
+        self._stopped = threading.Event()
+        # generation advances on every successful LISTEN; state derived from notifications
+        # is only trustworthy while connected and if rebuilt after the latest reconnect.
+        self.generation = 0
+        self.connected = False
+
+    def on(self, channel, handler):
+        self._handlers[channel].append(handler)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _dispatch(self, notify):
+        try:
+            payload = json.loads(notify.payload) if notify.payload else {}
+        except ValueError:
+            logger.warning('ignoring malformed %s payload: %r', notify.channel, notify.payload)
+            return
+        for handler in self._handlers.get(notify.channel, ()):
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception('%s handler failed', notify.channel)
+
+    def run(self):
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                for channel in list(self._handlers):
+                    cur.execute('LISTEN %s' % channel)
+                self.generation += 1
+                self.connected = True
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 5.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0))
+            except psycopg2.Error:
+                logger.exception('LISTEN connection lost; reconnecting in %.1fs', self.reconnect_delay)
+                time.sleep(self.reconnect_delay)
+            finally:
+                self.connected = False
+                if conn is not None:
+                    conn.close()
+
+
+broker = Broker()
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+_notify_handlers = defaultdict(list)
+
+
+def on_notify(channel, handler):
+    # Register at import time: channels are LISTENed when the per-process listener starts.
+    _notify_handlers[channel].append(handler)
+
+
+def _publish_fleet_event(payload):
+    data = {key: value for key, value in payload.items() if key != 'kind'}
+    message = format_sse(payload.get('kind', 'message'), data)
+    broker.publish('truck:%s' % payload.get('truck_id'), message)
+    if payload.get('owner_id') is not None:
+        broker.publish('owner:%s' % payload['owner_id'], message)
+
+
+def get_listener():
+    global _listener, _listener_pid
+    if _listener is None or _listener_pid != os.getpid():
+        with _listener_lock:
+            if _listener is None or _listener_pid != os.getpid():
+                listener = PgListener(os.getenv('DATABASE_URL'))
+                listener.on(FLEET_EVENTS_CHANNEL, _publish_fleet_event)
+                for channel, handlers in _notify_handlers.items():
+                    for handler in handlers:
+                        listener.on(channel, handler)
+                listener.start()
+                _listener, _listener_pid = listener, os.getpid()
+    return _listener
+
+
+def stream(subscription, heartbeat=15.0):
+    try:
+        yield b'retry: 5000\n\n'
+        while True:
+            messages = subscription.get(heartbeat)
+            yield b''.join(messages) if messages else b': keepalive\n\n'
+    finally:
+        broker.unsubscribe(subscription)
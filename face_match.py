@@ -0,0 +1,314 @@
+import base64
+import binascii
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import numpy as np
+import psycopg2.extras
+
+import events
+from alerting import raise_alerts
+from ingest import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = int(os.getenv('FACE_EMBEDDING_DIM', '128'))
+MATCH_THRESHOLD = float(os.getenv('FACE_MATCH_THRESHOLD', '0.6'))
+TOP_K = int(os.getenv('FACE_MATCH_TOP_K', '3'))
+INDEX_TTL = float(os.getenv('FACE_INDEX_TTL', '300'))
+MAX_DETECTIONS = int(os.getenv('FACE_MAX_DETECTIONS', '5000'))
+# Upper bound on one block of the query x driver score matrix; larger batches are
+# scored in slices so memory stays flat however many drivers are enrolled.
+SCORE_BLOCK_BYTES = 64 * 1024 * 1024
+GATHER_WIDTH = 32
+
+# face_detections.match_result values. A truck with no enrolled drivers cannot be
+# verified, so its detections are recorded but never raise alerts.
+MATCHED = 'Matched'
+WRONG_TRUCK = 'Wrong Truck'
+NO_MATCH = 'No Match'
+UNVERIFIED = 'Unverified'
+
+
+class FaceMatchError(ValueError):
+    pass
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    if np.any(norms == 0) or not np.all(np.isfinite(norms)):
+        raise FaceMatchError('embeddings must be finite and non-zero')
+    return vectors / norms
+
+
+def parse_embedding(value):
+    # A JSON list of numbers, or base64 of little-endian float32 values.
+    if isinstance(value, str):
+        try:
+            raw = base64.b64decode(value, validate=True)
+        except (ValueError, binascii.Error):
+            raise FaceMatchError('embedding is not valid base64')
+        if len(raw) != EMBEDDING_DIM * 4:
+            raise FaceMatchError('embedding must have %d float32 values' % EMBEDDING_DIM)
+        vector = np.frombuffer(raw, dtype='<f4')
+    elif isinstance(value, list):
+        if len(value) != EMBEDDING_DIM:
+            raise FaceMatchError('embedding must have %d values' % EMBEDDING_DIM)
+        try:
+            vector = np.array(value, dtype=np.float32)
+        except (TypeError, ValueError):
+            raise FaceMatchError('embedding values must be numbers')
+    else:
+        raise FaceMatchError('embedding must be a list of numbers or base64 float32')
+    return normalize(vector)
+
+
+def encode_embedding(vector):
+    return normalize(vector).astype('<f4').tobytes()
+
+
+def _top_k(scores, k):
+    # Row-wise top-k of a score block, best first, without sorting whole rows.
+    if scores.shape[1] > k:
+        idx = np.argpartition(scores, -k, axis=1)[:, -k:]
+    else:
+        idx = np.broadcast_to(np.arange(scores.shape[1]), (scores.shape[0], scores.shape[1]))
+    top = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+
+class FaceIndex:
+    # Enrolled drivers as one L2-normalized float32 matrix, rows grouped by truck so a
+    # truck's own drivers are a contiguous slice. Cosine similarity is then a matrix
+    # product: a whole batch of detections is scored with one BLAS call per block.
+    def __init__(self, driver_ids, truck_ids, embeddings):
+        driver_ids = np.asarray(driver_ids, dtype=np.int64)
+        truck_ids = np.asarray(truck_ids, dtype=np.int64)
+        order = np.argsort(truck_ids, kind='stable')
+        self.driver_ids = driver_ids[order]
+        self.truck_ids = truck_ids[order]
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(order), EMBEDDING_DIM)
+        self.matrix = np.ascontiguousarray(normalize(embeddings[order])) if len(order) else embeddings
+        trucks, starts, counts = np.unique(self.truck_ids, return_index=True, return_counts=True)
+        self._slices = {int(t): (int(s), int(s + c)) for t, s, c in zip(trucks, starts, counts)}
+
+    def __len__(self):
+        return len(self.driver_ids)
+
+    def enrolled(self, truck_id):
+        return truck_id in self._slices
+
+    def _search_block(self, queries, start, end, k):
+        k = min(k, end - start)
+        rows = max(1, SCORE_BLOCK_BYTES // (4 * (end - start)))
+        ids = np.empty((len(queries), k), dtype=np.int64)
+        scores = np.empty((len(queries), k), dtype=np.float32)
+        for lo in range(0, len(queries), rows):
+            block = queries[lo:lo + rows] @ self.matrix[start:end].T
+            idx, top = _top_k(block, k)
+            ids[lo:lo + rows] = self.driver_ids[start:end][idx]
+            scores[lo:lo + rows] = top
+        return ids, scores
+
+    def search(self, queries, k=TOP_K, truck_ids=None):
+        # Returns (driver_ids, scores), each (len(queries), k), best match first. With
+        # truck_ids only each query's own truck's drivers are candidates. Missing
+        # candidates are padded with driver id -1 and score -inf.
+        queries = normalize(queries).reshape(-1, EMBEDDING_DIM)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if not len(self) or not len(queries):
+            return ids, scores
+        if truck_ids is None:
+            found, top = self._search_block(queries, 0, len(self), k)
+            ids[:, :found.shape[1]], scores[:, :top.shape[1]] = found, top
+            return ids, scores
+
+        # Trucks have a handful of drivers each, so one matrix product per truck would
+        # be dominated by call overhead. Instead every query gathers its own truck's
+        # rows into a padded (queries, width, dim) block scored in one einsum; the rare
+        # truck with more than GATHER_WIDTH drivers is scored on its own.
+        spans = np.array([self._slices.get(t, (0, 0)) for t in truck_ids], dtype=np.int64).reshape(-1, 2)
+        counts = spans[:, 1] - spans[:, 0]
+        small = np.flatnonzero((counts > 0) & (counts <= GATHER_WIDTH))
+        if len(small):
+            width = int(counts[small].max())
+            offsets = np.arange(width)
+            valid = offsets < counts[small, None]
+            rows = np.where(valid, spans[small, :1] + offsets, 0)
+            block = np.einsum('qd,qwd->qw', queries[small], self.matrix[rows])
+            block[~valid] = -np.inf
+            idx, top = _top_k(block, min(k, width))
+            ids[small, :idx.shape[1]] = np.where(np.isfinite(top), self.driver_ids[np.take_along_axis(rows, idx, 1)], -1)
+            scores[small, :top.shape[1]] = top
+        for i in np.flatnonzero(counts > GATHER_WIDTH):
+            found, top = self._search_block(queries[i:i + 1], spans[i, 0], spans[i, 1], k)
+            ids[i, :found.shape[1]], scores[i, :top.shape[1]] = found, top
+        return ids, scores
+
+
+_lock = threading.Lock()
+_index = None
+_loaded_at = 0.0
+
+
+def invalidate():
+    global _index
+    with _lock:
+        _index = None
+
+
+# Enrollment changes from any process arrive through the LISTEN thread; processes
+# without a listener rely on FACE_INDEX_TTL instead.
+events.on_notify('driver_embeddings_changed', lambda payload: invalidate())
+
+
+def load_index(cur):
+    cur.execute('''
+        SELECT id, truck_id, embedding FROM drivers
+        WHERE embedding IS NOT NULL AND truck_id IS NOT NULL
+    ''')
+    driver_ids, truck_ids, blobs = [], [], []
+    for driver_id, truck_id, embedding in cur:
+        if len(embedding) != EMBEDDING_DIM * 4:
+            logger.warning('skipping driver %s: embedding has %d bytes, expected %d',
+                           driver_id, len(embedding), EMBEDDING_DIM * 4)
+            continue
+        driver_ids.append(driver_id)
+        truck_ids.append(truck_id)
+        blobs.append(embedding)
+    embeddings = np.frombuffer(b''.join(blobs), dtype='<f4')
+    return FaceIndex(driver_ids, truck_ids, embeddings)
+
+
+def get_index(cur):
+    global _index, _loaded_at
+    with _lock:
+        if _index is None or time.monotonic() - _loaded_at > INDEX_TTL:
+            _index = load_index(cur)
+            _loaded_at = time.monotonic()
+        return _index
+
+
+def parse_detections(data):
+    if isinstance(data, dict):
+        data = data.get('detections')
+    if not isinstance(data, list) or not data:
+        raise FaceMatchError('expected a non-empty list of detections')
+    if len(data) > MAX_DETECTIONS:
+        raise FaceMatchError('at most %d detections per request' % MAX_DETECTIONS)
+    detections = []
+    for i, item in enumerate(data):
+        if not isinstance(item, dict):
+            raise FaceMatchError('detection %d: expected an object' % i)
+        try:
+            truck_id = int(item['truck_id'])
+            embedding = parse_embedding(item.get('embedding'))
+            detected_at = parse_timestamp(item.get('detected_at'))
+        except (KeyError, TypeError, ValueError) as e:
+            raise FaceMatchError('detection %d: %s' % (i, e))
+        image_url = item.get('image_url')
+        if image_url is not None and (not isinstance(image_url, str) or len(image_url) > 255):
+            raise FaceMatchError('detection %d: image_url must be a string of at most 255 characters' % i)
+        detections.append((truck_id, embedding, image_url, detected_at))
+    return detections
+
+
+def classify(index, truck_ids, embeddings, threshold=MATCH_THRESHOLD, k=TOP_K):
+    # Each detection is first scored against its own truck's drivers only. Anything
+    # below the threshold is then searched fleet-wide to tell a known driver on the
+    # wrong truck from an unknown face. Returns (result, driver_id, score, candidates).
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    own_ids, own_scores = index.search(embeddings, 1, truck_ids)
+    results = [None] * len(truck_ids)
+    unmatched = []
+    for i, truck_id in enumerate(truck_ids):
+        if not index.enrolled(truck_id):
+            results[i] = (UNVERIFIED, None, None, [])
+        elif own_scores[i, 0] >= threshold:
+            results[i] = (MATCHED, int(own_ids[i, 0]), float(own_scores[i, 0]), [])
+        else:
+            unmatched.append(i)
+    if unmatched:
+        ids, scores = index.search(embeddings[unmatched], k)
+        for row, i in enumerate(unmatched):
+            candidates = [(int(d), float(s)) for d, s in zip(ids[row], scores[row]) if d >= 0]
+            if candidates and candidates[0][1] >= threshold:
+                results[i] = (WRONG_TRUCK, candidates[0][0], candidates[0][1], candidates)
+            else:
+                results[i] = (NO_MATCH, None, float(own_scores[i, 0]), candidates)
+    return results
+
+
+def match_detections(cur, detections):
+    # detections are (truck_id, embedding, image_url, detected_at) tuples. Writes one
+    # face_detections row each and at most one Unauthorized Driver alert per truck per
+    # batch, for its first failed verification.
+    index = get_index(cur)
+    truck_ids = [d[0] for d in detections]
+    cur.execute('SELECT id, truck_number FROM trucks WHERE id = ANY(%s)', (list(set(truck_ids)),))
+    truck_numbers = dict(cur.fetchall())
+    unknown = sorted(set(truck_ids) - set(truck_numbers))
+    if unknown:
+        raise FaceMatchError('unknown truck ids: %s' % ', '.join(map(str, unknown[:20])))
+
+    results = classify(index, truck_ids, np.stack([d[1] for d in detections]))
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rows, failed = [], {}
+    for (truck_id, _, image_url, detected_at), (result, driver_id, score, _) in zip(detections, results):
+        confidence = round(max(score, 0.0) * 100, 2) if score is not None else None
+        rows.append((truck_id, driver_id, image_url, confidence, result, detected_at or now))
+        if result in (WRONG_TRUCK, NO_MATCH) and truck_id not in failed:
+            failed[truck_id] = (result, driver_id, confidence)
+
+    drivers = {}
+    wrong = [driver_id for result, driver_id, _ in failed.values() if result == WRONG_TRUCK]
+    if wrong:
+        cur.execute('''
+            SELECT d.id, d.name, t.truck_number FROM drivers d JOIN trucks t ON t.id = d.truck_id
+            WHERE d.id = ANY(%s)
+        ''', (wrong,))
+        drivers = {row[0]: row[1:] for row in cur.fetchall()}
+    alerts = []
+    for truck_id, (result, driver_id, confidence) in failed.items():
+        if result == WRONG_TRUCK and driver_id in drivers:
+            name, home_truck = drivers[driver_id]
+            message = '%s: %s, a driver of %s, detected at the wheel (%.0f%% match)' % (
+                truck_numbers[truck_id], name, home_truck, confidence)
+        else:
+            message = '%s: unrecognised driver detected' % truck_numbers[truck_id]
+        alerts.append((truck_id, 'Unauthorized Driver', message, 'high'))
+
+    psycopg2.extras.execute_values(cur, '''
+        INSERT INTO face_detections (truck_id, driver_id, image_url, confidence, match_result, detected_at)
+        VALUES %s
+    ''', rows, page_size=1000)
+    raise_alerts(cur, alerts)
+
+    counts = defaultdict(int)
+    for result in results:
+        counts[result[0]] += 1
+    return {
+        'detections': len(rows),
+        'matched': counts[MATCHED],
+        'wrong_truck': counts[WRONG_TRUCK],
+        'no_match': counts[NO_MATCH],
+        'unverified': counts[UNVERIFIED],
+        'alerts': len(alerts),
+        'results': [
+            {
+                'truck_id': truck_id,
+                'match_result': result,
+                'driver_id': driver_id,
+                'similarity': score,
+                'candidates': [{'driver_id': d, 'similarity': s} for d, s in candidates],
+            }
+            for truck_id, (result, driver_id, score, candidates) in zip(truck_ids, results)
+        ],
+    }
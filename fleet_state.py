@@ -0,0 +1,71 @@
+import psycopg2.extras
+
+# truck_state holds one row per truck. Position columns only move forward in time:
+# an ingest batch overwrites them only when its newest point is at least as recent as
+# the stored one, so late or replayed points never regress the state. Alert counters
+# are maintained by a trigger on alerts (see migration 4).
+
+FLEET_STATE_QUERY = '''
+    SELECT t.*, s.latitude, s.longitude, s.speed, s.reported_at, s.active_alerts,
+           CASE WHEN s.offline_cameras > 0 THEN 'offline' ELSE 'online' END AS camera_status
+    FROM trucks t
+    LEFT JOIN truck_state s ON s.truck_id = t.id
+    WHERE t.owner_id = %s
+    ORDER BY t.created_at DESC
+'''
+
+
+def latest_by_truck(points, latest=None):
+    latest = {} if latest is None else latest
+    for truck_id, lat, lon, ts, speed in points:
+        current = latest.get(truck_id)
+        if current is None or ts >= current[3]:
+            latest[truck_id] = (lat, lon, speed, ts)
+    return latest
+
+
+def record_positions(cur, latest):
+    if not latest:
+        return
+    psycopg2.extras.execute_values(cur, '''
+        INSERT INTO truck_state (truck_id, latitude, longitude, speed, reported_at)
+        VALUES %s
+        ON CONFLICT (truck_id) DO UPDATE SET
+            latitude = EXCLUDED.latitude,
+            longitude = EXCLUDED.longitude,
+            speed = EXCLUDED.speed,
+            reported_at = EXCLUDED.reported_at,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE truck_state.reported_at IS NULL OR EXCLUDED.reported_at >= truck_state.reported_at
+    ''', [(truck_id, lat, lon, speed, ts) for truck_id, (lat, lon, speed, ts) in latest.items()])
+
+
+def refresh_truck_state(cur):
+    cur.execute('''
+        INSERT INTO truck_state (truck_id, latitude, longitude, speed, reported_at, active_alerts, offline_cameras)
+        SELECT t.id, g.latitude, g.longitude, g.speed, g.timestamp,
+               COALESCE(a.active_alerts, 0), COALESCE(a.offline_cameras, 0)
+        FROM trucks t
+        LEFT JOIN LATERAL (
+            SELECT latitude, longitude, speed, timestamp FROM gps_locations
+            WHERE truck_id = t.id ORDER BY timestamp DESC LIMIT 1
+        ) g ON TRUE
+        LEFT JOIN (
+            SELECT truck_id, count(*) AS active_alerts,
+                   count(*) FILTER (WHERE alert_type = 'Camera Offline') AS offline_cameras
+            FROM alerts WHERE is_read IS FALSE GROUP BY truck_id
+        ) a ON a.truck_id = t.id
+        ON CONFLICT (truck_id) DO UPDATE SET
+            latitude = EXCLUDED.latitude,
+            longitude = EXCLUDED.longitude,
+            speed = EXCLUDED.speed,
+            reported_at = EXCLUDED.reported_at,
+            active_alerts = EXCLUDED.active_alerts,
+            offline_cameras = EXCLUDED.offline_cameras,
+            updated_at = CURRENT_TIMESTAMP
+    ''')
+
+
+def fleet_state(cur, owner_id):
+    cur.execute(FLEET_STATE_QUERY, (owner_id,))
+    return cur.fetchall()
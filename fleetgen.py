@@ -0,0 +1,218 @@
+import io
+import struct
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from werkzeug.security import generate_password_hash
+
+from alerting import refresh_alert_counts
+from fleet_state import refresh_truck_state
+from gps_storage import ensure_partitions
+
+# Synthetic fleets for load testing. Everything is written with COPY and ids are
+# reserved from the sequences up front, so related rows can be generated without
+# reading anything back.
+
+PG_EPOCH = datetime(2000, 1, 1)
+
+# Binary COPY row for the GPS staging table: truck_id int4, ts timestamp, lat float8,
+# lon float8, speed float4, each field preceded by its byte length.
+_GPS_COPY_ROW = np.dtype([
+    ('fields', '>i2'),
+    ('truck_id_len', '>i4'), ('truck_id', '>i4'),
+    ('ts_len', '>i4'), ('ts', '>i8'),
+    ('lat_len', '>i4'), ('lat', '>f8'),
+    ('lon_len', '>i4'), ('lon', '>f8'),
+    ('speed_len', '>i4'), ('speed', '>f4'),
+])
+_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_COPY_TRAILER = struct.pack('>h', -1)
+
+MODELS = ('Volvo FH16', 'Scania R450', 'Mercedes Actros', 'MAN TGX', 'DAF XF', 'Iveco Stralis', 'Renault T')
+FIRST_NAMES = ('Robert', 'Michael', 'David', 'James', 'William', 'Thomas', 'Charles', 'Maria', 'Linda', 'Anna')
+LAST_NAMES = ('Johnson', 'Brown', 'Garcia', 'Martinez', 'Rodriguez', 'Davis', 'Miller', 'Lopez', 'Wilson', 'Clark')
+ALERT_TYPES = (
+    ('Speed Alert', 'medium', '%s exceeded the speed limit'),
+    ('Idle Alert', 'low', '%s idled with the engine running'),
+    ('Camera Offline', 'medium', 'Camera 2 in %s is not receiving signal'),
+    ('Unauthorized Driver', 'high', 'Unrecognised driver detected in %s'),
+    ('Alcohol Detection', 'high', 'Alcohol detected in cabin of %s'),
+)
+
+# Trigger-maintained state (truck_state, owner alert counters, versions, notifications) is rebuilt
+# once at the end instead of row by row; the triggers are disabled only inside the
+# loading transaction, so no other session ever sees them off.
+_BULK_TABLES = ('trucks', 'drivers', 'alerts', 'face_detections', 'video_recordings')
+
+
+def _reserve_ids(cur, sequence, count):
+    cur.execute('SELECT nextval(%s) FROM generate_series(1, %s)', (sequence, count))
+    return np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+
+
+def _copy_text(cur, table, columns, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join('\\N' if value is None else str(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)), buf)
+
+
+def _pg_micros(ts):
+    return int((ts - PG_EPOCH).total_seconds() * 1_000_000)
+
+
+def simulate_tracks(truck_ids, points, interval, end, rng):
+    # Vectorized random walk per truck: a slowly drifting heading, driving at motorway
+    # speeds with a stop of about half an hour every four hours. Returns flat arrays
+    # ordered by truck, then time.
+    trucks = len(truck_ids)
+    steps = np.arange(points)
+    cycle = max(1, int(4 * 3600 / interval))
+    moving = (steps[None, :] + rng.integers(0, cycle, (trucks, 1))) % cycle < cycle * 7 // 8
+    speed = np.clip(rng.normal(85, 12, (trucks, 1)) + rng.normal(0, 6, (trucks, points)), 5, 125) * moving
+    heading = rng.uniform(0, 2 * np.pi, (trucks, 1)) + np.cumsum(rng.normal(0, 0.08, (trucks, points)), axis=1)
+    step_km = speed * interval / 3600
+    lat = rng.uniform(30, 47, (trucks, 1)) + np.cumsum(step_km * np.cos(heading) / 111.0, axis=1)
+    lat = np.clip(lat, -89, 89)
+    lon = rng.uniform(-120, -75, (trucks, 1)) + np.cumsum(
+        step_km * np.sin(heading) / (111.0 * np.cos(np.radians(lat))), axis=1)
+    lon = (lon + 180) % 360 - 180
+
+    offsets = (points - 1 - steps) * interval * 1_000_000
+    jitter = rng.integers(0, max(1, interval * 250_000), (trucks, points))
+    ts = _pg_micros(end) - offsets[None, :] + jitter
+    return np.repeat(truck_ids, points), ts.ravel(), lat.ravel(), lon.ravel(), speed.ravel().astype(np.float32)
+
+
+def copy_tracks(cur, truck_ids, ts, lat, lon, speed):
+    rows = np.empty(len(ts), dtype=_GPS_COPY_ROW)
+    rows['fields'] = 5
+    rows['truck_id_len'], rows['ts_len'], rows['lat_len'], rows['lon_len'], rows['speed_len'] = 4, 8, 8, 8, 4
+    rows['truck_id'], rows['ts'], rows['lat'], rows['lon'], rows['speed'] = truck_ids, ts, lat, lon, speed
+    cur.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS fleetgen_gps (
+            truck_id INTEGER, ts TIMESTAMP, lat DOUBLE PRECISION, lon DOUBLE PRECISION, speed REAL
+        ) ON COMMIT DELETE ROWS
+    ''')
+    cur.copy_expert('COPY fleetgen_gps FROM STDIN WITH (FORMAT binary)',
+                    io.BytesIO(_COPY_HEADER + rows.tobytes() + _COPY_TRAILER))
+    cur.execute('''
+        INSERT INTO gps_locations (truck_id, latitude, longitude, timestamp, speed)
+        SELECT truck_id, round(lat::numeric, 8), round(lon::numeric, 8), ts, speed FROM fleetgen_gps
+    ''')
+
+
+def generate_fleet(conn, trucks=1000, trucks_per_owner=20, drivers_per_truck=2, hours=24, interval=60,
+                   alerts_per_truck=10, detections_per_truck=10, recordings_per_truck=4,
+                   password='password123', seed=0, end=None, chunk_trucks=500, progress=None):
+    rng = np.random.default_rng(seed)
+    end = end or datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    start = end - timedelta(hours=hours)
+    points = max(1, int(hours * 3600 / interval))
+    owners = max(1, -(-trucks // trucks_per_owner))
+    summary = {'owners': owners, 'trucks': trucks, 'drivers': trucks * drivers_per_truck,
+               'alerts': trucks * alerts_per_truck, 'face_detections': trucks * detections_per_truck,
+               'recordings': trucks * recordings_per_truck, 'gps_points': trucks * points}
+    started = time.perf_counter()
+
+    def report(step):
+        if progress:
+            progress('%-16s %7.1fs' % (step, time.perf_counter() - started))
+
+    cur = conn.cursor()
+    for table in _BULK_TABLES:
+        cur.execute('ALTER TABLE %s DISABLE TRIGGER USER' % table)
+
+    # One hash for every generated owner: hashing is deliberately slow and would
+    # otherwise dominate the load.
+    password_hash = generate_password_hash(password)
+    user_ids = _reserve_ids(cur, 'users_id_seq', owners)
+    tag = '%x' % int(user_ids[0])
+    _copy_text(cur, 'users', ('id', 'username', 'password_hash', 'email', 'full_name'), (
+        (user_id, 'fleet%s_%d' % (tag, i), password_hash, 'fleet%s_%d@example.com' % (tag, i), 'Fleet Owner %d' % i)
+        for i, user_id in enumerate(user_ids.tolist())))
+    report('users')
+
+    truck_ids = _reserve_ids(cur, 'trucks_id_seq', trucks)
+    truck_owner = user_ids[np.arange(trucks) // trucks_per_owner]
+    truck_numbers = ['TRK-%s-%05d' % (tag, i) for i in range(trucks)]
+    _copy_text(cur, 'trucks', ('id', 'truck_number', 'owner_id', 'license_plate', 'model', 'status', 'created_at'), (
+        (truck_id, truck_numbers[i], int(truck_owner[i]), 'GEN-%06d' % truck_id, MODELS[truck_id % len(MODELS)],
+         'active' if truck_id % 17 else 'maintenance', start.isoformat())
+        for i, truck_id in enumerate(truck_ids.tolist())))
+    report('trucks')
+
+    driver_ids = _reserve_ids(cur, 'drivers_id_seq', trucks * drivers_per_truck)
+    driver_truck = np.repeat(truck_ids, drivers_per_truck)
+    _copy_text(cur, 'drivers', ('id', 'truck_id', 'name', 'phone', 'license_number'), (
+        (driver_id, int(driver_truck[i]),
+         '%s %s' % (FIRST_NAMES[driver_id % len(FIRST_NAMES)], LAST_NAMES[driver_id // 7 % len(LAST_NAMES)]),
+         '+1-555-%04d' % (driver_id % 10000), 'DL-%07d' % driver_id)
+        for i, driver_id in enumerate(driver_ids.tolist())))
+    report('drivers')
+
+    span = hours * 3600
+
+    def times(count):
+        return [(start + timedelta(seconds=float(s))).isoformat() for s in rng.uniform(0, span, count)]
+
+    # Only the latest alert of each truck and type may still be unread (idx_alerts_open).
+    count = trucks * alerts_per_truck
+    alert_truck = rng.choice(trucks, count)
+    kinds = rng.integers(0, len(ALERT_TYPES), count)
+    created = [(start + timedelta(seconds=float(s))).isoformat() for s in np.sort(rng.uniform(0, span, count))]
+    _, last = np.unique((alert_truck * len(ALERT_TYPES) + kinds)[::-1], return_index=True)
+    unread = np.zeros(count, dtype=bool)
+    unread[count - 1 - last] = rng.random(len(last)) < 0.3
+    _copy_text(cur, 'alerts', ('truck_id', 'alert_type', 'message', 'severity', 'is_read', 'created_at', 'last_seen_at'), (
+        (int(truck_ids[t]), ALERT_TYPES[k][0], ALERT_TYPES[k][2] % truck_numbers[t], ALERT_TYPES[k][1],
+         'f' if u else 't', ts, ts)
+        for t, k, u, ts in zip(alert_truck.tolist(), kinds.tolist(), unread.tolist(), created)))
+    report('alerts')
+
+    count = trucks * detections_per_truck
+    detection_truck = rng.choice(trucks, count)
+    matched = rng.random(count) < 0.95
+    seat = rng.integers(0, drivers_per_truck, count) if drivers_per_truck else np.zeros(count, dtype=np.int64)
+    _copy_text(cur, 'face_detections', ('truck_id', 'driver_id', 'image_url', 'confidence', 'match_result', 'detected_at'), (
+        (int(truck_ids[t]), int(driver_ids[t * drivers_per_truck + s]) if m and drivers_per_truck else None,
+         '/static/images/detections/%d.jpg' % i, '%.2f' % (rng.uniform(80, 99) if m else rng.uniform(10, 55)),
+         'Matched' if m and drivers_per_truck else 'No Match', ts)
+        for i, (t, s, m, ts) in enumerate(zip(detection_truck.tolist(), seat.tolist(), matched.tolist(), times(count)))))
+    report('face detections')
+
+    count = trucks * recordings_per_truck
+    recording_truck = rng.choice(trucks, count)
+    _copy_text(cur, 'video_recordings', ('truck_id', 'camera_number', 'file_url', 'file_size', 'duration', 'status', 'recorded_at'), (
+        (int(truck_ids[t]), i % 4 + 1, '/static/videos/gen_%d.mp4' % i, 524288000, 3600, 'saved', ts)
+        for i, (t, ts) in enumerate(zip(recording_truck.tolist(), times(count)))))
+    report('recordings')
+
+    for table in _BULK_TABLES:
+        cur.execute('ALTER TABLE %s ENABLE TRIGGER USER' % table)
+    ensure_partitions(cur, start_day=start.date())
+    conn.commit()
+
+    # GPS is the bulk of the data: loaded a chunk of trucks at a time, one commit each.
+    for lo in range(0, trucks, chunk_trucks):
+        copy_tracks(cur, *simulate_tracks(truck_ids[lo:lo + chunk_trucks], points, interval, end, rng))
+        conn.commit()
+        report('gps %d/%d' % (min(lo + chunk_trucks, trucks), trucks))
+
+    refresh_truck_state(cur)
+    refresh_alert_counts(cur)
+    conn.commit()
+    report('truck state')
+    for table in ('users', 'trucks', 'drivers', 'alerts', 'face_detections', 'video_recordings', 'gps_locations',
+                  'truck_state', 'owner_alert_counts'):
+        cur.execute('ANALYZE %s' % table)
+    conn.commit()
+    cur.close()
+    report('analyze')
+
+    summary['usernames'] = 'fleet%s_0 .. fleet%s_%d' % (tag, tag, owners - 1)
+    summary['seconds'] = round(time.perf_counter() - started, 1)
+    return summary
@@ -0,0 +1,359 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import logging
+import math
+import os
+import secrets
+import signal
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import psycopg2.extras
+
+from alerting import SEVERITIES, raise_alerts
+from db_pool import ConnectionPool
+from ingest import IngestError, copy_gps_points, make_point
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_HOST = os.getenv('GATEWAY_HOST', '0.0.0.0')
+GATEWAY_PORT = int(os.getenv('GATEWAY_PORT', '5100'))
+# Records held in memory (buffered plus being written). When full, connections stop
+# being read, so TCP pushes back on the devices instead of the gateway growing.
+BUFFER_RECORDS = int(os.getenv('GATEWAY_BUFFER_RECORDS', '100000'))
+FLUSH_RECORDS = int(os.getenv('GATEWAY_FLUSH_RECORDS', '5000'))
+FLUSH_INTERVAL = float(os.getenv('GATEWAY_FLUSH_INTERVAL', '0.5'))
+HELLO_TIMEOUT = float(os.getenv('GATEWAY_HELLO_TIMEOUT', '10'))
+IDLE_TIMEOUT = float(os.getenv('GATEWAY_IDLE_TIMEOUT', '300'))
+DB_CONNECTIONS = int(os.getenv('GATEWAY_DB_CONNECTIONS', '4'))
+# A device that stops reading its acks is dropped once this much is queued for it.
+MAX_WRITE_BUFFER = 64 * 1024
+
+# Every frame is a 3-byte header (body length, frame type) and its body, all
+# little-endian. A device opens with HELLO and gets WELCOME carrying the last sequence
+# number already stored for its truck. After that it streams GPS and EVENT records,
+# each with its own increasing sequence number, and receives ACK with the highest
+# sequence number stored so far. Records are stored before they are acked and a
+# sequence number is stored at most once, so a device that resends everything
+# unacked after a reconnect gets each record into the database exactly once.
+FRAME_HEADER = struct.Struct('<HB')
+HELLO = 0x01
+GPS = 0x02
+EVENT = 0x03
+WELCOME = 0x81
+ACK = 0x82
+ERROR = 0x83
+
+HELLO_RECORD = struct.Struct('<iH')         # truck_id, token length; then the token
+GPS_RECORD = struct.Struct('<Qqddf')        # seq, epoch ms (0 = now), latitude, longitude, speed (NaN = unknown)
+EVENT_RECORD = struct.Struct('<QqBBH')      # seq, epoch ms, severity, type length, message length; then both
+SEQ_RECORD = struct.Struct('<Q')            # WELCOME and ACK
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_frame(kind, body=b''):
+    return FRAME_HEADER.pack(len(body), kind) + body
+
+
+def encode_hello(truck_id, token):
+    token = token.encode()
+    return encode_frame(HELLO, HELLO_RECORD.pack(truck_id, len(token)) + token)
+
+
+def encode_gps(seq, epoch_ms, latitude, longitude, speed=None):
+    return encode_frame(GPS, GPS_RECORD.pack(seq, epoch_ms, latitude, longitude, math.nan if speed is None else speed))
+
+
+def encode_event(seq, epoch_ms, alert_type, message, severity='medium'):
+    alert_type, message = alert_type.encode()[:255], message.encode()[:1000]
+    head = EVENT_RECORD.pack(seq, epoch_ms, SEVERITIES.index(severity), len(alert_type), len(message))
+    return encode_frame(EVENT, head + alert_type + message)
+
+
+async def read_frame(reader):
+    length, kind = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    return kind, await reader.readexactly(length)
+
+
+def decode_hello(body):
+    if len(body) < HELLO_RECORD.size:
+        raise ProtocolError('short HELLO')
+    truck_id, token_length = HELLO_RECORD.unpack_from(body)
+    if len(body) != HELLO_RECORD.size + token_length:
+        raise ProtocolError('bad HELLO length')
+    return truck_id, body[HELLO_RECORD.size:].decode('utf-8', 'replace')
+
+
+def decode_record(truck_id, kind, body):
+    # Returns (seq, point or alert). The payload is None for records that fail
+    # validation: they still advance the sequence, so they are acked and not resent.
+    if kind == GPS:
+        if len(body) != GPS_RECORD.size:
+            raise ProtocolError('bad GPS length')
+        seq, epoch_ms, latitude, longitude, speed = GPS_RECORD.unpack(body)
+        try:
+            return seq, make_point(truck_id, latitude, longitude, epoch_ms / 1000.0 if epoch_ms else None,
+                                   None if math.isnan(speed) else speed)
+        except (IngestError, ValueError, OverflowError, OSError):
+            return seq, None
+    if kind == EVENT:
+        if len(body) < EVENT_RECORD.size:
+            raise ProtocolError('short EVENT')
+        seq, epoch_ms, severity, type_length, message_length = EVENT_RECORD.unpack_from(body)
+        if len(body) != EVENT_RECORD.size + type_length + message_length:
+            raise ProtocolError('bad EVENT length')
+        alert_type = body[EVENT_RECORD.size:EVENT_RECORD.size + type_length].decode('utf-8', 'replace').strip()
+        message = body[EVENT_RECORD.size + type_length:].decode('utf-8', 'replace')
+        if not alert_type or severity >= len(SEVERITIES):
+            return seq, None
+        return seq, (truck_id, alert_type[:100], message, SEVERITIES[severity])
+    raise ProtocolError('unexpected frame type 0x%02x' % kind)
+
+
+def hash_device_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_device_tokens(cur, truck_ids):
+    # New credentials mean a new device, whose sequence numbers start over.
+    tokens = {truck_id: secrets.token_urlsafe(32) for truck_id in truck_ids}
+    psycopg2.extras.execute_values(cur, '''
+        UPDATE trucks t SET device_token_hash = v.token_hash
+        FROM (VALUES %s) AS v(truck_id, token_hash) WHERE t.id = v.truck_id
+    ''', [(truck_id, hash_device_token(token)) for truck_id, token in tokens.items()])
+    cur.execute('DELETE FROM device_sequences WHERE truck_id = ANY(%s)', (list(tokens),))
+    return tokens
+
+
+def authenticate_device(cur, truck_id, token):
+    # Returns the last stored sequence number, or None when the credentials are wrong.
+    cur.execute('''
+        SELECT t.device_token_hash, COALESCE(s.last_seq, 0)
+        FROM trucks t LEFT JOIN device_sequences s ON s.truck_id = t.id
+        WHERE t.id = %s
+    ''', (truck_id,))
+    row = cur.fetchone()
+    if row is None or row[0] is None or not hmac.compare_digest(row[0], hash_device_token(token)):
+        return None
+    return row[1]
+
+
+def store_records(cur, records):
+    # records are (truck_id, seq, kind, payload). Sequence rows are locked in truck
+    # order, so concurrent gateways serialize per truck without deadlocking, and
+    # anything at or below a truck's stored sequence number is a redelivery. Records
+    # of trucks deleted meanwhile are dropped. Returns the stored sequence number of
+    # every remaining truck in the batch.
+    truck_ids = sorted({record[0] for record in records})
+    cur.execute('''
+        INSERT INTO device_sequences (truck_id) SELECT id FROM trucks WHERE id = ANY(%s)
+        ON CONFLICT (truck_id) DO NOTHING
+    ''', (truck_ids,))
+    cur.execute('''
+        SELECT truck_id, last_seq FROM device_sequences
+        WHERE truck_id = ANY(%s) ORDER BY truck_id FOR UPDATE
+    ''', (truck_ids,))
+    stored = dict(cur.fetchall())
+    high = dict(stored)
+    points, alerts = [], []
+    for truck_id, seq, kind, payload in sorted(records, key=lambda record: record[:2]):
+        if seq <= high.get(truck_id, seq):
+            continue
+        high[truck_id] = seq
+        if payload is None:
+            continue
+        (points if kind == GPS else alerts).append(payload)
+    if points:
+        copy_gps_points(cur, enumerate(points))
+    raise_alerts(cur, alerts)
+    advanced = [(truck_id, seq) for truck_id, seq in high.items() if seq > stored[truck_id]]
+    if advanced:
+        psycopg2.extras.execute_values(cur, '''
+            UPDATE device_sequences s SET last_seq = v.seq, updated_at = CURRENT_TIMESTAMP
+            FROM (VALUES %s) AS v(truck_id, seq) WHERE s.truck_id = v.truck_id
+        ''', advanced)
+    return high
+
+
+class Gateway:
+    def __init__(self, dsn=None, buffer_records=BUFFER_RECORDS, flush_records=FLUSH_RECORDS,
+                 flush_interval=FLUSH_INTERVAL):
+        self.pool = ConnectionPool(dsn or os.getenv('DATABASE_URL'), minconn=1, maxconn=DB_CONNECTIONS + 1)
+        self.buffer_records = buffer_records
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.connections = {}
+        self.stats = {'connections': 0, 'records': 0, 'stored': 0, 'flushes': 0, 'rejected_hellos': 0}
+        self._records = []
+        self._in_flight = 0
+        self._space = asyncio.Condition()
+        self._ready = asyncio.Event()
+        self._closing = False
+        # One writer thread keeps flushes in order; lookups get their own threads.
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='gateway-writer')
+        self._lookups = ThreadPoolExecutor(DB_CONNECTIONS, thread_name_prefix='gateway-lookup')
+        self._server = None
+        self._flusher = None
+
+    def _run(self, fn, *args):
+        conn = self.pool.getconn()
+        try:
+            cur = conn.cursor()
+            result = fn(cur, *args)
+            conn.commit()
+            cur.close()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    async def start(self, host=GATEWAY_HOST, port=GATEWAY_PORT):
+        self._server = await asyncio.start_server(self._handle, host, port, limit=FRAME_HEADER.size + 0xFFFF)
+        self._flusher = asyncio.create_task(self._flush_loop())
+        return self._server.sockets[0].getsockname()
+
+    async def stop(self):
+        # Stop accepting, store what is buffered, ack it, then drop the connections.
+        self._server.close()
+        self._closing = True
+        self._ready.set()
+        await self._flusher
+        for writer in list(self.connections.values()):
+            writer.close()
+        await self._server.wait_closed()
+        self._writer.shutdown()
+        self._lookups.shutdown()
+        self.pool.closeall()
+
+    async def abort(self):
+        # Drops buffered records without storing them, as a crash would. Nothing
+        # dropped was acked, so devices resend it to the next gateway.
+        self._server.close()
+        self._closing = True
+        self._flusher.cancel()
+        for writer in list(self.connections.values()):
+            writer.transport.abort()
+        self._records = []
+        await self._server.wait_closed()
+        # A flush already running may still commit; its records are then redeliveries.
+        await asyncio.to_thread(self._writer.shutdown)
+        self._lookups.shutdown()
+        self.pool.closeall()
+
+    async def _put(self, record):
+        async with self._space:
+            await self._space.wait_for(lambda: len(self._records) + self._in_flight < self.buffer_records)
+            self._records.append(record)
+            self.stats['records'] += 1
+            if len(self._records) >= self.flush_records:
+                self._ready.set()
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        truck_id = None
+        try:
+            kind, body = await asyncio.wait_for(read_frame(reader), HELLO_TIMEOUT)
+            if kind != HELLO:
+                raise ProtocolError('expected HELLO')
+            truck_id, token = decode_hello(body)
+            last_seq = await loop.run_in_executor(self._lookups, self._run, authenticate_device, truck_id, token)
+            if last_seq is None or self._closing:
+                self.stats['rejected_hellos'] += 1
+                writer.write(encode_frame(ERROR, b'authentication failed'))
+                truck_id = None
+                return
+            previous = self.connections.get(truck_id)
+            if previous is not None:
+                previous.close()
+            self.connections[truck_id] = writer
+            self.stats['connections'] += 1
+            writer.write(encode_frame(WELCOME, SEQ_RECORD.pack(last_seq)))
+            # Frames already read from this connection are skipped when repeated; the
+            # database decides across connections and gateways.
+            seen = last_seq
+            while not self._closing:
+                kind, body = await asyncio.wait_for(read_frame(reader), IDLE_TIMEOUT)
+                seq, payload = decode_record(truck_id, kind, body)
+                if seq <= seen:
+                    continue
+                seen = seq
+                await self._put((truck_id, seq, kind, payload))
+        except ProtocolError as e:
+            writer.write(encode_frame(ERROR, str(e).encode()))
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            if truck_id is not None and self.connections.get(truck_id) is writer:
+                del self.connections[truck_id]
+            writer.close()
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        delay = 0.5
+        while not self._closing or self._records:
+            try:
+                await asyncio.wait_for(self._ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()
+            if not self._records:
+                continue
+            batch, self._records = self._records, []
+            self._in_flight = len(batch)
+            # Unstored records are kept and retried; devices keep them too until acked.
+            while True:
+                try:
+                    high = await loop.run_in_executor(self._writer, self._run, store_records, batch)
+                    delay = 0.5
+                    break
+                except psycopg2.Error:
+                    logger.exception('storing %d records failed; retrying in %.1fs', len(batch), delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30.0)
+            self.stats['stored'] += len(batch)
+            self.stats['flushes'] += 1
+            async with self._space:
+                self._in_flight = 0
+                self._space.notify_all()
+            for truck_id, seq in high.items():
+                writer = self.connections.get(truck_id)
+                if writer is None:
+                    continue
+                if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                    writer.close()
+                    continue
+                writer.write(encode_frame(ACK, SEQ_RECORD.pack(seq)))
+
+
+async def serve(host, port):
+    gateway = Gateway()
+    address = await gateway.start(host, port)
+    logger.info('telemetry gateway listening on %s:%d', *address[:2])
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    await stopped.wait()
+    logger.info('stopping; storing %d buffered records', len(gateway._records))
+    await gateway.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Asyncio TCP gateway for truck telemetry.')
+    parser.add_argument('--host', default=GATEWAY_HOST)
+    parser.add_argument('--port', type=int, default=GATEWAY_PORT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import psycopg2.extras
+
+import events
+from alerting import raise_alerts
+from analytics import haversine
+
+GRID_DEGREES = float(os.getenv('GEOFENCE_GRID_DEGREES', '0.05'))
+# Fences covering more grid cells than this (long corridors, whole regions) are kept
+# in a short list and prefiltered by bounding box instead of being copied into every cell.
+MAX_CELLS_PER_FENCE = int(os.getenv('GEOFENCE_MAX_CELLS', '400'))
+DEBOUNCE_POINTS = int(os.getenv('GEOFENCE_DEBOUNCE_POINTS', '3'))
+DEBOUNCE_SECONDS = float(os.getenv('GEOFENCE_DEBOUNCE_SECONDS', '15'))
+INDEX_TTL = float(os.getenv('GEOFENCE_INDEX_TTL', '60'))
+MAX_POLYGON_VERTICES = 1000
+SHAPES = ('polygon', 'circle')
+ALERT_ON = ('enter', 'exit', 'both')
+
+
+class GeofenceError(ValueError):
+    pass
+
+
+class Fence:
+    __slots__ = ('id', 'owner_id', 'truck_id', 'name', 'shape', 'alert_on', 'bbox', 'lat', 'lon', 'radius_m')
+
+    def __init__(self, id, owner_id, truck_id, name, shape, coordinates, radius_m=None, alert_on='both'):
+        self.id = id
+        self.owner_id = owner_id
+        self.truck_id = truck_id
+        self.name = name
+        self.shape = shape
+        self.alert_on = alert_on
+        coords = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self.lat = coords[:, 0]
+        self.lon = coords[:, 1]
+        self.radius_m = radius_m
+        if shape == 'circle':
+            dlat = math.degrees(radius_m / 6371008.8)
+            dlon = dlat / max(math.cos(math.radians(self.lat[0])), 1e-6)
+            self.bbox = (self.lat[0] - dlat, self.lon[0] - dlon, self.lat[0] + dlat, self.lon[0] + dlon)
+        else:
+            self.bbox = (self.lat.min(), self.lon.min(), self.lat.max(), self.lon.max())
+
+    def applies_to(self, truck_id, owner_id):
+        return self.owner_id == owner_id and (self.truck_id is None or self.truck_id == truck_id)
+
+    def contains(self, lat, lon):
+        if self.shape == 'circle':
+            return haversine(self.lat[0], self.lon[0], lat, lon) <= self.radius_m
+        # Even-odd ray casting, every point against every edge at once.
+        y1, x1 = self.lat, self.lon
+        y2, x2 = np.roll(y1, -1), np.roll(x1, -1)
+        py, px = lat[:, None], lon[:, None]
+        crosses = (y1 > py) != (y2 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_at = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        return np.count_nonzero(crosses & (px < x_at), axis=1) % 2 == 1
+
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'truck_id': self.truck_id,
+            'shape': self.shape,
+            'alert_on': self.alert_on,
+        }
+        if self.shape == 'circle':
+            data['center'] = [float(self.lat[0]), float(self.lon[0])]
+            data['radius_m'] = self.radius_m
+        else:
+            data['coordinates'] = np.column_stack((self.lat, self.lon)).tolist()
+        return data
+
+
+class FenceIndex:
+    # Uniform lat/lon grid: each fence is listed under every cell its bounding box
+    # touches, so a point only tests the fences registered in its own cell.
+    def __init__(self, fences, cell_degrees=GRID_DEGREES, max_cells=MAX_CELLS_PER_FENCE):
+        self.cell_degrees = cell_degrees
+        self.fences = {fence.id: fence for fence in fences}
+        self.cells = defaultdict(list)
+        self.large = []
+        for fence in fences:
+            min_lat, min_lon, max_lat, max_lon = fence.bbox
+            r0, c0 = self._cell(min_lat, min_lon)
+            r1, c1 = self._cell(max_lat, max_lon)
+            if (r1 - r0 + 1) * (c1 - c0 + 1) > max_cells:
+                self.large.append(fence)
+                continue
+            for row in range(r0, r1 + 1):
+                for col in range(c0, c1 + 1):
+                    self.cells[(row, col)].append(fence)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lon / self.cell_degrees))
+
+    def match(self, truck_ids, lat, lon, owners):
+        # Returns {fence_id: indices of the points inside it}, only considering fences
+        # that apply to each point's truck.
+        candidates = defaultdict(list)
+        rows = np.floor(lat / self.cell_degrees).astype(np.int64).tolist()
+        cols = np.floor(lon / self.cell_degrees).astype(np.int64).tolist()
+        for i, key in enumerate(zip(rows, cols)):
+            fences = self.cells.get(key)
+            if fences:
+                truck_id = truck_ids[i]
+                owner_id = owners.get(truck_id)
+                for fence in fences:
+                    if fence.applies_to(truck_id, owner_id):
+                        candidates[fence.id].append(i)
+        for fence in self.large:
+            min_lat, min_lon, max_lat, max_lon = fence.bbox
+            in_box = np.flatnonzero((lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon))
+            hits = [i for i in in_box.tolist() if fence.applies_to(truck_ids[i], owners.get(truck_ids[i]))]
+            if hits:
+                candidates[fence.id].extend(hits)
+
+        inside = {}
+        for fence_id, indices in candidates.items():
+            indices = np.asarray(indices)
+            hits = indices[self.fences[fence_id].contains(lat[indices], lon[indices])]
+            if len(hits):
+                inside[fence_id] = set(hits.tolist())
+        return inside
+
+
+_lock = threading.Lock()
+_index = None
+_loaded_at = 0.0
+
+
+def invalidate():
+    global _index
+    with _lock:
+        _index = None
+
+
+# Fence edits from any process arrive through the LISTEN thread; processes without a
+# listener (CLI, ingest gateways) rely on GEOFENCE_INDEX_TTL instead.
+events.on_notify('geofences_changed', lambda payload: invalidate())
+
+
+def load_fences(cur, owner_id=None):
+    query = 'SELECT id, owner_id, truck_id, name, shape, coordinates, radius_m, alert_on FROM geofences'
+    params = ()
+    if owner_id is not None:
+        query += ' WHERE owner_id = %s ORDER BY id'
+        params = (owner_id,)
+    cur.execute(query, params)
+    return [Fence(*row) for row in cur.fetchall()]
+
+
+def get_index(cur):
+    global _index, _loaded_at
+    with _lock:
+        if _index is None or time.monotonic() - _loaded_at > INDEX_TTL:
+            _index = FenceIndex(load_fences(cur))
+            _loaded_at = time.monotonic()
+        return _index
+
+
+def parse_geofence(data):
+    if not isinstance(data, dict):
+        raise GeofenceError('expected a JSON object')
+    name = str(data.get('name') or '').strip()
+    if not name or len(name) > 100:
+        raise GeofenceError('name is required (at most 100 characters)')
+    shape = data.get('shape')
+    if shape not in SHAPES:
+        raise GeofenceError('shape must be one of %s' % ', '.join(SHAPES))
+    alert_on = data.get('alert_on', 'both')
+    if alert_on not in ALERT_ON:
+        raise GeofenceError('alert_on must be one of %s' % ', '.join(ALERT_ON))
+    truck_id = data.get('truck_id')
+    if truck_id is not None and not isinstance(truck_id, int):
+        raise GeofenceError('truck_id must be an integer')
+
+    radius_m = None
+    try:
+        if shape == 'circle':
+            coordinates = [[float(v) for v in data['center']]]
+            radius_m = float(data['radius_m'])
+            if radius_m <= 0:
+                raise GeofenceError('radius_m must be positive')
+        else:
+            coordinates = [[float(v) for v in vertex] for vertex in data['coordinates']]
+            if not 3 <= len(coordinates) <= MAX_POLYGON_VERTICES:
+                raise GeofenceError('a polygon needs 3 to %d vertices' % MAX_POLYGON_VERTICES)
+    except GeofenceError:
+        raise
+    except (KeyError, TypeError, ValueError):
+        raise GeofenceError('circle needs center [lat, lon] and radius_m; polygon needs coordinates [[lat, lon], ...]')
+    for coordinate in coordinates:
+        if len(coordinate) != 2 or not (-90 <= coordinate[0] <= 90 and -180 <= coordinate[1] <= 180):
+            raise GeofenceError('coordinates must be [lat, lon] pairs in range')
+    return {
+        'name': name,
+        'truck_id': truck_id,
+        'shape': shape,
+        'coordinates': coordinates,
+        'radius_m': radius_m,
+        'alert_on': alert_on,
+    }
+
+
+def _debounce(state, observations):
+    # A transition is confirmed once DEBOUNCE_POINTS consecutive points, spanning at
+    # least DEBOUNCE_SECONDS, disagree with the stored side of the fence.
+    inside, count, since, updated_at = state
+    transitions = []
+    for ts, observed in observations:
+        if updated_at is not None and ts <= updated_at:
+            continue
+        updated_at = ts
+        if observed == inside:
+            count, since = 0, None
+            continue
+        if count == 0:
+            since = ts
+        count += 1
+        if count >= DEBOUNCE_POINTS and (ts - since).total_seconds() >= DEBOUNCE_SECONDS:
+            transitions.append((since, observed))
+            inside, count, since = observed, 0, None
+    return (inside, count, since, updated_at), transitions
+
+
+def evaluate_points(cur, points):
+    # points are ingest tuples (truck_id, lat, lon, timestamp, speed). Returns the
+    # number of alerts raised. A missing geofence_state row means "outside, settled".
+    if not points:
+        return 0
+    index = get_index(cur)
+    if not index.fences:
+        return 0
+
+    points = sorted(points, key=lambda p: (p[0], p[3]))
+    truck_ids = [p[0] for p in points]
+    lat = np.fromiter((p[1] for p in points), dtype=np.float64, count=len(points))
+    lon = np.fromiter((p[2] for p in points), dtype=np.float64, count=len(points))
+
+    cur.execute('SELECT id, owner_id, truck_number FROM trucks WHERE id = ANY(%s)', (list(set(truck_ids)),))
+    trucks = {row[0]: row[1:] for row in cur.fetchall()}
+    inside = index.match(truck_ids, lat, lon, {truck_id: owner for truck_id, (owner, _) in trucks.items()})
+
+    cur.execute('''
+        SELECT truck_id, geofence_id, inside, pending_count, pending_since, updated_at
+        FROM geofence_state WHERE truck_id = ANY(%s)
+        ORDER BY truck_id, geofence_id FOR UPDATE
+    ''', (list(trucks),))
+    states = {(row[0], row[1]): row[2:] for row in cur.fetchall()}
+
+    spans = {}
+    for i, truck_id in enumerate(truck_ids):
+        start, _ = spans.get(truck_id, (i, i))
+        spans[truck_id] = (start, i + 1)
+
+    pairs = set(states)
+    for fence_id, indices in inside.items():
+        pairs.update((truck_ids[i], fence_id) for i in indices)
+
+    upserts, deletes, alerts = [], [], []
+    for truck_id, fence_id in pairs:
+        fence = index.fences.get(fence_id)
+        if fence is None or truck_id not in spans:
+            continue
+        start, end = spans[truck_id]
+        hits = inside.get(fence_id, ())
+        observations = [(points[i][3], i in hits) for i in range(start, end)]
+        before = states.get((truck_id, fence_id), (False, 0, None, None))
+        after, transitions = _debounce(before, observations)
+        if after == before:
+            continue
+        if after[0] or after[1]:
+            upserts.append((truck_id, fence_id) + after)
+        elif (truck_id, fence_id) in states:
+            deletes.append((truck_id, fence_id))
+        truck_number = trucks[truck_id][1]
+        for ts, entered in transitions:
+            if fence.alert_on != 'both' and fence.alert_on != ('enter' if entered else 'exit'):
+                continue
+            alerts.append((
+                truck_id,
+                'Geofence Alert',
+                '%s %s %s at %s' % (truck_number, 'entered' if entered else 'left', fence.name, ts.strftime('%Y-%m-%d %H:%M')),
+                'high' if entered else 'medium',
+            ))
+
+    if upserts:
+        psycopg2.extras.execute_values(cur, '''
+            INSERT INTO geofence_state (truck_id, geofence_id, inside, pending_count, pending_since, updated_at)
+            VALUES %s
+            ON CONFLICT (truck_id, geofence_id) DO UPDATE SET
+                inside = EXCLUDED.inside,
+                pending_count = EXCLUDED.pending_count,
+                pending_since = EXCLUDED.pending_since,
+                updated_at = EXCLUDED.updated_at
+        ''', upserts)
+    if deletes:
+        psycopg2.extras.execute_values(cur, '''
+            DELETE FROM geofence_state s USING (VALUES %s) AS d(truck_id, geofence_id)
+            WHERE s.truck_id = d.truck_id AND s.geofence_id = d.geofence_id
+        ''', deletes)
+    raise_alerts(cur, alerts)
+    return len(alerts)
@@ -0,0 +1,224 @@
+import os
+import re
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+PARTITION_PREFIX = 'gps_locations_p'
+DEFAULT_PARTITION = 'gps_locations_default'
+ARCHIVE_SCHEMA = 'gps_archive'
+
+PARTITION_DAYS_AHEAD = int(os.getenv('GPS_PARTITION_DAYS_AHEAD', '7'))
+RETENTION_DAYS = int(os.getenv('GPS_RETENTION_DAYS', '90'))
+RETENTION_MODE = os.getenv('GPS_RETENTION_MODE', 'drop')
+ROLLUP_LATE_GRACE = timedelta(hours=int(os.getenv('GPS_ROLLUP_LATE_GRACE_HOURS', '2')))
+
+# Span thresholds used by read_history to pick the cheapest resolution.
+RAW_HISTORY_SPAN = timedelta(hours=6)
+MINUTE_HISTORY_SPAN = timedelta(days=7)
+
+
+def partition_name(day):
+    return '%s%s' % (PARTITION_PREFIX, day.strftime('%Y%m%d'))
+
+
+def partition_day(name):
+    match = re.fullmatch(PARTITION_PREFIX + r'(\d{8})', name)
+    return datetime.strptime(match.group(1), '%Y%m%d').date() if match else None
+
+
+def list_partitions(cur):
+    cur.execute('''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'gps_locations' AND p.relkind = 'p'
+    ''')
+    days = [partition_day(row[0]) for row in cur.fetchall()]
+    return sorted(day for day in days if day is not None)
+
+
+def create_partition(cur, day):
+    name = partition_name(day)
+    start, end = day, day + timedelta(days=1)
+    cur.execute('SELECT to_regclass(%s) IS NOT NULL', (name,))
+    if cur.fetchone()[0]:
+        return False
+
+    # Rows that landed in the default partition for this day must move out before the
+    # range can be attached, otherwise Postgres rejects the new partition.
+    cur.execute(
+        'SELECT EXISTS (SELECT 1 FROM ' + DEFAULT_PARTITION + ' WHERE timestamp >= %s AND timestamp < %s)',
+        (start, end)
+    )
+    if cur.fetchone()[0]:
+        cur.execute('CREATE TABLE %s (LIKE gps_locations INCLUDING DEFAULTS INCLUDING CONSTRAINTS)' % name)
+        cur.execute(
+            'WITH moved AS (DELETE FROM ' + DEFAULT_PARTITION + ' WHERE timestamp >= %s AND timestamp < %s RETURNING *) '
+            'INSERT INTO ' + name + ' SELECT * FROM moved',
+            (start, end)
+        )
+        cur.execute(
+            'ALTER TABLE gps_locations ATTACH PARTITION ' + name + ' FOR VALUES FROM (%s) TO (%s)',
+            (start, end)
+        )
+    else:
+        cur.execute(
+            'CREATE TABLE ' + name + ' PARTITION OF gps_locations FOR VALUES FROM (%s) TO (%s)',
+            (start, end)
+        )
+    return True
+
+
+def ensure_partitions(cur, start_day=None, days_ahead=PARTITION_DAYS_AHEAD):
+    today = datetime.now(timezone.utc).date()
+    start_day = start_day or today - timedelta(days=1)
+    created = []
+    day = start_day
+    while day <= today + timedelta(days=days_ahead):
+        if create_partition(cur, day):
+            created.append(day)
+        day += timedelta(days=1)
+    return created
+
+
+def compact_rollups(cur, since, until):
+    # Buckets are recomputed whole, so since/until are aligned to hours and re-running is idempotent.
+    since = since.replace(minute=0, second=0, microsecond=0)
+    until = until.replace(minute=0, second=0, microsecond=0)
+    if since >= until:
+        return 0
+    cur.execute('''
+        INSERT INTO gps_rollups_minute (truck_id, bucket, point_count, latitude, longitude, first_at, last_at)
+        SELECT truck_id, date_trunc('minute', timestamp), count(*),
+               (array_agg(latitude ORDER BY timestamp DESC))[1],
+               (array_agg(longitude ORDER BY timestamp DESC))[1],
+               min(timestamp), max(timestamp)
+        FROM gps_locations
+        WHERE timestamp >= %s AND timestamp < %s
+        GROUP BY 1, 2
+        ON CONFLICT (truck_id, bucket) DO UPDATE SET
+            point_count = EXCLUDED.point_count,
+            latitude = EXCLUDED.latitude,
+            longitude = EXCLUDED.longitude,
+            first_at = EXCLUDED.first_at,
+            last_at = EXCLUDED.last_at
+    ''', (since, until))
+    minute_rows = cur.rowcount
+    cur.execute('''
+        INSERT INTO gps_rollups_hour (truck_id, bucket, point_count, latitude, longitude, first_at, last_at)
+        SELECT truck_id, date_trunc('hour', bucket), sum(point_count),
+               (array_agg(latitude ORDER BY bucket DESC))[1],
+               (array_agg(longitude ORDER BY bucket DESC))[1],
+               min(first_at), max(last_at)
+        FROM gps_rollups_minute
+        WHERE bucket >= %s AND bucket < %s
+        GROUP BY 1, 2
+        ON CONFLICT (truck_id, bucket) DO UPDATE SET
+            point_count = EXCLUDED.point_count,
+            latitude = EXCLUDED.latitude,
+            longitude = EXCLUDED.longitude,
+            first_at = EXCLUDED.first_at,
+            last_at = EXCLUDED.last_at
+    ''', (since, until))
+    return minute_rows
+
+
+def run_compaction(conn, now=None):
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    cur = conn.cursor()
+    cur.execute('SELECT compacted_until FROM gps_rollup_progress')
+    row = cur.fetchone()
+    if row and row[0]:
+        since = row[0] - ROLLUP_LATE_GRACE
+    else:
+        cur.execute('SELECT min(timestamp) FROM gps_locations')
+        since = cur.fetchone()[0] or now
+    until = now.replace(minute=0, second=0, microsecond=0)
+
+    total = 0
+    # One transaction per day keeps each compaction step short.
+    while since < until:
+        step_end = min(since + timedelta(days=1), until)
+        total += compact_rollups(cur, since, step_end)
+        cur.execute('''
+            INSERT INTO gps_rollup_progress (id, compacted_until) VALUES (TRUE, %s)
+            ON CONFLICT (id) DO UPDATE SET compacted_until = GREATEST(gps_rollup_progress.compacted_until, EXCLUDED.compacted_until)
+        ''', (step_end,))
+        conn.commit()
+        since = step_end
+    cur.close()
+    return total
+
+
+def apply_retention(conn, retain_days=RETENTION_DAYS, mode=RETENTION_MODE):
+    if mode not in ('drop', 'archive'):
+        raise ValueError('retention mode must be drop or archive, not %r' % mode)
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=retain_days)
+    cur = conn.cursor()
+
+    # Never discard raw points the rollups have not absorbed yet.
+    cur.execute('SELECT compacted_until FROM gps_rollup_progress')
+    row = cur.fetchone()
+    compacted_until = row[0].date() if row and row[0] else date.min
+    cutoff = min(cutoff, compacted_until)
+
+    expired = [day for day in list_partitions(cur) if day < cutoff]
+    if mode == 'archive' and expired:
+        cur.execute('CREATE SCHEMA IF NOT EXISTS ' + ARCHIVE_SCHEMA)
+    for day in expired:
+        name = partition_name(day)
+        if mode == 'archive':
+            cur.execute('ALTER TABLE gps_locations DETACH PARTITION ' + name)
+            cur.execute('ALTER TABLE %s SET SCHEMA %s' % (name, ARCHIVE_SCHEMA))
+        else:
+            cur.execute('DROP TABLE ' + name)
+        conn.commit()
+
+    cur.execute('DELETE FROM ' + DEFAULT_PARTITION + ' WHERE timestamp < %s', (cutoff,))
+    conn.commit()
+    cur.close()
+    return expired
+
+
+def read_history(cur, truck_id, start, end, archived=None):
+    span = end - start
+    # Points come back as an (n, 3) array of (latitude, longitude, epoch seconds).
+    # archived(cur, truck_id, start, end) supplies raw points moved out of the table.
+    raw_query = '''
+        SELECT latitude::float8, longitude::float8, extract(epoch FROM timestamp)::float8 FROM gps_locations
+        WHERE truck_id = %s AND timestamp >= %s AND timestamp < %s
+        ORDER BY timestamp
+    '''
+
+    def raw(since, until):
+        cur.execute(raw_query, (truck_id, since, until))
+        points = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 3)
+        if archived is not None:
+            old = archived(cur, truck_id, since, until)
+            if len(old):
+                points = np.concatenate((old, points))
+                points = points[np.argsort(points[:, 2], kind='stable')]
+        return points
+
+    if span <= RAW_HISTORY_SPAN:
+        return 'raw', raw(start, end)
+
+    cur.execute('SELECT compacted_until FROM gps_rollup_progress')
+    row = cur.fetchone()
+    compacted_until = min(row[0], end) if row and row[0] else start
+    if compacted_until <= start:
+        return 'raw', raw(start, end)
+
+    resolution = 'minute' if span <= MINUTE_HISTORY_SPAN else 'hour'
+    cur.execute('''
+        SELECT latitude::float8, longitude::float8, extract(epoch FROM last_at)::float8 FROM gps_rollups_''' + resolution + '''
+        WHERE truck_id = %s AND bucket >= %s AND bucket < %s
+        ORDER BY bucket
+    ''', (truck_id, start, compacted_until))
+    points = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 3)
+    # The newest stretch has not been compacted yet; read it raw so history has no gap.
+    if compacted_until < end:
+        points = np.concatenate((points, raw(max(start, compacted_until), end)))
+    return resolution, points
@@ -0,0 +1,16 @@
+# gunicorn -c gunicorn_gevent.py app:app
+# Gevent workers hold each request, including every open SSE stream, as a greenlet,
+# so one worker serves thousands of subscribers. psycopg2 blocks inside libpq, which
+# gevent cannot see; psycogreen routes its socket waits through the gevent hub so a
+# query only suspends its own greenlet. Do not combine with --preload: the app must
+# be imported after the worker has patched the standard library.
+import os
+
+from psycogreen.gevent import patch_psycopg
+
+worker_class = 'gevent'
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '5000'))
+
+
+def post_fork(server, worker):
+    patch_psycopg()
@@ -0,0 +1,178 @@
+import csv
+import gzip
+import hmac
+import io
+import json
+import os
+import struct
+from datetime import datetime, timezone
+
+from fleet_state import latest_by_truck, record_positions
+from geofence import evaluate_points
+
+CHUNK_SIZE = 5000
+MAX_ERRORS_REPORTED = 20
+
+# Binary frames: truck_id int32, latitude float64, longitude float64, epoch milliseconds int64 (0 = now).
+BINARY_POINT = struct.Struct('<iddq')
+
+
+class IngestError(ValueError):
+    pass
+
+
+def ingest_authorized(authorization):
+    api_key = os.getenv('INGEST_API_KEY')
+    if not api_key or not authorization:
+        return False
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer':
+        return False
+    return hmac.compare_digest(token.strip().encode(), api_key.encode())
+
+
+def parse_timestamp(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise IngestError('timestamp must be a string or a number, not %s' % type(value).__name__)
+    try:
+        if isinstance(value, (int, float)) or (isinstance(value, str) and value.replace('.', '', 1).isdigit()):
+            return datetime.fromtimestamp(float(value), timezone.utc).replace(tzinfo=None)
+        ts = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if ts.tzinfo is not None:
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        return ts
+    except (OverflowError, OSError):
+        # Epochs beyond what datetime (or the platform's time functions) can represent.
+        raise IngestError('timestamp out of range: %s' % value)
+
+
+def make_point(truck_id, latitude, longitude, timestamp=None, speed=None):
+    truck_id = int(truck_id)
+    latitude = float(latitude)
+    longitude = float(longitude)
+    speed = float(speed) if speed not in (None, '') else None
+    if not -90.0 <= latitude <= 90.0:
+        raise IngestError('latitude out of range: %s' % latitude)
+    if not -180.0 <= longitude <= 180.0:
+        raise IngestError('longitude out of range: %s' % longitude)
+    if speed is not None and speed < 0:
+        raise IngestError('speed must not be negative: %s' % speed)
+    return (truck_id, latitude, longitude, parse_timestamp(timestamp), speed)
+
+
+def iter_jsonl(lines):
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            obj = json.loads(line)
+            yield lineno, make_point(obj['truck_id'], obj['latitude'], obj['longitude'], obj.get('timestamp'), obj.get('speed'))
+        except (KeyError, TypeError, ValueError) as e:
+            yield lineno, IngestError('line %d: %s' % (lineno, e))
+
+
+def iter_csv(lines):
+    for lineno, row in enumerate(csv.reader(lines), 1):
+        if not row:
+            continue
+        if lineno == 1 and row[0].strip() == 'truck_id':
+            continue
+        try:
+            if len(row) not in (3, 4, 5):
+                raise IngestError('expected truck_id,latitude,longitude[,timestamp[,speed]]')
+            yield lineno, make_point(*row)
+        except (TypeError, ValueError) as e:
+            yield lineno, IngestError('line %d: %s' % (lineno, e))
+
+
+def iter_binary(stream):
+    index = 0
+    while True:
+        block = stream.read(BINARY_POINT.size * 4096)
+        if not block:
+            return
+        if len(block) % BINARY_POINT.size:
+            rest = stream.read(BINARY_POINT.size - len(block) % BINARY_POINT.size)
+            block += rest
+            if len(block) % BINARY_POINT.size:
+                index += 1
+                yield index, IngestError('truncated binary frame at point %d' % index)
+                block = block[:len(block) - len(block) % BINARY_POINT.size]
+        for truck_id, lat, lon, epoch_ms in BINARY_POINT.iter_unpack(block):
+            index += 1
+            try:
+                yield index, make_point(truck_id, lat, lon, epoch_ms / 1000.0 if epoch_ms else None)
+            except ValueError as e:
+                yield index, IngestError('point %d: %s' % (index, e))
+
+
+def point_reader(mimetype, stream, content_encoding=None):
+    if content_encoding == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream)
+    elif content_encoding not in (None, '', 'identity'):
+        raise IngestError('unsupported content encoding: %s' % content_encoding)
+
+    if mimetype in ('application/x-ndjson', 'application/jsonl', 'application/json'):
+        return iter_jsonl(io.TextIOWrapper(stream, encoding='utf-8'))
+    if mimetype == 'text/csv':
+        return iter_csv(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+    if mimetype == 'application/octet-stream':
+        return iter_binary(stream)
+    raise IngestError('unsupported content type: %s' % mimetype)
+
+
+def _copy_chunk(cur, chunk):
+    buf = io.StringIO()
+    for truck_id, lat, lon, ts, speed in chunk:
+        buf.write('%d\t%.8f\t%.8f\t%s\t%s\n' % (truck_id, lat, lon, ts.isoformat(), '\\N' if speed is None else repr(speed)))
+    buf.seek(0)
+    cur.copy_expert('COPY gps_locations (truck_id, latitude, longitude, timestamp, speed) FROM STDIN', buf)
+
+
+def copy_gps_points(cur, reader, max_points=None, chunk_size=CHUNK_SIZE):
+    cur.execute("SELECT timezone('UTC', now())")
+    received_at = cur.fetchone()[0]
+    known_trucks = set()
+    accepted = 0
+    rejected = 0
+    errors = []
+    chunk = []
+    latest = {}
+
+    def flush():
+        nonlocal accepted, rejected
+        unseen = {p[0] for p in chunk} - known_trucks
+        if unseen:
+            cur.execute('SELECT id FROM trucks WHERE id = ANY(%s)', (list(unseen),))
+            known_trucks.update(row[0] for row in cur.fetchall())
+        valid = [p if p[3] is not None else p[:3] + (received_at, p[4]) for p in chunk if p[0] in known_trucks]
+        for p in chunk:
+            if p[0] not in known_trucks and len(errors) < MAX_ERRORS_REPORTED:
+                errors.append('unknown truck_id %d' % p[0])
+        rejected += len(chunk) - len(valid)
+        if valid:
+            _copy_chunk(cur, valid)
+            latest_by_truck(valid, latest)
+            evaluate_points(cur, valid)
+            accepted += len(valid)
+        chunk.clear()
+
+    for position, item in reader:
+        if isinstance(item, IngestError):
+            rejected += 1
+            if len(errors) < MAX_ERRORS_REPORTED:
+                errors.append(str(item))
+            continue
+        if max_points is not None and accepted + rejected + len(chunk) >= max_points:
+            raise IngestError('batch exceeds %d points' % max_points)
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    record_positions(cur, latest)
+
+    return {'accepted': accepted, 'rejected': rejected, 'errors': errors}
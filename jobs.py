@@ -0,0 +1,553 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import psycopg2
+import psycopg2.extras
+
+from alerting import raise_alerts
+from analytics import analyze_fleet, previous_hour
+from archive import archive_history
+from gps_storage import apply_retention, ensure_partitions, run_compaction
+from recordings import last_write
+
+logger = logging.getLogger(__name__)
+
+# Jobs run on a thread pool in whichever processes run a scheduler: web processes
+# with JOBS_IN_PROCESS=1, or a `flask run-jobs` sidecar. Each job is a row in
+# scheduled_jobs; a scheduler runs it only after leasing the row, so one run happens
+# per due time however many processes are polling. Job times (run stamps, leases,
+# schedules) are naive UTC from the database clock, timezone('UTC', now()), whatever
+# the session's TimeZone, matching the UTC of GPS timestamps and recording files.
+JOBS_IN_PROCESS = os.getenv('JOBS_IN_PROCESS', '0') == '1'
+JOBS_WORKERS = int(os.getenv('JOBS_WORKERS', '2'))
+JOBS_POLL_SECONDS = float(os.getenv('JOBS_POLL_SECONDS', '5'))
+# A lease is renewed every poll while its job runs, so it only expires (and another
+# process takes the job over) when the process holding it is gone.
+JOBS_LEASE_SECONDS = float(os.getenv('JOBS_LEASE_SECONDS', '60'))
+JOBS_HISTORY_DAYS = int(os.getenv('JOBS_HISTORY_DAYS', '30'))
+# Trucks per transaction in fleet sweeps.
+JOBS_CHUNK_SIZE = int(os.getenv('JOBS_CHUNK_SIZE', '500'))
+STALE_GPS_MINUTES = float(os.getenv('STALE_GPS_MINUTES', '15'))
+CAMERA_OFFLINE_MINUTES = float(os.getenv('CAMERA_OFFLINE_MINUTES', '5'))
+
+
+class JobError(ValueError):
+    pass
+
+
+class Cron:
+    # Five-field cron expression (minute hour day-of-month month day-of-week) in UTC,
+    # with *, lists, ranges and steps. As in cron, a restricted
+    # day-of-month and day-of-week match when either does.
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise JobError('cron expression needs 5 fields: %r' % expression)
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.FIELDS))
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            spec, _, step = part.partition('/')
+            try:
+                step = int(step) if step else 1
+                if spec == '*':
+                    start, stop = low, high
+                elif '-' in spec:
+                    start, stop = (int(v) for v in spec.split('-', 1))
+                else:
+                    start = int(spec)
+                    stop = high if step > 1 else start
+            except ValueError:
+                raise JobError('bad cron field %r' % field)
+            if step < 1 or not low <= start <= stop <= high:
+                raise JobError('cron field %r must be within %d-%d' % (field, low, high))
+            values.update(range(start, stop + 1, step))
+        return values
+
+    def _day_matches(self, t):
+        day = t.day in self.days
+        weekday = t.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, t):
+        t = t.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Skips whole months, days and hours that cannot match; a few thousand steps
+        # cover any expression that matches at all within five years.
+        for _ in range(100000):
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise JobError('cron expression %r never matches' % self.expression)
+
+    def __str__(self):
+        return 'cron %s' % self.expression
+
+
+class Every:
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise JobError('interval must be positive')
+        self.seconds = seconds
+
+    def next_after(self, t):
+        return t + timedelta(seconds=self.seconds)
+
+    def __str__(self):
+        return 'every %gs' % self.seconds
+
+
+class Job:
+    def __init__(self, name, run, every=None, cron=None):
+        if (every is None) == (cron is None):
+            raise JobError('%s: give exactly one of every and cron' % name)
+        self.name = name
+        self.run = run
+        self.schedule = Every(every) if every is not None else Cron(cron)
+
+
+class JobRun:
+    # Passed to the job function. since is when the last successful run started (None
+    # before the first); sweeps check stopped between chunks and return early when
+    # the scheduler shuts down or the lease is lost.
+    def __init__(self, job, started_at, since):
+        self.job = job
+        self.started_at = started_at
+        self.since = since
+        self.stopped = threading.Event()
+
+
+SYNC_JOBS_QUERY = '''
+    INSERT INTO scheduled_jobs (name, schedule, next_run_at) VALUES %s
+    ON CONFLICT (name) DO UPDATE SET
+        schedule = EXCLUDED.schedule,
+        next_run_at = CASE WHEN scheduled_jobs.schedule = EXCLUDED.schedule
+                           THEN scheduled_jobs.next_run_at ELSE EXCLUDED.next_run_at END
+'''
+
+# Due, unleased rows are taken oldest first; rows another scheduler is claiming are
+# skipped rather than waited for.
+CLAIM_JOBS_QUERY = '''
+    UPDATE scheduled_jobs j SET
+        lease_owner = %(owner)s,
+        lease_expires_at = timezone('UTC', now()) + %(lease)s * interval '1 second',
+        last_started_at = timezone('UTC', now())
+    WHERE j.name IN (
+        SELECT name FROM scheduled_jobs
+        WHERE name = ANY(%(names)s) AND (%(force)s OR (enabled AND next_run_at <= timezone('UTC', now())))
+          AND (lease_expires_at IS NULL OR lease_expires_at <= timezone('UTC', now()))
+        ORDER BY next_run_at
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING j.name, j.last_started_at, j.last_success_at
+'''
+
+RENEW_LEASES_QUERY = '''
+    UPDATE scheduled_jobs SET lease_expires_at = timezone('UTC', now()) + %s * interval '1 second'
+    WHERE lease_owner = %s AND name = ANY(%s)
+    RETURNING name
+'''
+
+FINISH_JOB_QUERY = '''
+    UPDATE scheduled_jobs SET
+        lease_owner = NULL,
+        lease_expires_at = NULL,
+        next_run_at = GREATEST(%(next_run_at)s, timezone('UTC', now())),
+        last_finished_at = timezone('UTC', now()),
+        last_status = %(status)s,
+        last_seconds = %(seconds)s,
+        last_success_at = CASE WHEN %(status)s = 'succeeded' THEN last_started_at ELSE last_success_at END
+    WHERE name = %(name)s AND lease_owner = %(owner)s
+'''
+
+JOB_HISTORY_QUERY = '''
+    SELECT started_at, seconds, status, worker, result, error FROM job_runs
+    WHERE job_name = %s ORDER BY started_at DESC LIMIT %s
+'''
+
+RECORD_RUN_QUERY = '''
+    INSERT INTO job_runs (job_name, worker, started_at, finished_at, seconds, status, result, error)
+    VALUES (%(name)s, %(owner)s, %(started_at)s, timezone('UTC', now()), %(seconds)s, %(status)s, %(result)s, %(error)s)
+'''
+
+
+def sync_jobs(cur, jobs):
+    # Registers the jobs this process knows. A changed schedule takes effect from now;
+    # otherwise the stored next run stands.
+    cur.execute("SELECT timezone('UTC', now())")
+    now = cur.fetchone()[0]
+    psycopg2.extras.execute_values(cur, SYNC_JOBS_QUERY, [
+        (job.name, str(job.schedule), now if isinstance(job.schedule, Every) else job.schedule.next_after(now))
+        for job in jobs
+    ])
+
+
+def truck_chunks(conn, run, chunk_size=JOBS_CHUNK_SIZE):
+    # Yields (first id, last id) of consecutive id-ordered trucks; the caller commits
+    # its work per chunk, so a sweep of the whole fleet never holds one long transaction.
+    cur = conn.cursor()
+    last_id = 0
+    try:
+        while not run.stopped.is_set():
+            cur.execute('SELECT id FROM trucks WHERE id > %s ORDER BY id LIMIT %s', (last_id, chunk_size))
+            ids = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            if not ids:
+                break
+            yield ids[0], ids[-1]
+            last_id = ids[-1]
+    finally:
+        cur.close()
+
+
+def _threshold_window(run, minutes):
+    # Things that crossed the threshold since the previous successful run; each is
+    # alerted once, when first found.
+    threshold = timedelta(minutes=minutes)
+    since = run.since or run.started_at - timedelta(seconds=run.job.schedule.seconds)
+    return since - threshold, run.started_at - threshold
+
+
+def sweep_stale_gps(conn, run):
+    start, end = _threshold_window(run, STALE_GPS_MINUTES)
+    cur = conn.cursor()
+    summary = {'chunks': 0, 'alerts': 0}
+    for first_id, last_id in truck_chunks(conn, run):
+        cur.execute('''
+            SELECT t.id, t.truck_number, s.reported_at FROM trucks t
+            JOIN truck_state s ON s.truck_id = t.id
+            WHERE t.id BETWEEN %s AND %s AND t.status = 'active'
+              AND s.reported_at >= %s AND s.reported_at < %s
+        ''', (first_id, last_id, start, end))
+        alerts = [
+            (truck_id, 'GPS Signal Lost', '%s has not reported a position since %s' % (
+                truck_number, reported_at.strftime('%Y-%m-%d %H:%M')), 'medium')
+            for truck_id, truck_number, reported_at in cur.fetchall()
+        ]
+        raise_alerts(cur, alerts)
+        conn.commit()
+        summary['chunks'] += 1
+        summary['alerts'] += len(alerts)
+    cur.close()
+    return summary
+
+
+def sweep_offline_cameras(conn, run):
+    # A camera is offline when its recording in progress has not grown for
+    # CAMERA_OFFLINE_MINUTES (or never received a byte in that time). recorded_at
+    # defaults to CURRENT_TIMESTAMP in the session's zone, so it is converted to UTC
+    # to compare with the run and the file's mtime.
+    start, end = _threshold_window(run, CAMERA_OFFLINE_MINUTES)
+    cur = conn.cursor()
+    summary = {'recordings': 0, 'alerts': 0}
+    for first_id, last_id in truck_chunks(conn, run):
+        cur.execute('''
+            SELECT r.truck_id, t.truck_number, r.camera_number, r.file_path,
+                   timezone('UTC', r.recorded_at::timestamptz)
+            FROM video_recordings r JOIN trucks t ON t.id = r.truck_id
+            WHERE r.truck_id BETWEEN %s AND %s AND r.status = 'recording'
+              AND timezone('UTC', r.recorded_at::timestamptz) < %s
+        ''', (first_id, last_id, end))
+        rows = cur.fetchall()
+        conn.commit()
+        alerts = []
+        for truck_id, truck_number, camera_number, file_path, recorded_at in rows:
+            written = last_write(file_path) if file_path else None
+            active_at = max(recorded_at, written) if written else recorded_at
+            if start <= active_at < end:
+                alerts.append((truck_id, 'Camera Offline', 'Camera %d in %s stopped uploading at %s' % (
+                    camera_number, truck_number, active_at.strftime('%Y-%m-%d %H:%M')), 'medium'))
+        raise_alerts(cur, alerts)
+        conn.commit()
+        summary['recordings'] += len(rows)
+        summary['alerts'] += len(alerts)
+    cur.close()
+    return summary
+
+
+def analyze_recent(conn, run):
+    # The previous full hour, stretched back to cover hours missed while no scheduler
+    # ran (up to a day).
+    start, end = previous_hour(run.started_at)
+    if run.since is not None:
+        start = max(min(start, run.since.replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)),
+                    end - timedelta(days=1))
+    summary = analyze_fleet(conn, start, end)
+    summary['window'] = '%s/%s' % (start.isoformat(), end.isoformat())
+    return summary
+
+
+def daily_mileage(conn, run):
+    # The previous UTC day, stretched back to days missed while no scheduler ran (up
+    # to a week). The hourly sweep has alerted on these hours, so only mileage is written.
+    end = run.started_at.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=1)
+    if run.since is not None:
+        start = max(min(start, run.since.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)),
+                    end - timedelta(days=7))
+    summary = analyze_fleet(conn, start, end, alerts=False)
+    summary['window'] = '%s/%s' % (start.isoformat(), end.isoformat())
+    return summary
+
+
+def gps_maintenance(conn, run):
+    cur = conn.cursor()
+    created = ensure_partitions(cur)
+    conn.commit()
+    cur.close()
+    return {
+        'partitions': len(created),
+        'minute_buckets': run_compaction(conn),
+        'expired': [day.isoformat() for day in apply_retention(conn)],
+    }
+
+
+def archive_old_history(conn, run):
+    def progress(line):
+        if run.stopped.is_set():
+            raise JobError('stopped')
+    return archive_history(conn, progress=progress)
+
+
+def prune_job_runs(conn, run):
+    cur = conn.cursor()
+    cur.execute("DELETE FROM job_runs WHERE started_at < timezone('UTC', now()) - %s * interval '1 day'", (JOBS_HISTORY_DAYS,))
+    deleted = cur.rowcount
+    conn.commit()
+    cur.close()
+    return {'deleted': deleted}
+
+
+JOBS = [
+    Job('stale-gps', sweep_stale_gps, every=300),
+    Job('camera-offline', sweep_offline_cameras, every=60),
+    Job('analyze-fleet', analyze_recent, cron='5 * * * *'),
+    Job('daily-mileage', daily_mileage, cron='20 0 * * *'),
+    Job('gps-maintenance', gps_maintenance, cron='15 * * * *'),
+    Job('archive-history', archive_old_history, cron='30 3 * * *'),
+    Job('prune-job-runs', prune_job_runs, cron='45 3 * * *'),
+]
+
+
+def get_job(name):
+    for job in JOBS:
+        if job.name == name:
+            return job
+    raise JobError('unknown job %r; jobs are %s' % (name, ', '.join(job.name for job in JOBS)))
+
+
+class Scheduler(threading.Thread):
+    def __init__(self, dsn, jobs=JOBS, workers=JOBS_WORKERS, poll=JOBS_POLL_SECONDS, lease=JOBS_LEASE_SECONDS):
+        super().__init__(name='job-scheduler', daemon=True)
+        self.dsn = dsn
+        self.jobs = {job.name: job for job in jobs}
+        self.workers = workers
+        self.poll = poll
+        self.lease = lease
+        self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='job')
+        self._running = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._conn = None
+
+    def stop(self, wait=True):
+        self._stopped.set()
+        with self._lock:
+            for run in self._running.values():
+                run.stopped.set()
+        self._executor.shutdown(wait=wait)
+
+    def _cursor(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(self.dsn)
+        return self._conn.cursor()
+
+    def run(self):
+        synced = False
+        while not self._stopped.is_set():
+            try:
+                if not synced:
+                    with self._cursor() as cur:
+                        sync_jobs(cur, self.jobs.values())
+                    self._conn.commit()
+                    synced = True
+                self._renew()
+                self._claim()
+            except psycopg2.Error:
+                logger.exception('job scheduler database error; retrying in %.0fs', self.poll)
+                if self._conn is not None:
+                    self._conn.close()
+            self._stopped.wait(self.poll)
+        if self._conn is not None:
+            self._conn.close()
+
+    def _renew(self):
+        with self._lock:
+            names = list(self._running)
+        if not names:
+            return
+        with self._cursor() as cur:
+            cur.execute(RENEW_LEASES_QUERY, (self.lease, self.owner, names))
+            renewed = {name for (name,) in cur.fetchall()}
+        self._conn.commit()
+        with self._lock:
+            for name in names:
+                if name not in renewed and name in self._running:
+                    logger.warning('lost the lease on job %s; stopping it', name)
+                    self._running[name].stopped.set()
+
+    def _claim(self, force_name=None):
+        with self._lock:
+            free = self.workers - len(self._running)
+        if free <= 0:
+            return []
+        names = [force_name] if force_name else list(self.jobs)
+        with self._cursor() as cur:
+            cur.execute(CLAIM_JOBS_QUERY, {'owner': self.owner, 'lease': self.lease, 'names': names,
+                                           'force': force_name is not None, 'limit': free})
+            claimed = cur.fetchall()
+        self._conn.commit()
+        futures = []
+        for name, started_at, since in claimed:
+            run = JobRun(self.jobs[name], started_at, since)
+            with self._lock:
+                self._running[name] = run
+            futures.append(self._executor.submit(self._execute, run))
+        return futures
+
+    def _execute(self, run):
+        job = run.job
+        started = time.perf_counter()
+        status, result, error = 'succeeded', None, None
+        conn = None
+        try:
+            conn = psycopg2.connect(self.dsn)
+            result = job.run(conn, run)
+            if run.stopped.is_set():
+                status = 'interrupted'
+        except Exception as e:
+            status, error = ('interrupted' if run.stopped.is_set() else 'failed'), '%s: %s' % (type(e).__name__, e)
+            logger.exception('job %s failed', job.name)
+        finally:
+            if conn is not None:
+                conn.close()
+        seconds = time.perf_counter() - started
+        params = {
+            'name': job.name, 'owner': self.owner, 'started_at': run.started_at, 'seconds': seconds,
+            'status': status, 'result': psycopg2.extras.Json(result) if result is not None else None, 'error': error,
+            'next_run_at': job.schedule.next_after(run.started_at + timedelta(seconds=seconds)
+                                                   if isinstance(job.schedule, Cron) else run.started_at),
+        }
+        try:
+            conn = psycopg2.connect(self.dsn)
+            try:
+                cur = conn.cursor()
+                cur.execute(RECORD_RUN_QUERY, params)
+                cur.execute(FINISH_JOB_QUERY, params)
+                if cur.rowcount == 0:
+                    logger.warning('job %s finished after its lease passed to another scheduler', job.name)
+                conn.commit()
+            finally:
+                conn.close()
+        except psycopg2.Error:
+            # The lease runs out and the job runs again at its next due time.
+            logger.exception('could not record the run of job %s', job.name)
+        finally:
+            with self._lock:
+                self._running.pop(job.name, None)
+        return status, seconds, result, error
+
+    def run_now(self, name):
+        # Runs one job immediately in the calling process, unless another scheduler
+        # holds its lease. Returns (status, seconds, result, error), or None.
+        job = get_job(name)
+        self.jobs.setdefault(name, job)
+        with self._cursor() as cur:
+            sync_jobs(cur, [job])
+        self._conn.commit()
+        futures = self._claim(force_name=name)
+        return futures[0].result() if futures else None
+
+
+_scheduler = None
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    # One scheduler per process when JOBS_IN_PROCESS is set, started on first use like
+    # the LISTEN thread.
+    global _scheduler, _scheduler_pid
+    if not JOBS_IN_PROCESS:
+        return None
+    if _scheduler is None or _scheduler_pid != os.getpid():
+        with _scheduler_lock:
+            if _scheduler is None or _scheduler_pid != os.getpid():
+                scheduler = Scheduler(os.getenv('DATABASE_URL'))
+                scheduler.start()
+                _scheduler, _scheduler_pid = scheduler, os.getpid()
+    return _scheduler
+
+
+def job_status(cur):
+    cur.execute('''
+        SELECT name, schedule, enabled, next_run_at, lease_owner, last_started_at, last_status, last_seconds,
+               last_success_at
+        FROM scheduled_jobs ORDER BY name
+    ''')
+    return cur.fetchall()
+
+
+def job_history(cur, name, limit=20):
+    cur.execute(JOB_HISTORY_QUERY, (name, limit))
+    return cur.fetchall()
+
+
+def serve():
+    scheduler = Scheduler(os.getenv('DATABASE_URL'))
+    stopped = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopped.set())
+    scheduler.start()
+    logger.info('job scheduler %s running %d jobs on %d workers', scheduler.owner, len(scheduler.jobs),
+                scheduler.workers)
+    stopped.wait()
+    logger.info('stopping; waiting for running jobs to reach a chunk boundary')
+    scheduler.stop()
+
+
+def main():
+    argparse.ArgumentParser(description='Run scheduled fleet jobs (sidecar to the web processes).').parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    serve()
+
+
+if __name__ == '__main__':
+    main()
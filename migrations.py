@@ -0,0 +1,744 @@
+import psycopg2.extras
+
+from alerting import DASHBOARD_ALERTS_QUERY, refresh_alert_counts
+from dispatch import OWNER_POSITIONS_QUERY
+from fleet_state import FLEET_STATE_QUERY, refresh_truck_state
+from gps_storage import ensure_partitions
+from jobs import JOB_HISTORY_QUERY
+from pagination import (
+    ALERTS_PAGE_QUERY, FACE_DETECTIONS_PAGE_QUERY, FIRST_PAGE, LOCATIONS_PAGE_QUERY, RECORDINGS_PAGE_QUERY,
+)
+from truck_bundle import TRUCK_BUNDLE_QUERY
+
+# Session-level advisory lock key; serializes migrations across workers and deploy hooks.
+MIGRATION_LOCK_ID = 72_614_001
+
+
+def _partition_existing_gps(cur):
+    cur.execute('SELECT min(timestamp)::date FROM gps_locations_unpartitioned')
+    first_day = cur.fetchone()[0]
+    ensure_partitions(cur, start_day=first_day)
+
+
+MIGRATIONS = [
+    (1, 'baseline schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(100) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            email VARCHAR(150) UNIQUE NOT NULL,
+            full_name VARCHAR(150) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS trucks (
+            id SERIAL PRIMARY KEY,
+            truck_number VARCHAR(50) NOT NULL,
+            owner_id INTEGER REFERENCES users(id),
+            license_plate VARCHAR(50),
+            model VARCHAR(100),
+            status VARCHAR(50) DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS drivers (
+            id SERIAL PRIMARY KEY,
+            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
+            name VARCHAR(150) NOT NULL,
+            phone VARCHAR(20),
+            license_number VARCHAR(50),
+            photo_url VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS gps_locations (
+            id SERIAL PRIMARY KEY,
+            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
+            latitude DECIMAL(10, 8) NOT NULL,
+            longitude DECIMAL(11, 8) NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS face_detections (
+            id SERIAL PRIMARY KEY,
+            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
+            driver_id INTEGER REFERENCES drivers(id) ON DELETE SET NULL,
+            image_url VARCHAR(255),
+            confidence DECIMAL(5, 2),
+            match_result VARCHAR(50),
+            detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS alerts (
+            id SERIAL PRIMARY KEY,
+            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
+            alert_type VARCHAR(100) NOT NULL,
+            message TEXT NOT NULL,
+            severity VARCHAR(20) DEFAULT 'medium',
+            is_read BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS video_recordings (
+            id SERIAL PRIMARY KEY,
+            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
+            camera_number INTEGER NOT NULL,
+            file_url VARCHAR(255),
+            file_size BIGINT,
+            duration INTEGER,
+            status VARCHAR(50) DEFAULT 'saved',
+            recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, 'indexes for hot query paths', [
+        'CREATE INDEX IF NOT EXISTS idx_trucks_owner_created ON trucks (owner_id, created_at DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_drivers_truck ON drivers (truck_id)',
+        'CREATE INDEX IF NOT EXISTS idx_gps_truck_timestamp ON gps_locations (truck_id, timestamp DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_alerts_truck_read_created ON alerts (truck_id, is_read, created_at DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_face_detections_truck_detected ON face_detections (truck_id, detected_at DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_recordings_truck_recorded ON video_recordings (truck_id, recorded_at DESC)',
+    ]),
+    (3, 'partition gps_locations by day and add rollups', [
+        'ALTER TABLE gps_locations RENAME TO gps_locations_unpartitioned',
+        'ALTER TABLE gps_locations_unpartitioned RENAME CONSTRAINT gps_locations_pkey TO gps_locations_unpartitioned_pkey',
+        'ALTER INDEX idx_gps_truck_timestamp RENAME TO idx_gps_truck_timestamp_unpartitioned',
+        'ALTER SEQUENCE gps_locations_id_seq AS BIGINT',
+        '''
+        CREATE TABLE gps_locations (
+            id BIGINT NOT NULL DEFAULT nextval('gps_locations_id_seq'),
+            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
+            latitude DECIMAL(10, 8) NOT NULL,
+            longitude DECIMAL(11, 8) NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+        ''',
+        'ALTER SEQUENCE gps_locations_id_seq OWNED BY gps_locations.id',
+        'CREATE INDEX idx_gps_truck_timestamp ON gps_locations (truck_id, timestamp DESC)',
+        'CREATE TABLE gps_locations_default PARTITION OF gps_locations DEFAULT',
+        _partition_existing_gps,
+        '''
+        INSERT INTO gps_locations (id, truck_id, latitude, longitude, timestamp)
+        SELECT id, truck_id, latitude, longitude, COALESCE(timestamp, CURRENT_TIMESTAMP)
+        FROM gps_locations_unpartitioned
+        ''',
+        'DROP TABLE gps_locations_unpartitioned',
+        '''
+        CREATE TABLE gps_rollups_minute (
+            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
+            bucket TIMESTAMP NOT NULL,
+            point_count INTEGER NOT NULL,
+            latitude DECIMAL(10, 8) NOT NULL,
+            longitude DECIMAL(11, 8) NOT NULL,
+            first_at TIMESTAMP NOT NULL,
+            last_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (truck_id, bucket)
+        )
+        ''',
+        '''
+        CREATE TABLE gps_rollups_hour (
+            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
+            bucket TIMESTAMP NOT NULL,
+            point_count INTEGER NOT NULL,
+            latitude DECIMAL(10, 8) NOT NULL,
+            longitude DECIMAL(11, 8) NOT NULL,
+            first_at TIMESTAMP NOT NULL,
+            last_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (truck_id, bucket)
+        )
+        ''',
+        '''
+        CREATE TABLE gps_rollup_progress (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            compacted_until TIMESTAMP
+        )
+        ''',
+    ]),
+    (4, 'last-known truck state', [
+        'ALTER TABLE gps_locations ADD COLUMN speed REAL',
+        '''
+        CREATE TABLE truck_state (
+            truck_id INTEGER PRIMARY KEY REFERENCES trucks(id) ON DELETE CASCADE,
+            latitude DECIMAL(10, 8),
+            longitude DECIMAL(11, 8),
+            speed REAL,
+            reported_at TIMESTAMP,
+            active_alerts INTEGER NOT NULL DEFAULT 0,
+            offline_cameras INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE FUNCTION truck_state_init() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO truck_state (truck_id) VALUES (NEW.id) ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER trucks_truck_state AFTER INSERT ON trucks
+        FOR EACH ROW EXECUTE FUNCTION truck_state_init()
+        ''',
+        '''
+        CREATE FUNCTION truck_state_count_alerts() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.is_read IS FALSE THEN
+                UPDATE truck_state SET
+                    active_alerts = active_alerts - 1,
+                    offline_cameras = offline_cameras - (OLD.alert_type = 'Camera Offline')::int
+                WHERE truck_id = OLD.truck_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.is_read IS FALSE THEN
+                UPDATE truck_state SET
+                    active_alerts = active_alerts + 1,
+                    offline_cameras = offline_cameras + (NEW.alert_type = 'Camera Offline')::int
+                WHERE truck_id = NEW.truck_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER alerts_truck_state AFTER INSERT OR DELETE OR UPDATE OF is_read, truck_id, alert_type ON alerts
+        FOR EACH ROW EXECUTE FUNCTION truck_state_count_alerts()
+        ''',
+        refresh_truck_state,
+    ]),
+    (5, 'notify live positions and alerts', [
+        '''
+        CREATE FUNCTION notify_truck_position() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('fleet_events', json_build_object(
+                'kind', 'position',
+                'truck_id', NEW.truck_id,
+                'owner_id', (SELECT owner_id FROM trucks WHERE id = NEW.truck_id),
+                'latitude', NEW.latitude,
+                'longitude', NEW.longitude,
+                'speed', NEW.speed,
+                'reported_at', NEW.reported_at
+            )::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER truck_state_notify AFTER UPDATE ON truck_state
+        FOR EACH ROW WHEN (NEW.reported_at IS DISTINCT FROM OLD.reported_at)
+        EXECUTE FUNCTION notify_truck_position()
+        ''',
+        '''
+        CREATE FUNCTION notify_alert() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('fleet_events', json_build_object(
+                'kind', 'alert',
+                'id', NEW.id,
+                'truck_id', NEW.truck_id,
+                'owner_id', t.owner_id,
+                'truck_number', t.truck_number,
+                'alert_type', NEW.alert_type,
+                'message', left(NEW.message, 1000),
+                'severity', NEW.severity,
+                'created_at', NEW.created_at
+            )::text)
+            FROM trucks t WHERE t.id = NEW.truck_id;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER alerts_notify AFTER INSERT ON alerts
+        FOR EACH ROW EXECUTE FUNCTION notify_alert()
+        ''',
+    ]),
+    (6, 'notify truck ownership changes', [
+        '''
+        CREATE FUNCTION notify_truck_owner_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('truck_owner_changed', json_build_object(
+                'truck_id', COALESCE(NEW.id, OLD.id)
+            )::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER trucks_owner_changed AFTER INSERT OR DELETE OR UPDATE OF owner_id ON trucks
+        FOR EACH ROW EXECUTE FUNCTION notify_truck_owner_changed()
+        ''',
+    ]),
+    (7, 'daily mileage', [
+        '''
+        CREATE TABLE truck_daily_mileage (
+            truck_id INTEGER NOT NULL REFERENCES trucks(id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            distance_m DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (truck_id, day)
+        )
+        ''',
+    ]),
+    (8, 'geofences', [
+        '''
+        CREATE TABLE geofences (
+            id SERIAL PRIMARY KEY,
+            owner_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
+            name VARCHAR(100) NOT NULL,
+            shape VARCHAR(10) NOT NULL CHECK (shape IN ('polygon', 'circle')),
+            coordinates JSONB NOT NULL,
+            radius_m DOUBLE PRECISION,
+            alert_on VARCHAR(10) NOT NULL DEFAULT 'both' CHECK (alert_on IN ('enter', 'exit', 'both')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX idx_geofences_owner ON geofences (owner_id, id)',
+        '''
+        CREATE TABLE geofence_state (
+            truck_id INTEGER NOT NULL REFERENCES trucks(id) ON DELETE CASCADE,
+            geofence_id INTEGER NOT NULL REFERENCES geofences(id) ON DELETE CASCADE,
+            inside BOOLEAN NOT NULL,
+            pending_count INTEGER NOT NULL DEFAULT 0,
+            pending_since TIMESTAMP,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (truck_id, geofence_id)
+        )
+        ''',
+        '''
+        CREATE FUNCTION notify_geofences_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('geofences_changed', json_build_object(
+                'geofence_id', COALESCE(NEW.id, OLD.id)
+            )::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER geofences_changed AFTER INSERT OR UPDATE OR DELETE ON geofences
+        FOR EACH ROW EXECUTE FUNCTION notify_geofences_changed()
+        ''',
+    ]),
+    # Keyset pages compare (timestamp, id) row values, which never match NULL, so the
+    # ordering columns become NOT NULL (rows that never had a time sort as the oldest).
+    (9, 'keyset pagination indexes', [
+        "UPDATE video_recordings SET recorded_at = TIMESTAMP 'epoch' WHERE recorded_at IS NULL",
+        'ALTER TABLE video_recordings ALTER COLUMN recorded_at SET NOT NULL',
+        "UPDATE alerts SET created_at = TIMESTAMP 'epoch' WHERE created_at IS NULL",
+        'ALTER TABLE alerts ALTER COLUMN created_at SET NOT NULL',
+        "UPDATE face_detections SET detected_at = TIMESTAMP 'epoch' WHERE detected_at IS NULL",
+        'ALTER TABLE face_detections ALTER COLUMN detected_at SET NOT NULL',
+        'DROP INDEX idx_recordings_truck_recorded',
+        'CREATE INDEX idx_recordings_truck_recorded_id ON video_recordings (truck_id, recorded_at DESC, id DESC)',
+        'DROP INDEX idx_face_detections_truck_detected',
+        'CREATE INDEX idx_face_detections_truck_detected_id ON face_detections (truck_id, detected_at DESC, id DESC)',
+        'CREATE INDEX idx_alerts_truck_created_id ON alerts (truck_id, created_at DESC, id DESC)',
+        'DROP INDEX idx_gps_truck_timestamp',
+        'CREATE INDEX idx_gps_truck_timestamp_id ON gps_locations (truck_id, timestamp DESC, id DESC)',
+    ]),
+    (10, 'truck page versions', [
+        # Every change that alters a rendered truck or dashboard page rewrites the
+        # truck's truck_state row, which draws a fresh number from one sequence. The
+        # row lock taken before BEFORE triggers run makes versions of a truck increase
+        # in commit order, so the largest version seen is always the current one.
+        'CREATE SEQUENCE fleet_version_seq',
+        "ALTER TABLE truck_state ADD COLUMN version BIGINT NOT NULL DEFAULT nextval('fleet_version_seq')",
+        'ALTER TABLE truck_state ADD COLUMN changed_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()',
+        '''
+        CREATE FUNCTION truck_state_bump_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('fleet_version_seq');
+            NEW.changed_at := clock_timestamp();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER truck_state_version BEFORE UPDATE ON truck_state
+        FOR EACH ROW EXECUTE FUNCTION truck_state_bump_version()
+        ''',
+        '''
+        CREATE FUNCTION notify_truck_version() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('fleet_version', json_build_object(
+                    'truck_id', OLD.truck_id,
+                    'deleted', TRUE,
+                    'version', nextval('fleet_version_seq'),
+                    'changed_at', clock_timestamp()
+                )::text);
+            ELSE
+                PERFORM pg_notify('fleet_version', json_build_object(
+                    'truck_id', NEW.truck_id,
+                    'owner_id', (SELECT owner_id FROM trucks WHERE id = NEW.truck_id),
+                    'version', NEW.version,
+                    'changed_at', NEW.changed_at
+                )::text);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER truck_state_version_notify AFTER INSERT OR UPDATE OR DELETE ON truck_state
+        FOR EACH ROW EXECUTE FUNCTION notify_truck_version()
+        ''',
+        '''
+        CREATE FUNCTION touch_truck_state() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                UPDATE truck_state SET version = version WHERE truck_id = OLD.truck_id;
+            END IF;
+            IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.truck_id IS DISTINCT FROM OLD.truck_id) THEN
+                UPDATE truck_state SET version = version WHERE truck_id = NEW.truck_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER drivers_touch_truck AFTER INSERT OR UPDATE OR DELETE ON drivers
+        FOR EACH ROW EXECUTE FUNCTION touch_truck_state()
+        ''',
+        '''
+        CREATE TRIGGER recordings_touch_truck AFTER INSERT OR UPDATE OR DELETE ON video_recordings
+        FOR EACH ROW EXECUTE FUNCTION touch_truck_state()
+        ''',
+        # Inserts, deletes and read-state changes already rewrite truck_state through
+        # the alert counters; edits to the rendered text are the remaining case.
+        '''
+        CREATE TRIGGER alerts_touch_truck AFTER UPDATE OF message, severity ON alerts
+        FOR EACH ROW EXECUTE FUNCTION touch_truck_state()
+        ''',
+        '''
+        CREATE FUNCTION trucks_touch_state() RETURNS trigger AS $$
+        BEGIN
+            UPDATE truck_state SET version = version WHERE truck_id = NEW.id;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER trucks_touch_state AFTER UPDATE ON trucks
+        FOR EACH ROW EXECUTE FUNCTION trucks_touch_state()
+        ''',
+    ]),
+    (11, 'driver face embeddings', [
+        # L2-normalized little-endian float32 vectors (see face_match.py).
+        'ALTER TABLE drivers ADD COLUMN embedding BYTEA',
+        '''
+        CREATE FUNCTION notify_driver_embeddings_changed() RETURNS trigger AS $$
+        BEGIN
+            IF (TG_OP = 'INSERT' AND NEW.embedding IS NULL) OR (TG_OP = 'DELETE' AND OLD.embedding IS NULL) THEN
+                RETURN NULL;
+            END IF;
+            PERFORM pg_notify('driver_embeddings_changed', json_build_object(
+                'driver_id', COALESCE(NEW.id, OLD.id)
+            )::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER drivers_embeddings_changed AFTER INSERT OR DELETE OR UPDATE OF embedding, truck_id ON drivers
+        FOR EACH ROW EXECUTE FUNCTION notify_driver_embeddings_changed()
+        ''',
+    ]),
+    (12, 'alert deduplication and owner counters', [
+        "UPDATE alerts SET is_read = FALSE WHERE is_read IS NULL",
+        'ALTER TABLE alerts ALTER COLUMN is_read SET NOT NULL',
+        "UPDATE alerts SET severity = 'medium' WHERE severity IS NULL",
+        'ALTER TABLE alerts ALTER COLUMN severity SET NOT NULL',
+        'ALTER TABLE alerts ADD COLUMN occurrences INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE alerts ADD COLUMN last_seen_at TIMESTAMP',
+        'UPDATE alerts SET last_seen_at = created_at',
+        'ALTER TABLE alerts ALTER COLUMN last_seen_at SET NOT NULL',
+        'ALTER TABLE alerts ALTER COLUMN last_seen_at SET DEFAULT CURRENT_TIMESTAMP',
+        # Fold existing unread repeats into their oldest row before the index forbids them.
+        '''
+        WITH ranked AS (
+            SELECT id,
+                   first_value(id) OVER (PARTITION BY truck_id, alert_type ORDER BY created_at, id) AS keep_id,
+                   count(*) OVER (PARTITION BY truck_id, alert_type) AS occurrences,
+                   max(created_at) OVER (PARTITION BY truck_id, alert_type) AS last_seen_at
+            FROM alerts
+            WHERE NOT is_read
+        ), kept AS (
+            UPDATE alerts a SET occurrences = r.occurrences, last_seen_at = r.last_seen_at
+            FROM ranked r
+            WHERE a.id = r.id AND r.id = r.keep_id AND r.occurrences > 1
+        )
+        DELETE FROM alerts a USING ranked r WHERE a.id = r.id AND r.id <> r.keep_id
+        ''',
+        'CREATE UNIQUE INDEX idx_alerts_open ON alerts (truck_id, alert_type) WHERE NOT is_read',
+        'DROP INDEX idx_alerts_truck_read_created',
+        'DROP TRIGGER alerts_touch_truck ON alerts',
+        '''
+        CREATE TRIGGER alerts_touch_truck AFTER UPDATE OF message, severity, occurrences, last_seen_at ON alerts
+        FOR EACH ROW EXECUTE FUNCTION touch_truck_state()
+        ''',
+        '''
+        CREATE TABLE owner_alert_counts (
+            owner_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            severity VARCHAR(20) NOT NULL,
+            unread INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (owner_id, severity)
+        )
+        ''',
+        '''
+        CREATE FUNCTION owner_alert_counts_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND NOT OLD.is_read THEN
+                UPDATE owner_alert_counts c SET unread = c.unread - 1
+                FROM trucks t
+                WHERE t.id = OLD.truck_id AND c.owner_id = t.owner_id AND c.severity = OLD.severity;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NOT NEW.is_read THEN
+                INSERT INTO owner_alert_counts (owner_id, severity, unread)
+                SELECT owner_id, NEW.severity, 1 FROM trucks WHERE id = NEW.truck_id AND owner_id IS NOT NULL
+                ON CONFLICT (owner_id, severity) DO UPDATE SET unread = owner_alert_counts.unread + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER alerts_owner_counts AFTER INSERT OR DELETE OR UPDATE OF is_read, truck_id, severity ON alerts
+        FOR EACH ROW EXECUTE FUNCTION owner_alert_counts_apply()
+        ''',
+        # A truck changing hands moves its unread alerts to the new owner's counters. A
+        # deleted truck is subtracted before the cascade removes its alerts, whose own
+        # trigger then no longer finds the truck.
+        '''
+        CREATE FUNCTION trucks_move_alert_counts() RETURNS trigger AS $$
+        BEGIN
+            IF OLD.owner_id IS NOT NULL THEN
+                UPDATE owner_alert_counts c SET unread = c.unread - a.unread
+                FROM (SELECT severity, count(*) AS unread FROM alerts
+                      WHERE truck_id = OLD.id AND NOT is_read GROUP BY severity) a
+                WHERE c.owner_id = OLD.owner_id AND c.severity = a.severity;
+            END IF;
+            IF TG_OP = 'UPDATE' AND NEW.owner_id IS NOT NULL THEN
+                INSERT INTO owner_alert_counts (owner_id, severity, unread)
+                SELECT NEW.owner_id, severity, count(*) FROM alerts
+                WHERE truck_id = NEW.id AND NOT is_read GROUP BY severity
+                ON CONFLICT (owner_id, severity) DO UPDATE SET unread = owner_alert_counts.unread + EXCLUDED.unread;
+            END IF;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER trucks_alert_counts_moved AFTER UPDATE OF owner_id ON trucks
+        FOR EACH ROW WHEN (NEW.owner_id IS DISTINCT FROM OLD.owner_id)
+        EXECUTE FUNCTION trucks_move_alert_counts()
+        ''',
+        '''
+        CREATE TRIGGER trucks_alert_counts_deleted BEFORE DELETE ON trucks
+        FOR EACH ROW EXECUTE FUNCTION trucks_move_alert_counts()
+        ''',
+        refresh_alert_counts,
+    ]),
+    # Manifest of the day segments archive.py has moved out to files. Rows of an
+    # archived day live either here or in the file, never both.
+    (13, 'history archive manifest', [
+        '''
+        CREATE TABLE archive_segments (
+            table_name VARCHAR(50) NOT NULL,
+            day DATE NOT NULL,
+            path TEXT NOT NULL,
+            row_count BIGINT NOT NULL,
+            trucks INTEGER NOT NULL,
+            bytes BIGINT NOT NULL,
+            archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (table_name, day)
+        )
+        ''',
+        '''
+        CREATE FUNCTION notify_archive_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('archive_changed', '{}');
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER archive_segments_changed AFTER INSERT OR UPDATE OR DELETE ON archive_segments
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_archive_changed()
+        ''',
+        # Archiving deletes face detections by day; a BRIN index finds a day's rows
+        # without scanning the whole table and costs next to nothing on insert.
+        'CREATE INDEX idx_face_detections_detected_brin ON face_detections USING brin (detected_at)',
+    ]),
+    # Telemetry gateway: per-truck device credentials (only a SHA-256 of the random
+    # token is kept) and the highest sequence number stored from each device.
+    (14, 'gateway devices', [
+        'ALTER TABLE trucks ADD COLUMN device_token_hash VARCHAR(64)',
+        '''
+        CREATE TABLE device_sequences (
+            truck_id INTEGER PRIMARY KEY REFERENCES trucks(id) ON DELETE CASCADE,
+            last_seq BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    # Recordings uploaded by trucks live under RECORDINGS_DIR; rows from before this
+    # (and generated ones) have no file.
+    (15, 'recording files', [
+        'ALTER TABLE video_recordings ADD COLUMN file_path VARCHAR(255)',
+    ]),
+    # Background jobs (jobs.py): one row per job, leased by the scheduler that runs it,
+    # and a row per finished run.
+    (16, 'scheduled jobs', [
+        '''
+        CREATE TABLE scheduled_jobs (
+            name VARCHAR(100) PRIMARY KEY,
+            schedule VARCHAR(100) NOT NULL,
+            enabled BOOLEAN NOT NULL DEFAULT TRUE,
+            next_run_at TIMESTAMP NOT NULL,
+            lease_owner VARCHAR(200),
+            lease_expires_at TIMESTAMP,
+            last_started_at TIMESTAMP,
+            last_finished_at TIMESTAMP,
+            last_status VARCHAR(20),
+            last_seconds DOUBLE PRECISION,
+            last_success_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE job_runs (
+            id BIGSERIAL PRIMARY KEY,
+            job_name VARCHAR(100) NOT NULL,
+            worker VARCHAR(200) NOT NULL,
+            started_at TIMESTAMP NOT NULL,
+            finished_at TIMESTAMP NOT NULL,
+            seconds DOUBLE PRECISION NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            result JSONB,
+            error TEXT
+        )
+        ''',
+        'CREATE INDEX idx_job_runs_job_started ON job_runs (job_name, started_at DESC)',
+    ]),
+    # GPS timestamps are naive UTC; CURRENT_TIMESTAMP would store the session's local time.
+    (17, 'utc gps default', [
+        "ALTER TABLE gps_locations ALTER COLUMN timestamp SET DEFAULT timezone('UTC', now())",
+    ]),
+    # Trucks with rows in each archive segment, so history pages skip the days a truck
+    # has none without opening their files. archive.index_segments fills in older rows.
+    (18, 'archive segment trucks', [
+        'ALTER TABLE archive_segments ADD COLUMN truck_ids INTEGER[]',
+    ]),
+]
+
+_FIRST_PAGE_PARAMS = {'truck_id': 1, 'before_ts': FIRST_PAGE[0], 'before_id': FIRST_PAGE[1], 'limit': 21}
+
+# Every ORDER BY / lookup the routes issue, with the index the plan must use.
+# allow_sort marks queries that merge several trucks and therefore keep a top-N sort.
+HOT_QUERIES = [
+    ('login user', 'SELECT * FROM users WHERE username = %s', ('john_doe',), 'users_username_key', False),
+    ('dashboard fleet state', FLEET_STATE_QUERY, (1,), 'idx_trucks_owner_created', False),
+    ('dashboard alerts', DASHBOARD_ALERTS_QUERY, (1,), 'idx_alerts_open', True),
+    ('dashboard alert counts', 'SELECT severity, unread FROM owner_alert_counts WHERE owner_id = %s', (1,),
+     'owner_alert_counts_pkey', False),
+    ('truck bundle drivers', TRUCK_BUNDLE_QUERY, (1,), 'idx_drivers_truck', False),
+    ('truck bundle state', TRUCK_BUNDLE_QUERY, (1,), 'truck_state_pkey', False),
+    ('travel history', '''
+        SELECT latitude::float8, longitude::float8, extract(epoch FROM timestamp)::float8 FROM gps_locations
+        WHERE truck_id = %s AND timestamp >= now() - interval '6 hours' AND timestamp < now()
+        ORDER BY timestamp
+    ''', (1,), 'idx_gps_truck_timestamp_id', False),
+    ('dispatch positions', OWNER_POSITIONS_QUERY, (1,), 'idx_trucks_owner_created', False),
+    ('geofences', '''
+        SELECT id, owner_id, truck_id, name, shape, coordinates, radius_m, alert_on
+        FROM geofences WHERE owner_id = %s ORDER BY id
+    ''', (1,), 'idx_geofences_owner', False),
+    ('recordings page', RECORDINGS_PAGE_QUERY, _FIRST_PAGE_PARAMS, 'idx_recordings_truck_recorded_id', False),
+    ('alerts page', ALERTS_PAGE_QUERY, _FIRST_PAGE_PARAMS, 'idx_alerts_truck_created_id', False),
+    ('face detections page', FACE_DETECTIONS_PAGE_QUERY, _FIRST_PAGE_PARAMS, 'idx_face_detections_truck_detected_id', False),
+    ('locations page', LOCATIONS_PAGE_QUERY, _FIRST_PAGE_PARAMS, 'idx_gps_truck_timestamp_id', False),
+    ('job history', JOB_HISTORY_QUERY, ('stale-gps', 20), 'idx_job_runs_job_started', False),
+]
+
+
+def migrate(conn):
+    cur = conn.cursor()
+    cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+    applied_now = []
+    try:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(200) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+
+        cur.execute('SELECT version FROM schema_migrations')
+        applied = {row[0] for row in cur.fetchall()}
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(cur)
+                else:
+                    cur.execute(statement)
+            cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+            conn.commit()
+            applied_now.append(version)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+        conn.commit()
+        cur.close()
+    return applied_now
+
+
+def _walk_plan(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _walk_plan(child)
+
+
+def check_hot_query_indexes(conn):
+    # Seq scans, bitmap scans and sorts are priced out so that the planner reveals whether an
+    # index can serve the filter and the ORDER BY even on tiny development tables.
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    failures = []
+    try:
+        cur.execute('SET LOCAL enable_seqscan = off')
+        cur.execute('SET LOCAL enable_bitmapscan = off')
+        cur.execute('SET LOCAL enable_sort = off')
+        # Partition-local indexes are reported by the name of the parent index they belong to.
+        cur.execute('''
+            SELECT c.relname, p.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE c.relkind = 'i'
+        ''')
+        parent_index = dict(cur.fetchall())
+        for name, sql, params, index, allow_sort in HOT_QUERIES:
+            cur.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cur.fetchone()[0][0]['Plan']
+            nodes = list(_walk_plan(plan))
+            indexes = {parent_index.get(node.get('Index Name'), node.get('Index Name')) for node in nodes}
+            has_sort = any(node['Node Type'] in ('Sort', 'Incremental Sort') for node in nodes)
+            if index not in indexes:
+                failures.append('%s: expected %s, plan used %s' % (name, index, sorted(i for i in indexes if i) or 'no index'))
+            elif has_sort and not allow_sort:
+                failures.append('%s: %s is used but the plan still sorts' % (name, index))
+    finally:
+        conn.rollback()
+        cur.close()
+    return failures
@@ -1,106 +1,97 @@
 import psycopg2
 import psycopg2.extras
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import hash_passwords
+from flask import g
 import os
+import threading
+from db_pool import ConnectionPool
+from migrations import migrate
+from fleet_state import refresh_truck_state
+from profiling import ProfiledConnection
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
 
 def get_db_connection():
     conn = psycopg2.connect(os.getenv('DATABASE_URL'))
     return conn
 
+def get_pool():
+    global _pool, _pool_pid
+    # Pools must not be shared across a fork (gunicorn --preload), so each process builds its own.
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ConnectionPool(
+                    os.getenv('DATABASE_URL'),
+                    minconn=int(os.getenv('DB_POOL_MIN', '1')),
+                    maxconn=int(os.getenv('DB_POOL_MAX', '10')),
+                    timeout=float(os.getenv('DB_POOL_TIMEOUT', '30')),
+                    health_check_after=float(os.getenv('DB_POOL_HEALTH_CHECK_AFTER', '30')),
+                    connection_factory=ProfiledConnection if os.getenv('DB_PROFILING', '1') == '1' else None,
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
+def get_db():
+    if 'db_conn' not in g:
+        g.db_conn = get_pool().getconn()
+    return g.db_conn
+
+def close_db(exception=None):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_pool().putconn(conn)
+
 def init_db():
+    conn = get_db_connection()
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
+
+def drop_db():
     conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('DROP TABLE IF EXISTS video_recordings CASCADE')
     cur.execute('DROP TABLE IF EXISTS alerts CASCADE')
+    cur.execute('DROP TABLE IF EXISTS owner_alert_counts CASCADE')
     cur.execute('DROP TABLE IF EXISTS face_detections CASCADE')
+    cur.execute('DROP TABLE IF EXISTS truck_daily_mileage CASCADE')
+    cur.execute('DROP TABLE IF EXISTS geofence_state CASCADE')
+    cur.execute('DROP TABLE IF EXISTS geofences CASCADE')
+    cur.execute('DROP TABLE IF EXISTS truck_state CASCADE')
     cur.execute('DROP TABLE IF EXISTS gps_locations CASCADE')
+    cur.execute('DROP TABLE IF EXISTS gps_rollups_minute CASCADE')
+    cur.execute('DROP TABLE IF EXISTS gps_rollups_hour CASCADE')
+    cur.execute('DROP TABLE IF EXISTS gps_rollup_progress CASCADE')
+    cur.execute('DROP SCHEMA IF EXISTS gps_archive CASCADE')
     cur.execute('DROP TABLE IF EXISTS drivers CASCADE')
     cur.execute('DROP TABLE IF EXISTS trucks CASCADE')
     cur.execute('DROP TABLE IF EXISTS users CASCADE')
-    
-    cur.execute('''
-        CREATE TABLE users (
-            id SERIAL PRIMARY KEY,
-            username VARCHAR(100) UNIQUE NOT NULL,
-            password_hash VARCHAR(255) NOT NULL,
-            email VARCHAR(150) UNIQUE NOT NULL,
-            full_name VARCHAR(150) NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE trucks (
-            id SERIAL PRIMARY KEY,
-            truck_number VARCHAR(50) NOT NULL,
-            owner_id INTEGER REFERENCES users(id),
-            license_plate VARCHAR(50),
-            model VARCHAR(100),
-            status VARCHAR(50) DEFAULT 'active',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE drivers (
-            id SERIAL PRIMARY KEY,
-            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
-            name VARCHAR(150) NOT NULL,
-            phone VARCHAR(20),
-            license_number VARCHAR(50),
-            photo_url VARCHAR(255),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE gps_locations (
-            id SERIAL PRIMARY KEY,
-            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
-            latitude DECIMAL(10, 8) NOT NULL,
-            longitude DECIMAL(11, 8) NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE face_detections (
-            id SERIAL PRIMARY KEY,
-            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
-            driver_id INTEGER REFERENCES drivers(id) ON DELETE SET NULL,
-            image_url VARCHAR(255),
-            confidence DECIMAL(5, 2),
-            match_result VARCHAR(50),
-            detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE alerts (
-            id SERIAL PRIMARY KEY,
-            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
-            alert_type VARCHAR(100) NOT NULL,
-            message TEXT NOT NULL,
-            severity VARCHAR(20) DEFAULT 'medium',
-            is_read BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cur.execute('''
-        CREATE TABLE video_recordings (
-            id SERIAL PRIMARY KEY,
-            truck_id INTEGER REFERENCES trucks(id) ON DELETE CASCADE,
-            camera_number INTEGER NOT NULL,
-            file_url VARCHAR(255),
-            file_size BIGINT,
-            duration INTEGER,
-            status VARCHAR(50) DEFAULT 'saved',
-            recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    cur.execute('DROP TABLE IF EXISTS archive_segments CASCADE')
+    cur.execute('DROP TABLE IF EXISTS device_sequences CASCADE')
+    cur.execute('DROP TABLE IF EXISTS scheduled_jobs CASCADE')
+    cur.execute('DROP TABLE IF EXISTS job_runs CASCADE')
+    cur.execute('DROP TABLE IF EXISTS schema_migrations CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS truck_state_init() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS truck_state_count_alerts() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS notify_truck_position() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS notify_alert() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS notify_truck_owner_changed() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS notify_geofences_changed() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS truck_state_bump_version() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS notify_truck_version() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS touch_truck_state() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS trucks_touch_state() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS notify_driver_embeddings_changed() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS owner_alert_counts_apply() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS trucks_move_alert_counts() CASCADE')
+    cur.execute('DROP FUNCTION IF EXISTS notify_archive_changed() CASCADE')
+    cur.execute('DROP SEQUENCE IF EXISTS fleet_version_seq CASCADE')
     
     conn.commit()
     cur.close()
@@ -110,11 +101,18 @@ def create_test_data():
     conn = get_db_connection()
     cur = conn.cursor()
     
+    cur.execute('SELECT EXISTS (SELECT 1 FROM users)')
+    if cur.fetchone()[0]:
+        cur.close()
+        conn.close()
+        return False
+    
+    password_hashes = hash_passwords(['password123'] * 4)
     users_data = [
-        ('john_doe', generate_password_hash('password123'), 'john@trucking.com', 'John Doe'),
-        ('jane_smith', generate_password_hash('password123'), 'jane@trucking.com', 'Jane Smith'),
-        ('mike_wilson', generate_password_hash('password123'), 'mike@trucking.com', 'Mike Wilson'),
-        ('sarah_jones', generate_password_hash('password123'), 'sarah@trucking.com', 'Sarah Jones')
+        ('john_doe', password_hashes[0], 'john@trucking.com', 'John Doe'),
+        ('jane_smith', password_hashes[1], 'jane@trucking.com', 'Jane Smith'),
+        ('mike_wilson', password_hashes[2], 'mike@trucking.com', 'Mike Wilson'),
+        ('sarah_jones', password_hashes[3], 'sarah@trucking.com', 'Sarah Jones')
     ]
     
     for username, password_hash, email, full_name in users_data:
@@ -209,6 +207,9 @@ def create_test_data():
             (truck_id, camera_number, file_url, file_size, duration, status)
         )
     
+    refresh_truck_state(cur)
+    
     conn.commit()
     cur.close()
     conn.close()
+    return True
@@ -0,0 +1,250 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app, make_response, request, session
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+
+import events
+from models import get_db
+
+FRAGMENT_CACHE_BYTES = int(os.getenv('FRAGMENT_CACHE_BYTES', str(32 * 1024 * 1024)))
+CONDITIONAL_GET = os.getenv('CONDITIONAL_GET', '1') == '1'
+
+VERSION_CHANNEL = 'fleet_version'
+
+TRUCK_VERSIONS_QUERY = '''
+    SELECT s.truck_id, t.owner_id, s.version, s.changed_at
+    FROM truck_state s
+    JOIN trucks t ON t.id = s.truck_id
+'''
+
+
+def _template_digest():
+    # Part of every validator and fragment key, so a deploy that changes a template
+    # never serves pages or fragments rendered by the old one.
+    digest = hashlib.sha1()
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    for name in sorted(os.listdir(folder)):
+        digest.update(name.encode())
+        with open(os.path.join(folder, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:10]
+
+
+TEMPLATE_DIGEST = _template_digest()
+
+
+class VersionMirror:
+    # An in-process copy of (owner, version, changed_at) per truck, kept current by
+    # fleet_version notifications. An owner's dashboard version is derived from the
+    # versions of all its trucks: their sum grows on every change to any of them, even
+    # when notifications from concurrent transactions arrive out of version order.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._trucks = {}
+        self._owners = {}
+        self._generation = None
+        self._pending = None
+
+    def apply(self, payload):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(payload)
+            self._apply(payload)
+
+    def _apply(self, payload):
+        truck_id = payload['truck_id']
+        version = payload['version']
+        changed_at = datetime.fromisoformat(payload['changed_at'])
+        previous = self._trucks.get(truck_id)
+        if previous is not None and version <= previous[1]:
+            return
+        if previous is not None:
+            self._remove(truck_id, previous, changed_at)
+        if not payload.get('deleted'):
+            entry = (payload.get('owner_id'), version, changed_at)
+            self._trucks[truck_id] = entry
+            self._add(entry)
+
+    def _add(self, entry):
+        owner_id, version, changed_at = entry
+        if owner_id is None:
+            return
+        count, total, last_modified = self._owners.get(owner_id, (0, 0, changed_at))
+        self._owners[owner_id] = (count + 1, total + version, max(last_modified, changed_at))
+
+    def _remove(self, truck_id, entry, changed_at):
+        del self._trucks[truck_id]
+        owner_id, version, _ = entry
+        if owner_id is None:
+            return
+        count, total, last_modified = self._owners[owner_id]
+        self._owners[owner_id] = (count - 1, total - version, max(last_modified, changed_at))
+
+    def load(self, cur, generation):
+        # Notifications that arrive while the snapshot is read are replayed on top of
+        # it; replays are harmless because older versions are ignored.
+        with self._load_lock:
+            if self._generation == generation:
+                return
+            with self._lock:
+                self._pending = []
+            try:
+                cur.execute(TRUCK_VERSIONS_QUERY)
+                rows = cur.fetchall()
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                pending, self._pending = self._pending, None
+                self._trucks, self._owners = {}, {}
+                for truck_id, owner_id, version, changed_at in rows:
+                    entry = (owner_id, version, changed_at)
+                    self._trucks[truck_id] = entry
+                    self._add(entry)
+                for payload in pending:
+                    self._apply(payload)
+                self._generation = generation
+
+    def is_current(self, generation):
+        return self._generation == generation
+
+    def truck(self, truck_id):
+        with self._lock:
+            return self._trucks.get(truck_id)
+
+    def owner(self, owner_id):
+        with self._lock:
+            return self._owners.get(owner_id)
+
+
+mirror = VersionMirror()
+events.on_notify(VERSION_CHANNEL, mirror.apply)
+
+
+def _current_generation():
+    # Versions are only trusted while the LISTEN connection is up and the mirror has
+    # been rebuilt since it last (re)connected; otherwise pages are always rendered.
+    listener = events.get_listener()
+    if not listener.connected:
+        return None
+    generation = listener.generation
+    if not mirror.is_current(generation):
+        cur = get_db().cursor()
+        try:
+            mirror.load(cur, generation)
+        finally:
+            cur.close()
+    return generation
+
+
+class Validator:
+    __slots__ = ('etag', 'last_modified', 'version')
+
+    def __init__(self, etag, last_modified, version):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.version = version
+
+
+def truck_validator(truck_id, user_id):
+    if not CONDITIONAL_GET or _current_generation() is None:
+        return None
+    entry = mirror.truck(truck_id)
+    if entry is None:
+        return None
+    owner_id, version, changed_at = entry
+    return Validator('truck%d-v%d-u%d-%s' % (truck_id, version, user_id, TEMPLATE_DIGEST), changed_at, version)
+
+
+def fleet_validator(user_id):
+    if not CONDITIONAL_GET or _current_generation() is None:
+        return None
+    entry = mirror.owner(user_id)
+    if entry is None:
+        return None
+    count, total, last_modified = entry
+    version = '%d.%d' % (count, total)
+    return Validator('fleet-v%s-u%d-%s' % (version, user_id, TEMPLATE_DIGEST), last_modified, version)
+
+
+def conditional_response(validator, render):
+    # Answers 304 before render() runs, so an unchanged page costs no query at all.
+    # Pages carrying a flashed message are always rendered: the flash is not part of
+    # the version and must be consumed.
+    if validator is None or '_flashes' in session:
+        return render()
+    if not is_resource_modified(request.environ, etag=validator.etag, last_modified=validator.last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+    response.set_etag(validator.etag, weak=True)
+    response.last_modified = validator.last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+class FragmentCache:
+    # Rendered template sections keyed by (name, key, version), bounded by the total
+    # size of the cached markup and evicted least recently used first.
+    def __init__(self, max_bytes=FRAGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        cost = len(html)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = html
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+fragments = FragmentCache()
+
+
+def cached_fragment(name, key, version, caller):
+    # Used from templates as {% call cached_fragment('drivers', truck.id, page_version) %}.
+    # Without a version (conditional GET unavailable) the body is always rendered.
+    if version is None:
+        return caller()
+    cache_key = (name, key, version, TEMPLATE_DIGEST)
+    html = fragments.get(cache_key)
+    if html is None:
+        html = str(caller())
+        fragments.put(cache_key, html)
+    return Markup(html)
@@ -0,0 +1,104 @@
+import base64
+import binascii
+from datetime import datetime
+from decimal import Decimal
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Every page query walks one (truck_id, <timestamp> DESC, id DESC) index from the
+# cursor position, so page N costs the same as page 1. The first page starts from
+# the largest possible key rather than using a separate query. The plain timestamp
+# bound on gps_locations is redundant but lets the planner prune newer partitions,
+# which a row comparison alone does not.
+FIRST_PAGE = (datetime.max, 2 ** 63 - 1)
+
+RECORDINGS_PAGE_QUERY = '''
+    SELECT id, camera_number, file_url, file_size, duration, status, recorded_at
+    FROM video_recordings
+    WHERE truck_id = %(truck_id)s AND (recorded_at, id) < (%(before_ts)s, %(before_id)s)
+    ORDER BY recorded_at DESC, id DESC
+    LIMIT %(limit)s
+'''
+
+ALERTS_PAGE_QUERY = '''
+    SELECT id, alert_type, message, severity, is_read, occurrences, created_at, last_seen_at
+    FROM alerts
+    WHERE truck_id = %(truck_id)s AND (created_at, id) < (%(before_ts)s, %(before_id)s)
+    ORDER BY created_at DESC, id DESC
+    LIMIT %(limit)s
+'''
+
+FACE_DETECTIONS_PAGE_QUERY = '''
+    SELECT fd.id, fd.driver_id, d.name AS driver_name, fd.image_url, fd.confidence,
+           fd.match_result, fd.detected_at
+    FROM face_detections fd
+    LEFT JOIN drivers d ON fd.driver_id = d.id
+    WHERE fd.truck_id = %(truck_id)s AND (fd.detected_at, fd.id) < (%(before_ts)s, %(before_id)s)
+    ORDER BY fd.detected_at DESC, fd.id DESC
+    LIMIT %(limit)s
+'''
+
+LOCATIONS_PAGE_QUERY = '''
+    SELECT id, latitude::float8 AS latitude, longitude::float8 AS longitude, speed, timestamp
+    FROM gps_locations
+    WHERE truck_id = %(truck_id)s AND (timestamp, id) < (%(before_ts)s, %(before_id)s)
+      AND timestamp <= %(before_ts)s
+    ORDER BY timestamp DESC, id DESC
+    LIMIT %(limit)s
+'''
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(ts, row_id):
+    raw = '%s|%d' % (ts.isoformat(), row_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return FIRST_PAGE
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        ts, row_id = raw.split('|')
+        return datetime.fromisoformat(ts), int(row_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise CursorError('invalid cursor')
+
+
+def page_size(value):
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(MAX_PAGE_SIZE, value))
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def keyset_page(cur, query, ts_column, truck_id, cursor=None, limit=DEFAULT_PAGE_SIZE, archived=None):
+    # cur must return dict rows. One extra row is fetched to tell whether a next page exists.
+    # archived(cur, truck_id, before_ts, before_id, limit, since) supplies rows that have
+    # been moved out of the table; both sources are merged in key order. When the table
+    # fills the page, only archived days from its oldest row on can still make the cut.
+    before_ts, before_id = decode_cursor(cursor)
+    cur.execute(query, {'truck_id': truck_id, 'before_ts': before_ts, 'before_id': before_id, 'limit': limit + 1})
+    rows = cur.fetchall()
+    if archived is not None:
+        since = rows[limit][ts_column] if len(rows) > limit else None
+        rows.extend(archived(cur, truck_id, before_ts, before_id, limit + 1, since))
+        rows.sort(key=lambda row: (row[ts_column], row['id']), reverse=True)
+        del rows[limit + 1:]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][ts_column], rows[-1]['id'])
+    items = [{key: _json_value(value) for key, value in row.items()} for row in rows]
+    return items, next_cursor
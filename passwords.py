@@ -0,0 +1,163 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Password hashes are computed in a small pool of worker processes, so a burst of
+# logins costs a bounded amount of CPU instead of one KDF per request thread. 0 hashes
+# in the calling thread.
+PASSWORD_WORKERS = int(os.getenv('PASSWORD_WORKERS', '2'))
+# Logins waiting for or being hashed per process; beyond that a login is refused with
+# 503 straight away instead of queueing behind the storm.
+PASSWORD_QUEUE_DEPTH = int(os.getenv('PASSWORD_QUEUE_DEPTH', '16'))
+PASSWORD_TIMEOUT = float(os.getenv('PASSWORD_TIMEOUT', '10'))
+# Workers run at a lower CPU priority than the web threads, so page requests keep
+# their share of the CPU while hashes are computed.
+PASSWORD_WORKER_NICE = int(os.getenv('PASSWORD_WORKER_NICE', '5'))
+# Attempts are limited per (client address, username), so failures sent under someone
+# else's name from elsewhere never lock the real user out, and failed attempts per
+# address across all usernames, against password spraying. Both are counted per process: with N workers
+# a client gets up to N times the limit.
+LOGIN_RATE_LIMIT = int(os.getenv('LOGIN_RATE_LIMIT', '10'))
+LOGIN_ADDRESS_RATE_LIMIT = int(os.getenv('LOGIN_ADDRESS_RATE_LIMIT', '50'))
+LOGIN_RATE_WINDOW = float(os.getenv('LOGIN_RATE_WINDOW', '60'))
+
+
+class LoginThrottledError(ValueError):
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class LoginRateLimiter:
+    # Sliding window of attempt times per username, bounded to the most recently
+    # seen names.
+    def __init__(self, limit, window, maxsize=100000):
+        self.limit = limit
+        self.window = window
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._attempts = OrderedDict()
+
+    def check(self, key):
+        # Seconds until key may try again, or 0, without recording an attempt.
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if attempts is None:
+                return 0
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            return attempts[0] + self.window - now if len(attempts) >= self.limit else 0
+
+    def hit(self, key):
+        # Records an attempt; returns 0 when allowed, otherwise seconds until the
+        # oldest attempt leaves the window.
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if attempts is None:
+                attempts = self._attempts[key] = deque()
+            self._attempts.move_to_end(key)
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= self.limit:
+                return attempts[0] + self.window - now
+            attempts.append(now)
+            while len(self._attempts) > self.maxsize:
+                self._attempts.popitem(last=False)
+            return 0
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+
+login_attempts = LoginRateLimiter(LOGIN_RATE_LIMIT, LOGIN_RATE_WINDOW)
+address_attempts = LoginRateLimiter(LOGIN_ADDRESS_RATE_LIMIT, LOGIN_RATE_WINDOW)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_QUEUE_DEPTH)
+
+
+def _lower_priority(nice):
+    if nice:
+        os.nice(nice)
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                # forkserver: workers never inherit the web process's threads or sockets.
+                _pool = ProcessPoolExecutor(PASSWORD_WORKERS, mp_context=multiprocessing.get_context('forkserver'),
+                                            initializer=_lower_priority, initargs=(PASSWORD_WORKER_NICE,))
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def throttle_login(username, address):
+    retry_after = address_attempts.check(address) or login_attempts.hit((address, username.lower()))
+    if retry_after:
+        seconds = int(retry_after) + 1
+        raise LoginThrottledError('Too many login attempts; try again in %d seconds' % seconds, 429, seconds)
+
+
+def login_succeeded(username, address):
+    login_attempts.reset((address, username.lower()))
+
+
+def login_failed(address):
+    # Only failures count against the address, so a depot signing its whole shift in
+    # from behind one NAT address is never refused.
+    address_attempts.hit(address)
+
+
+def check_password(password_hash, password):
+    if PASSWORD_WORKERS <= 0:
+        return check_password_hash(password_hash, password)
+    if not _slots.acquire(blocking=False):
+        raise LoginThrottledError('Too many logins in progress; try again shortly', 503, 1)
+    pool = _get_pool()
+    try:
+        future = pool.submit(check_password_hash, password_hash, password)
+    except BaseException as e:
+        _slots.release()
+        if isinstance(e, BrokenProcessPool):
+            _discard_pool(pool)
+            raise LoginThrottledError('Login temporarily unavailable; try again shortly', 503, 1)
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(PASSWORD_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        raise LoginThrottledError('Login timed out; try again shortly', 503, 1)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); the next login starts a new pool.
+        _discard_pool(pool)
+        raise LoginThrottledError('Login temporarily unavailable; try again shortly', 503, 1)
+
+
+def hash_passwords(passwords):
+    if PASSWORD_WORKERS <= 0 or len(passwords) < 2:
+        return [generate_password_hash(password) for password in passwords]
+    return list(_get_pool().map(generate_password_hash, passwords))
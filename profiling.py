@@ -0,0 +1,218 @@
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+import psycopg2.extensions
+from flask import g
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', '0') == '1'
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL_MS', '5')) / 1000
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+# The current request's QueryStats; a ContextVar is much cheaper to read on every
+# statement than flask.g, and stays per-greenlet under gevent.
+_current_stats = ContextVar('query_stats', default=None)
+
+
+class QueryStats:
+    __slots__ = ('queries', 'db_time', 'rows', 'slowest', 'slowest_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.slowest = None
+        self.slowest_time = 0.0
+
+    def record(self, query, elapsed, rows):
+        self.queries += 1
+        self.db_time += elapsed
+        self.rows += rows
+        if elapsed > self.slowest_time:
+            self.slowest, self.slowest_time = query, elapsed
+
+
+def _statement(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return ' '.join(str(query).split())[:500]
+
+
+def _record(cur, query, elapsed):
+    rows = cur.rowcount if cur.description is not None and cur.rowcount > 0 else 0
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record(query, elapsed, rows)
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        # The statement template is logged, never the bound parameters.
+        logger.warning('slow query (%.1f ms, %d rows): %s', elapsed * 1000, rows, _statement(query))
+
+
+class ProfiledCursorMixin:
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _record(self, query, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _record(self, query, time.perf_counter() - started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            _record(self, sql, time.perf_counter() - started)
+
+
+_profiled_classes = {}
+
+
+def _profiled(cursor_class):
+    cls = _profiled_classes.get(cursor_class)
+    if cls is None:
+        cls = type('Profiled' + cursor_class.__name__, (ProfiledCursorMixin, cursor_class), {})
+        _profiled_classes[cursor_class] = cls
+    return cls
+
+
+class ProfiledConnection(psycopg2.extensions.connection):
+    # Every cursor, whatever cursor_factory the caller asks for, is timed.
+    def cursor(self, *args, **kwargs):
+        cursor_class = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _profiled(cursor_class)
+        return super().cursor(*args, **kwargs)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = sorted((key, (list(v[0]), v[1], v[2])) for key, v in self._series.items())
+        for label_values, (counts, total, count) in series:
+            labels = ','.join('%s="%s"' % (k, _escape(v)) for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, labels, count))
+            lines.append('%s_sum{%s} %s' % (self.name, labels, repr(total)))
+            lines.append('%s_count{%s} %d' % (self.name, labels, count))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_latency = Histogram(
+    'http_request_duration_seconds', 'Request latency by route.',
+    LATENCY_BUCKETS, ('route', 'method', 'status'))
+request_db_time = Histogram(
+    'http_request_db_seconds', 'Time spent in database calls per request.',
+    LATENCY_BUCKETS, ('route', 'method'))
+request_queries = Histogram(
+    'http_request_db_queries', 'Database statements issued per request.',
+    QUERY_COUNT_BUCKETS, ('route', 'method'))
+
+
+class Sampler(threading.Thread):
+    # Samples one thread's Python stack at a fixed interval and aggregates collapsed
+    # stacks ("a;b;c count"), the input format of flame graph tools.
+    def __init__(self, thread_id, interval=PROFILER_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return '\n'.join('%s %d' % (stack, count) for stack, count in self.stacks.most_common()) + '\n'
+
+
+def start_request(profile=False):
+    g.request_started = time.perf_counter()
+    g.query_stats = QueryStats()
+    g.query_stats_token = _current_stats.set(g.query_stats)
+    if profile and PROFILER_ENABLED:
+        g.sampler = Sampler(threading.get_ident())
+        g.sampler.start()
+
+
+def finish_request(route, method, status):
+    if 'request_started' not in g:
+        return None
+    elapsed = time.perf_counter() - g.request_started
+    stats = g.query_stats
+    _current_stats.reset(g.query_stats_token)
+    request_latency.observe(elapsed, route, method, str(status))
+    request_db_time.observe(stats.db_time, route, method)
+    request_queries.observe(stats.queries, route, method)
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        sampler.stop()
+    return elapsed, stats, sampler
+
+
+def profile_report(label, elapsed, stats, sampler):
+    summary = '# %s: %.1f ms, %d queries, %.1f ms in database, %d rows, slowest %.1f ms: %s\n' % (
+        label, elapsed * 1000, stats.queries, stats.db_time * 1000, stats.rows,
+        stats.slowest_time * 1000, _statement(stats.slowest or ''))
+    return summary + sampler.collapsed()
+
+
+def render_metrics(extra=()):
+    lines = []
+    for histogram in (request_latency, request_db_time, request_queries):
+        lines.extend(histogram.render())
+    lines.extend(extra)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,245 @@
+import fcntl
+import os
+import struct
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from flask import Response, request
+
+RECORDINGS_DIR = os.getenv('RECORDINGS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings'))
+RECORDING_MAX_BYTES = int(os.getenv('RECORDING_MAX_BYTES', str(8 * 1024 ** 3)))
+# Upload bodies are copied to disk, and downloads without a server file wrapper are
+# read, this many bytes at a time; nothing holds more than that per request.
+RECORDING_IO_BYTES = int(os.getenv('RECORDING_IO_BYTES', str(1024 * 1024)))
+MIMETYPE = 'video/mp4'
+# Servers whose wsgi.file_wrapper sends no more than Content-Length (gunicorn, with
+# sendfile(2) from the current offset), so byte ranges can go to the wrapper too.
+RANGE_FILE_WRAPPER_SERVERS = ('gunicorn/',)
+
+# Trucks upload a recording as a sequence of PATCH requests, each appending its body
+# at the offset the client states. HEAD reports the bytes already on disk, so after
+# a dropped connection the upload resumes from there. A flock on the file lets one
+# upload at a time write to a recording, and lets stop wait for the one in flight.
+
+
+class RecordingError(ValueError):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def recording_file(truck_id, recording_id):
+    return '%d/%d.mp4' % (truck_id, recording_id)
+
+
+def recording_path(file_path):
+    return os.path.join(RECORDINGS_DIR, file_path)
+
+
+def video_url(truck_id, recording_id):
+    return '/truck/%d/recording/%d/video' % (truck_id, recording_id)
+
+
+def upload_url(truck_id, recording_id):
+    return '/api/truck/%d/recording/%d/upload' % (truck_id, recording_id)
+
+
+def parse_camera_number(value):
+    try:
+        camera_number = int(value)
+    except (TypeError, ValueError):
+        raise RecordingError('camera_number must be an integer')
+    if not 1 <= camera_number <= 16:
+        raise RecordingError('camera_number must be between 1 and 16')
+    return camera_number
+
+
+def create_recording(cur, truck_id, camera_number):
+    cur.execute('''
+        INSERT INTO video_recordings (truck_id, camera_number, status)
+        VALUES (%s, %s, 'recording')
+        RETURNING id
+    ''', (truck_id, camera_number))
+    recording_id = cur.fetchone()[0]
+    cur.execute('UPDATE video_recordings SET file_url = %s, file_path = %s WHERE id = %s',
+                (video_url(truck_id, recording_id), recording_file(truck_id, recording_id), recording_id))
+    return recording_id
+
+
+def upload_offset(file_path):
+    try:
+        return os.stat(recording_path(file_path)).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def last_write(file_path):
+    # When the upload last appended to the file (naive UTC), or None without a file.
+    try:
+        mtime = os.stat(recording_path(file_path)).st_mtime
+    except FileNotFoundError:
+        return None
+    return datetime.fromtimestamp(mtime, timezone.utc).replace(tzinfo=None)
+
+
+@contextmanager
+def locked(file_path, wait):
+    path = recording_path(file_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RecordingError('Another upload to this recording is in progress', 409, upload_offset(file_path))
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_chunk(f, offset, stream):
+    # Appends the request body at offset, which must be the current end of the file.
+    # A body cut short leaves what arrived on disk; the client asks for the offset
+    # and sends the rest.
+    size = os.fstat(f.fileno()).st_size
+    if offset != size:
+        raise RecordingError('Upload-Offset does not match the bytes received', 409, size)
+    while True:
+        data = stream.read(RECORDING_IO_BYTES)
+        if not data:
+            break
+        if size + len(data) > RECORDING_MAX_BYTES:
+            f.truncate(offset)
+            raise RecordingError('Recording exceeds %d bytes' % RECORDING_MAX_BYTES, 413, offset)
+        f.write(data)
+        size += len(data)
+    f.flush()
+    return size
+
+
+def finalize(f):
+    # Runs with the upload lock held, once no more chunks are accepted. Returns the
+    # size on disk and the media duration in seconds, or None when the file does not
+    # record one (fragmented MP4 written live).
+    os.fsync(f.fileno())
+    size = os.fstat(f.fileno()).st_size
+    return size, mp4_duration(f.name)
+
+
+def remove(file_path):
+    try:
+        os.unlink(recording_path(file_path))
+    except FileNotFoundError:
+        pass
+
+
+def _find_box(f, start, end, kind):
+    # Returns (payload start, box end) of the first box of this type among the ISO BMFF
+    # boxes in [start, end), reading only their headers.
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(16)
+        if len(header) < 8:
+            return None
+        size, box = struct.unpack_from('>I4s', header)
+        payload = pos + 8
+        if size == 1:
+            if len(header) < 16:
+                return None
+            size = struct.unpack_from('>Q', header, 8)[0]
+            payload = pos + 16
+        elif size == 0:
+            size = end - pos
+        if size < payload - pos:
+            return None
+        if box == kind:
+            return payload, min(pos + size, end)
+        pos += size
+    return None
+
+
+def mp4_duration(path):
+    with open(path, 'rb') as f:
+        moov = _find_box(f, 0, os.fstat(f.fileno()).st_size, b'moov')
+        if moov is None:
+            return None
+        mvhd = _find_box(f, *moov, b'mvhd')
+        if mvhd is None:
+            return None
+        f.seek(mvhd[0])
+        data = f.read(32)
+        if len(data) < 32:
+            return None
+        timescale, duration = struct.unpack_from('>IQ' if data[0] == 1 else '>II', data, 20 if data[0] == 1 else 12)
+        if duration in (0, 0xffffffff, 0xffffffffffffffff):
+            # Fragmented files may carry the total in mvex/mehd instead.
+            mvex = _find_box(f, *moov, b'mvex')
+            mehd = mvex and _find_box(f, *mvex, b'mehd')
+            if not mehd:
+                return None
+            f.seek(mehd[0])
+            data = f.read(12)
+            duration = struct.unpack_from('>Q' if data[0] == 1 else '>I', data, 4)[0]
+        return duration / timescale if timescale and duration else None
+
+
+def _read_range(f, length):
+    try:
+        while length > 0:
+            data = f.read(min(RECORDING_IO_BYTES, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def video_response(file_path):
+    # Serves the file, or the single byte range asked for, through the server's
+    # wsgi.file_wrapper (sendfile(2) under gunicorn). Other wrappers may stream to
+    # EOF whatever Content-Length says (wsgiref does), so elsewhere ranges are read
+    # from their first byte for exactly their length instead; a seek into a large
+    # recording still reads only the bytes asked for. Returns None when there is
+    # no file.
+    try:
+        f = open(recording_path(file_path), 'rb')
+    except FileNotFoundError:
+        return None
+    st = os.fstat(f.fileno())
+    size = st.st_size
+    etag = '%x-%x' % (st.st_mtime_ns, size)
+    headers = {'Accept-Ranges': 'bytes', 'Cache-Control': 'private, no-cache'}
+    if request.if_none_match.contains(etag):
+        f.close()
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, size, 200
+    byte_range = request.range
+    if_range = request.if_range
+    if byte_range is not None and len(byte_range.ranges) == 1 and (
+            (if_range.etag is None and if_range.date is None) or if_range.etag == etag or
+            (if_range.date is not None and int(if_range.date.timestamp()) == int(st.st_mtime))):
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            f.close()
+            headers['Content-Range'] = 'bytes */%d' % size
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+
+    f.seek(start)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and (
+            status == 200 or request.environ.get('SERVER_SOFTWARE', '').startswith(RANGE_FILE_WRAPPER_SERVERS)):
+        body = file_wrapper(f, RECORDING_IO_BYTES)
+    else:
+        body = _read_range(f, stop - start)
+    response = Response(body, status=status, headers=headers, mimetype=MIMETYPE, direct_passthrough=True)
+    response.content_length = stop - start
+    response.set_etag(etag)
+    response.last_modified = st.st_mtime
+    return response
@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from migrations import migrate
+from models import get_db_connection
+
+
+@pytest.fixture
+def db():
+    # A migrated Postgres connection; tests that need one are skipped without DATABASE_URL.
+    if not os.getenv('DATABASE_URL'):
+        pytest.skip('DATABASE_URL is not set')
+    conn = get_db_connection()
+    try:
+        migrate(conn)
+        yield conn
+    finally:
+        conn.close()
@@ -0,0 +1,33 @@
+import numpy as np
+
+import analytics
+from analytics import analyze
+
+
+def track(truck_id, start, speeds_kmh, interval=10.0):
+    # Points due north along a meridian, one per interval, at the given segment speeds.
+    ts = start + interval * np.arange(len(speeds_kmh) + 1)
+    metres = np.concatenate(([0.0], np.cumsum(np.asarray(speeds_kmh) / 3.6 * interval)))
+    lat = 40.0 + np.degrees(metres / analytics.EARTH_RADIUS_M)
+    return np.full(len(ts), truck_id, dtype=np.int64), ts, lat, np.full(len(ts), -74.0)
+
+
+def test_speeding_peak_ignores_segments_after_the_run():
+    # 60s at 120-130 km/h, then a glitch (implausible jump) and slow driving; then a
+    # second truck whose first point is far away, making a huge cross-truck segment.
+    first = track(1, 0.0, [120, 130, 125, 120, 120, 120, 5000, 50, 50])
+    second = track(2, 0.0, [50, 50, 50])
+    second = (second[0], second[1], second[2] + 30.0, second[3])
+    truck_ids, ts, lat, lon = (np.concatenate(parts) for parts in zip(first, second))
+
+    result = analyze(truck_ids, ts, lat, lon)
+
+    ((truck_id, started, duration, peak),) = result['speeding']
+    assert truck_id == 1 and started == 0.0 and duration == 60.0
+    assert abs(peak - 130) < 0.5
+
+
+def test_speeding_peak_of_run_ending_at_last_segment():
+    result = analyze(*track(1, 0.0, [50, 110, 140, 115, 110]))
+    ((_, started, duration, peak),) = result['speeding']
+    assert started == 10.0 and duration == 40.0 and abs(peak - 140) < 0.5
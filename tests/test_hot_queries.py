@@ -0,0 +1,10 @@
+from migrations import HOT_QUERIES, check_hot_query_indexes
+
+
+def test_hot_queries_use_their_index(db):
+    assert check_hot_query_indexes(db) == []
+
+
+def test_hot_query_names_are_unique():
+    names = [query[0] for query in HOT_QUERIES]
+    assert len(names) == len(set(names))
@@ -0,0 +1,39 @@
+import pytest
+
+from ingest import IngestError, iter_csv, iter_jsonl, parse_timestamp
+
+
+@pytest.mark.parametrize('value', [1e20, -1e20, '99999999999999999999', float('inf'), '9999-12-31T23:00:00-05:00'])
+def test_parse_timestamp_out_of_range(value):
+    with pytest.raises(IngestError):
+        parse_timestamp(value)
+
+
+def test_out_of_range_timestamp_rejects_only_its_line():
+    lines = [
+        '{"truck_id": 1, "latitude": 40.7, "longitude": -74.0, "timestamp": 1e20}',
+        '{"truck_id": 1, "latitude": 40.7, "longitude": -74.0, "timestamp": 1700000000}',
+    ]
+    (_, bad), (_, good) = iter_jsonl(lines)
+    assert isinstance(bad, IngestError) and 'line 1' in str(bad)
+    assert good[0] == 1 and good[3].year == 2023
+    ((_, bad),) = iter_csv(['1,40.7,-74.0,99999999999999999999'])
+    assert isinstance(bad, IngestError)
+
+
+@pytest.mark.parametrize('value', [[1], {'t': 1}, True])
+def test_parse_timestamp_rejects_other_types(value):
+    with pytest.raises(IngestError):
+        parse_timestamp(value)
+
+
+def test_non_scalar_timestamp_rejects_only_its_line():
+    lines = [
+        '{"truck_id": 1, "latitude": 40.7, "longitude": -74.0, "timestamp": [1]}',
+        '{"truck_id": 1, "latitude": 40.7, "longitude": -74.0, "timestamp": {"t": 1}}',
+        '{"truck_id": 1, "latitude": 40.7, "longitude": -74.0}',
+    ]
+    (_, first), (_, second), (_, good) = iter_jsonl(lines)
+    assert isinstance(first, IngestError) and 'line 1' in str(first)
+    assert isinstance(second, IngestError) and 'line 2' in str(second)
+    assert good[0] == 1 and good[3] is None
@@ -0,0 +1,46 @@
+import pytest
+
+import passwords
+from passwords import LoginRateLimiter, LoginThrottledError, login_failed, login_succeeded, throttle_login
+
+
+@pytest.fixture(autouse=True)
+def limiters(monkeypatch):
+    monkeypatch.setattr(passwords, 'login_attempts', LoginRateLimiter(3, 60))
+    monkeypatch.setattr(passwords, 'address_attempts', LoginRateLimiter(5, 60))
+
+
+def test_failures_from_another_address_do_not_lock_the_user_out():
+    for _ in range(3):
+        throttle_login('john_doe', '203.0.113.9')
+    with pytest.raises(LoginThrottledError) as refused:
+        throttle_login('John_Doe', '203.0.113.9')
+    assert refused.value.status == 429 and refused.value.retry_after > 0
+    throttle_login('john_doe', '198.51.100.7')
+
+
+def test_address_limit_counts_failures_across_usernames():
+    for i in range(5):
+        throttle_login('user%d' % i, '203.0.113.9')
+        login_failed('203.0.113.9')
+    with pytest.raises(LoginThrottledError):
+        throttle_login('someone_else', '203.0.113.9')
+    throttle_login('someone_else', '198.51.100.7')
+
+
+def test_many_users_logging_in_from_one_address():
+    # A shift change behind one NAT address: far more successful logins than the
+    # address limit, plus a few typos, all allowed.
+    for i in range(50):
+        throttle_login('driver%d' % i, '203.0.113.9')
+        if i % 20 == 0:
+            login_failed('203.0.113.9')
+            throttle_login('driver%d' % i, '203.0.113.9')
+        login_succeeded('driver%d' % i, '203.0.113.9')
+
+
+def test_success_clears_only_that_address_and_username():
+    for _ in range(3):
+        throttle_login('john_doe', '203.0.113.9')
+    login_succeeded('john_doe', '203.0.113.9')
+    throttle_login('john_doe', '203.0.113.9')
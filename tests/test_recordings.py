@@ -0,0 +1,60 @@
+from wsgiref.util import FileWrapper
+
+import pytest
+from flask import Flask
+
+import recordings
+from recordings import video_response
+
+app = Flask(__name__)
+
+
+@pytest.fixture
+def recording(tmp_path, monkeypatch):
+    monkeypatch.setattr(recordings, 'RECORDINGS_DIR', str(tmp_path))
+    data = bytes(range(256)) * 40
+    (tmp_path / '1').mkdir()
+    (tmp_path / '1' / '2.mp4').write_bytes(data)
+    return '1/2.mp4', data
+
+
+def body(response):
+    chunks = b''.join(response.response)
+    response.close()
+    return chunks
+
+
+@pytest.mark.parametrize('file_wrapper', [None, FileWrapper])
+def test_range_body_matches_content_length(recording, file_wrapper):
+    file_path, data = recording
+    environ = {'wsgi.file_wrapper': file_wrapper} if file_wrapper else {}
+    with app.test_request_context(headers={'Range': 'bytes=100-109'}, environ_overrides=environ):
+        response = video_response(file_path)
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == 'bytes 100-109/%d' % len(data)
+        assert response.content_length == 10
+        assert body(response) == data[100:110]
+
+
+@pytest.mark.parametrize('file_wrapper', [None, FileWrapper])
+def test_whole_file(recording, file_wrapper):
+    file_path, data = recording
+    environ = {'wsgi.file_wrapper': file_wrapper} if file_wrapper else {}
+    with app.test_request_context(environ_overrides=environ):
+        response = video_response(file_path)
+        assert response.status_code == 200 and response.content_length == len(data)
+        assert body(response) == data
+
+
+def test_gunicorn_range_goes_to_file_wrapper(recording):
+    # gunicorn sends Content-Length bytes from the file's offset with sendfile(2).
+    gunicorn_wsgi = pytest.importorskip('gunicorn.http.wsgi')
+    file_path, data = recording
+    environ = {'wsgi.file_wrapper': gunicorn_wsgi.FileWrapper, 'SERVER_SOFTWARE': 'gunicorn/23.0.0'}
+    with app.test_request_context(headers={'Range': 'bytes=100-109'}, environ_overrides=environ):
+        response = video_response(file_path)
+        assert response.status_code == 206 and response.content_length == 10
+        wrapper = response.response
+        assert isinstance(wrapper, gunicorn_wsgi.FileWrapper)
+        assert wrapper.filelike.tell() == 100
+        assert body(response)[:10] == data[100:110]
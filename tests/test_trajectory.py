@@ -0,0 +1,26 @@
+import math
+
+import pytest
+
+from trajectory import MAX_ZOOM, TrajectoryError, check_detail, zoom_tolerance
+
+
+@pytest.mark.parametrize('zoom', [-1.0, MAX_ZOOM + 1, 1e6, math.nan, math.inf])
+def test_zoom_out_of_range_is_rejected(zoom):
+    with pytest.raises(TrajectoryError):
+        check_detail(zoom=zoom)
+    with pytest.raises(TrajectoryError):
+        zoom_tolerance(zoom, 40.0)
+
+
+@pytest.mark.parametrize('tolerance', [-0.5, math.nan, math.inf])
+def test_tolerance_must_be_finite_and_non_negative(tolerance):
+    with pytest.raises(TrajectoryError):
+        check_detail(tolerance=tolerance)
+
+
+def test_valid_detail_is_accepted():
+    check_detail()
+    check_detail(zoom=0, tolerance=0.0)
+    check_detail(zoom=MAX_ZOOM, tolerance=25.0)
+    assert 0 < zoom_tolerance(MAX_ZOOM, 40.0) < zoom_tolerance(0, 40.0)
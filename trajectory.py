@@ -0,0 +1,105 @@
+import heapq
+import math
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+# Ground resolution of a 256px Web Mercator tile at zoom 0, in metres per pixel at the equator.
+ZOOM0_METERS_PER_PIXEL = 156543.03392
+# Deepest zoom level of common web map tile servers.
+MAX_ZOOM = 24
+
+
+class TrajectoryError(ValueError):
+    pass
+
+
+def project(lat, lon):
+    # Local equirectangular projection in metres; accurate enough for simplification tolerances.
+    lat0 = math.radians(float(np.mean(lat))) if len(lat) else 0.0
+    x = np.radians(lon) * EARTH_RADIUS_M * math.cos(lat0)
+    y = np.radians(lat) * EARTH_RADIUS_M
+    return np.column_stack((x, y))
+
+
+def check_detail(zoom=None, tolerance=None):
+    # NaN fails both comparisons, so it is rejected along with the out-of-range values.
+    if zoom is not None and not 0 <= zoom <= MAX_ZOOM:
+        raise TrajectoryError('zoom must be between 0 and %d' % MAX_ZOOM)
+    if tolerance is not None and not 0 <= tolerance < math.inf:
+        raise TrajectoryError('tolerance must be a finite, non-negative number of metres')
+
+
+def zoom_tolerance(zoom, latitude, pixels=1.0):
+    check_detail(zoom=zoom)
+    return pixels * ZOOM0_METERS_PER_PIXEL * math.cos(math.radians(latitude)) / (2 ** zoom)
+
+
+def _farthest(xy, start, end):
+    points = xy[start + 1:end]
+    a = xy[start]
+    ab = xy[end] - a
+    ap = points - a
+    denom = float(ab @ ab)
+    if denom == 0.0:
+        dist2 = np.einsum('ij,ij->i', ap, ap)
+    else:
+        t = np.clip(ap @ ab / denom, 0.0, 1.0)
+        offset = ap - np.outer(t, ab)
+        dist2 = np.einsum('ij,ij->i', offset, offset)
+    i = int(np.argmax(dist2))
+    return start + 1 + i, math.sqrt(float(dist2[i]))
+
+
+def simplify(xy, tolerance=0.0, max_points=None):
+    # Douglas-Peucker driven by a max-heap of segments: the segment with the largest
+    # deviation is always split first. Stopping once the top deviation is within
+    # tolerance gives the exact Douglas-Peucker result; stopping at max_points keeps
+    # the most significant vertices. Each split is one vectorized pass over its slice.
+    n = len(xy)
+    if n <= 2:
+        return np.arange(n)
+    budget = n if max_points is None else max(2, max_points)
+    keep = [0, n - 1]
+    index, distance = _farthest(xy, 0, n - 1)
+    heap = [(-distance, 0, n - 1, index)]
+    while heap and len(keep) < budget:
+        negative, start, end, index = heapq.heappop(heap)
+        if -negative <= tolerance:
+            break
+        keep.append(index)
+        for s, e in ((start, index), (index, end)):
+            if e - s > 1:
+                child, distance = _farthest(xy, s, e)
+                heapq.heappush(heap, (-distance, s, e, child))
+    keep.sort()
+    return np.asarray(keep)
+
+
+def encode_polyline(lat, lon, precision=5):
+    # Google encoded polyline, computed for all points at once.
+    if len(lat) == 0:
+        return ''
+    coords = np.round(np.column_stack((lat, lon)) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(coords, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    shifts = np.arange(7, dtype=np.int64) * 5
+    chunks = (values[:, None] >> shifts) & 0x1F
+    lengths = np.maximum(1, np.count_nonzero(values[:, None] >> shifts, axis=1))
+    position = np.arange(7)
+    chunks = chunks | np.where(position < (lengths - 1)[:, None], 0x20, 0)
+    return (chunks[position < lengths[:, None]] + 63).astype(np.uint8).tobytes().decode('ascii')
+
+
+def decode_polyline(encoded, precision=5):
+    values = []
+    current = shift = 0
+    for byte in encoded.encode('ascii'):
+        byte -= 63
+        current |= (byte & 0x1F) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(current >> 1) if current & 1 else current >> 1)
+            current = shift = 0
+    coords = np.cumsum(np.asarray(values, dtype=np.int64).reshape(-1, 2), axis=0)
+    return coords / 10 ** precision
@@ -0,0 +1,71 @@
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+
+# Everything the truck page renders server-side, fetched in one round trip: the truck
+# row, its last-known state and its drivers folded into a JSON array by a lateral
+# subquery. The paginated sections are loaded separately by the page itself.
+TRUCK_BUNDLE_QUERY = '''
+    SELECT t.id, t.truck_number, t.owner_id, t.license_plate, t.model, t.status, t.created_at,
+           s.latitude, s.longitude, s.speed, s.reported_at, s.active_alerts,
+           CASE WHEN s.offline_cameras > 0 THEN 'offline' ELSE 'online' END,
+           COALESCE(d.drivers, '[]'::json)
+    FROM trucks t
+    LEFT JOIN truck_state s ON s.truck_id = t.id
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_array(id, name, phone, license_number, photo_url)) AS drivers
+        FROM drivers
+        WHERE truck_id = t.id
+    ) d ON TRUE
+    WHERE t.id = %s
+'''
+
+
+@dataclass(frozen=True, slots=True)
+class Truck:
+    id: int
+    truck_number: str
+    owner_id: int | None
+    license_plate: str | None
+    model: str | None
+    status: str | None
+    created_at: datetime | None
+
+
+@dataclass(frozen=True, slots=True)
+class Driver:
+    id: int
+    name: str
+    phone: str | None
+    license_number: str | None
+    photo_url: str | None
+
+
+@dataclass(frozen=True, slots=True)
+class Location:
+    latitude: Decimal
+    longitude: Decimal
+    speed: float | None
+    reported_at: datetime
+    active_alerts: int
+    camera_status: str
+
+
+@dataclass(frozen=True, slots=True)
+class TruckBundle:
+    truck: Truck
+    drivers: list[Driver]
+    location: Location | None
+
+
+def load_truck_bundle(cur, truck_id):
+    cur.execute(TRUCK_BUNDLE_QUERY, (truck_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    location = Location(*row[7:13]) if row[10] is not None else None
+    return TruckBundle(
+        truck=Truck(*row[:7]),
+        drivers=[Driver(*driver) for driver in row[13]],
+        location=location,
+    )